@@ -1,5 +1,5 @@
-_version__ = '0.0.1'
-__author__ = 'Ishan Jain
+__version__ = '0.0.1'
+__author__ = 'Ishan Jain'
 __lastupdate__ = '2022'
 
 """
@@ -9,20 +9,37 @@ Online Leads are generated through facebook and Google Ads.
 
 """
 
-from flask import Blueprint, request, jsonify
-import pandas as pd
-import requests
-import bs4
-from bs4 import BeautifulSoup
-from utilities import api_validation_function as avf
-from los import los_function as lf
+from flask import Blueprint, Response, request
+from online_leads import admission
+from online_leads import async_lookups
+from online_leads import eligibility_rules
+from online_leads import hist_writer
+from online_leads import metrics
+from online_leads import request_profiler
+from online_leads import request_schema
+from online_leads import response_templates
+from online_leads import result_cache
+from online_leads import step_trace
+from online_leads import threshold_cache
+from online_leads import token_cache
+from online_leads import warmup
 
 
 # Define blueprint
 online_leads_eligibility_api = Blueprint('online_leads_eligibility_api', __name__)
 
+# Define metrics blueprint, registered along with online_leads_eligibility_api
+online_leads_metrics_api = Blueprint('online_leads_metrics_api', __name__)
+
+# api_name used for token access, logs and history
+API_NAME = "los/v1/online_leads_eligibility"
+
 
 @online_leads_eligibility_api.route("/los/v1/online_leads_eligibility_api", methods=['POST'])
+@admission.admitted()
+@step_trace.traced(API_NAME, payload=request_schema.request_payload)
+@request_profiler.profiled(API_NAME)
+@result_cache.stores_result
 def online_leads_eligibility():
     
     """
@@ -35,516 +52,407 @@ def online_leads_eligibility():
     """
        
     # defining a variable api_name for later usage
-    api_name = "los/v1/online_leads_eligibility"
+    api_name = API_NAME
     
     # ----------------------------------------------------------------
     # Step 1.1 - API request method check - Only POST is allowed
     # ----------------------------------------------------------------
     if request.method != "POST":
-        return_response = default_api_response_dict(request_status = "fail", 
-                                                    request_message = "invalid API request method", 
-                                                    online_leads_eligibility_status = "NA", 
-                                                    body_message = "NA", 
-                                                    error_response_code = 'NA')
-        return return_response
+        return response_templates.INVALID_METHOD.response()
 
-    # taking the request data in a seperate variable for further usage
-    request_data = request.form
+    # taking the request data (form data or a JSON object) in a seperate variable for further usage
+    request_data = request_schema.request_payload()
+    
+    # all params are parsed, coerced and validated once, the steps below use the typed lead
+    lead = request_schema.parse(request_data)
     
     
     #====================================================================================
-    # Step 2 - Token authentication
+    # Step 2 - Token authentication, results are cached per (token, api_name)
     #====================================================================================
-    token_valid_flag = avf.validate_token_and_api_access(request_data, api_name)
+    with metrics.timed('validate_token_and_api_access'):
+        token_valid_flag = token_cache.validate_token_and_api_access(request_data, api_name)
 
     # logs
-    message = f"Token authentication"
-    avf.make_log(request_data=request_data, message=message, api_name=api_name)
+    step_trace.step("Token authentication")
 
     if token_valid_flag['status'] == "fail":
-        return_response = default_api_response_dict(request_status = "fail", 
-                                                    request_message = token_valid_flag['error'], 
-                                                    online_leads_eligibility_status = "NA", 
-                                                    body_message = "NA", 
-                                                    error_response_code = 'NA')
-
-        avf.add_api_call_hist_data(api_name,
-                                   api_error_label="token", 
-                                   api_status="success", 
-                                   logic_status="fail", 
-                                   api_request = request_data,
-                                   api_response = return_response)
-
-        return return_response
+        return template_response(response_templates.token_failure(token_valid_flag['error']), request_data, api_name)
     
     #====================================================================================
     # Step 3 - Check all mandatory params in request data
     #====================================================================================
 
     # logs
-    message = f"Check all mandatory params in request data"
-    avf.make_log(request_data=request_data, message=message, api_name=api_name)
-
-    mandatory_param_lst = ['application_id',
-                          'business_name',
-                          'business_pincode',
-                          'mobile_number',
-                          'business_type',
-                          'business_main_sector',
-                          'business_specific_sector',
-                          'vintage_months',
-                          'average_annual_turnover',
-                          'required_loan_amount',
-                          'preferred_monthly_EMI',
-                          'applicant_name',
-                          'app_highmark_score_A8']
-
-    optional_param_lst = ['loan_purpose',
-                          'applicant_pan_number',
-                          'email_address',
-                          'email_type',
-                          'dev_bypass',
-                          'loan_type',
-                          'applicant_highmark_XML']
-    
-    all_params_status = avf.check_required_parameter(request_data, mandatory_param_lst)
-
-    if all_params_status == False:
-        return_response = default_api_response_dict(request_status = "fail", 
-                                                    request_message = "all mandatory parameters are not sent", 
-                                                    online_leads_eligibility_status = "NA", 
-                                                    body_message = "NA", 
-                                                    error_response_code = 'NA')
+    step_trace.step("Check all mandatory params in request data")
 
-        avf.add_api_call_hist_data(api_name,
-                                   api_error_label="missing mandatory parameter", 
-                                   api_status="success", 
-                                   logic_status="fail", 
-                                   api_request = request_data,
-                                   api_response = return_response)
-
-        return return_response
+    if lead.missing_params:
+        return template_response(response_templates.TEMPLATES['missing_params'], request_data, api_name)
     
     
     #====================================================================================
-    # Step-4 If dev_bypass is True, return success
+    # Step-3.1 Duplicate lead - return the stored response of the same lead
     #====================================================================================
+    # a lead sent again with the same data under the same thresholds gets the stored response,
+    # the response of a new lead is stored once this view returns (result_cache.stores_result).
+    # The thresholds are read once, here, for the checks below too: the lead is decided under the
+    # version its response is stored with. They are served from the in-memory cache.
+    with metrics.timed('thresholds'):
+        thresholds = threshold_cache.get_thresholds(api_name)
+    
+    request_key, stored_response = result_cache.lookup(request_data, api_name, thresholds.version)
 
-    # logs
-    message = f"If dev_bypass is True, return success"
-    avf.make_log(request_data=request_data, message=message, api_name=api_name)
-
-    if 'dev_bypass' in request_data.keys():
-        if request_data['dev_bypass'].lower() == 'true':
-            return_response = default_api_response_dict(request_status = "success", 
-                                                        request_message = "successfully completed API call", 
-                                                        online_leads_eligibility_status = "success", 
-                                                        body_message = "DEV_BYPASS -> online_leads_eligibility process has been by-passed successfully", 
-                                                        error_response_code = 'NA')
-
-            avf.add_api_call_hist_data(api_name,
-                                    api_error_label=f"NA",
-                                    api_status="success",
-                                    logic_status="success",
-                                    api_request = request_data,
-                                    api_response = return_response)
-
-            return return_response
-        
-
+    if stored_response is not None:
+        step_trace.step("Duplicate lead - stored response returned")
+        result_cache.record_duplicate(api_name, request_key, stored_response)
+        return stored_response.response()
+    
+    
     #====================================================================================
-    # Step-5 Check data type for all numeric parameters
+    # Step-4 If dev_bypass is True, return success
     #====================================================================================
 
     # logs
-    message = f"Check data type for all numeric parameters"
-    avf.make_log(request_data=request_data, message=message, api_name=api_name)
-
-    numeric_param_lst = ['vintage_months',
-                         'average_annual_turnover', 
-                         'required_loan_amount', 
-                         'preferred_monthly_EMI',
-                         'business_pincode'] 
-    
-    # business_mobile is not considered into this list.
-
-    for param in numeric_param_lst:
-        try:
-            float(request_data[param])
-        except:
-            return_response = default_api_response_dict(request_status = "fail", 
-                                                        request_message = f"Parameter {param} should be numeric",
-                                                        online_leads_eligibility_status = "NA", 
-                                                        body_message = 'NA', 
-                                                        error_response_code = 'NA')
-
-            avf.add_api_call_hist_data(api_name,
-                                       api_error_label=f"{param} data type", 
-                                       api_status="success", 
-                                       logic_status="fail", 
-                                       api_request = request_data,
-                                       api_response = return_response)
-
-            return return_response
+    step_trace.step("If dev_bypass is True, return success")
 
+    if lead.dev_bypass:
+        return template_response(response_templates.TEMPLATES['dev_bypass'], request_data, api_name)
+        
 
     #====================================================================================
-    # Step-6 Check non negative parameters out of all numeric parameters
+    # Step-5 and Step-6 Check data type and non negative values of all numeric parameters
     #====================================================================================
+    # checked by request_schema.parse(), in the order of request_schema.NUMERIC_PARAMS:
+    # the first non numeric param is reported, then the first negative one
 
     # logs
-    message = f"Check non negative parameters out of all numeric parameters"
-    avf.make_log(request_data=request_data, message=message, api_name=api_name)
-
-    non_negative_param_lst =  ['vintage_months',
-                               'average_annual_turnover', 
-                               'required_loan_amount', 
-                               'preferred_monthly_EMI',
-                               'business_pincode'] 
-
-    for param in non_negative_param_lst:
-        if float(request_data[param]) < 0:
-            return_response = default_api_response_dict(request_status = "fail", 
-                                                        request_message = f"Parameter {param} should not be negative", 
-                                                        online_leads_eligibility_status = "NA", 
-                                                        body_message = "NA", 
-                                                        error_response_code = 'NA')
-
-            avf.add_api_call_hist_data(api_name,
-                                       api_error_label=f"{param} negative", 
-                                       api_status="success", 
-                                       logic_status="fail", 
-                                       api_request = request_data,
-                                       api_response = return_response)
+    step_trace.step("Check data type and non negative values of all numeric parameters")
 
-            return return_response
+    if lead.invalid_param is not None:
+        return template_response(response_templates.TEMPLATES[lead.invalid_param], request_data, api_name)
         
     #====================================================================================
     # Step-7 Get threshold variables required
     #====================================================================================
 
-    message = 'Get threshold variables required for online leads eligibility API from "los_thresholds" table in dsapi schema...'
-    avf.make_log(message=message, api_name=api_name, request_data=request_data)
-    
-    threshold_df = lf.get_env_variables(api_name)
+    step_trace.step('Get threshold variables required for online leads eligibility API from "los_thresholds" table in dsapi schema...')
     
-    message = f'Thresholds required for this api --> {threshold_df}'
-    avf.make_log(message=message, api_name=api_name, request_data=request_data)
+    # read once by Step-3.1
+    step_trace.step('Thresholds required for this api --> %s', thresholds)
     
-    # vintage upperbound and lower bound.
-    min_vintage = int(threshold_df.loc[threshold_df.var_key == 'MIN_VINTAGE',"var_value"].values[0])
-    max_vintage = int(threshold_df.loc[threshold_df.var_key == 'MAX_VINTAGE',"var_value"].values[0])
-
-    # reading turnover upper and lower bound.
-    min_turnover = int(threshold_df.loc[threshold_df.var_key == 'MIN_TURNOVER',"var_value"].values[0])
-    max_turnover = int(threshold_df.loc[threshold_df.var_key == 'MAX_TURNOVER',"var_value"].values[0])
-
-    # loan amount upper and lower bound.
-    min_loan_amount = int(threshold_df.loc[threshold_df.var_key == 'MIN_LOAN_AMOUNT',"var_value"].values[0])
-    max_loan_amount = int(threshold_df.loc[threshold_df.var_key == 'MAX_LOAN_AMOUNT',"var_value"].values[0])
-
-    # Min and Max eligible CRIF score for the applicant.
-    min_crif_score = int(threshold_df.loc[threshold_df.var_key == 'MIN_CRIF_SCORE',"var_value"].values[0])
-    max_crif_score = int(threshold_df.loc[threshold_df.var_key == 'MAX_CRIF_SCORE',"var_value"].values[0])
     
+    #====================================================================================
+    # Step-8 to Step-16 Online Leads eligibility CHECK 1 to CHECK 9
+    #====================================================================================
+    # The checks are declared in online_leads.eligibility_rules and run by the rule engine,
+    # cheap in-memory checks first. The response is always the one of the first failing
+    # check in the order below, as if they had been run one after another:
+    #   CHECK 1 - Business Pincode Serviceability    (252)
+    #   CHECK 2 - Sector Validity                    (253)
+    #   CHECK 3 - Sub-Sector Validity                (254)
+    #   CHECK 4 - Vintage Check with "business_type" (255)
+    #   CHECK 5 - Annual Business Turnover check     (256)
+    #   CHECK 6 - requested loan amount validation   (257)
+    #   CHECK 7 - Highmark Score Check               (258)
+    #   CHECK 8 - Loan Purpose                       (251)
+    #   CHECK 9 - Highmark XML Score Check           (259), see online_leads.highmark_report
+    with metrics.timed('eligibility_rules'):
+        failed_rule = eligibility_rules.ENGINE.run(lead, thresholds, api_name)
+    
+    if failed_rule is not None:
+        return template_response(response_templates.for_outcome(failed_rule.outcome), request_data, api_name)
+        
     
     #====================================================================================
-    # Step-8 Online Leads eligibility CHECK 1 - Business Pincode Service-abiltiy
+    # Step-17 All checks are completed - Success response - customer eligible
     #====================================================================================
+
     # logs
-    message = f"Step-8 Online Leads eligibility CHECK 1 - Business Pincode Eligibility"
-    avf.make_log(request_data=request_data, message=message, api_name=api_name)
+    step_trace.step("All checks are completed - Success response")
 
-    business_pincode = (request_data['business_pincode'])
-    
-    
-    if len(business_pincode) >= 7:
-        return_response = default_api_response_dict(request_status = "success", 
-                                                        request_message = 'successfully completed API call', 
-                                                        online_leads_eligibility_status = "fail", 
-                                                        body_message = f"entered pincode is wrong", 
-                                                        error_response_code = 'NA')
+    return template_response(response_templates.TEMPLATES['success'], request_data, api_name)
 
-        avf.add_api_call_hist_data(api_name,
-                                       api_error_label=f"entered pincode is wrong", 
-                                       api_status="success", 
-                                       logic_status="fail", 
-                                       api_request = request_data,
-                                       api_response = return_response)
 
-        return return_response
+@online_leads_eligibility_api.route("/los/v1/online_leads_eligibility_api/async", methods=['POST'])
+@admission.admitted()
+@step_trace.traced(API_NAME, payload=request_schema.request_payload)
+@request_profiler.profiled(API_NAME)
+@result_cache.stores_result
+async def online_leads_eligibility_async():
+    
+    """
+       @api {POST} /los/v1/online_leads_eligibility_api/async
+       @apiName online leads eligibility async
+       @apiGroup los
+       @apiVersion 0.0.1
+       
+       Same params and responses as the single lead API. Once the token is validated, the
+       thresholds and the pincode / sector / sub-sector / Highmark XML lookups run concurrently,
+       each with its own timeout (online_leads.async_lookups), and the checks are decided in
+       the same order.
+       Needs an ASGI server or Flask installed with the async extra (pip install "flask[async]").
+    """
+    
+    api_name = API_NAME
+    request_data = request_schema.request_payload()
+    lead = request_schema.parse(request_data)
+    
+    # the token validation is started here, the other lookups once it passed
+    lookups = async_lookups.RequestLookups(lead, api_name)
     
-    # Fetch Business Pincode from the Pincode Eng API
-    # "Check_Pincode" function in "Loan_Function.py" will return True or False
-    is_pincode = lf.check_pincode(business_pincode, request_data=request_data,api_name=api_name)
+    try:
+        return await _eligibility_with_lookups(lead, api_name, lookups)
     
-    if not is_pincode:
-        return_response = default_api_response_dict(request_status = "success", 
-                                                        request_message = 'successfully completed API call', 
-                                                        online_leads_eligibility_status = "NA", 
-                                                        body_message = f"Non Serviceable Pin-code", 
-                                                        error_response_code = '252')
+    except async_lookups.LookupTimeout as timeout:
+        # a timed out lead is decided again when it is sent again
+        result_cache.skip()
+        step_trace.step("Lookup timed out - %s", timeout)
+        
+        return_response = default_api_response_dict(request_status = "fail", 
+                                                    request_message = f"{timeout.stage} lookup timed out", 
+                                                    online_leads_eligibility_status = "NA", 
+                                                    body_message = "NA", 
+                                                    error_response_code = 'NA')
 
-        avf.add_api_call_hist_data(api_name,
-                                       api_error_label=f"Non Serviceable Pin-code", 
-                                       api_status="success", 
-                                       logic_status="fail", 
-                                       api_request = request_data,
-                                       api_response = return_response)
+        hist_writer.add_api_call_hist_data(api_name,
+                                           api_error_label=f"{timeout.stage} timeout", 
+                                           api_status="fail", 
+                                           logic_status="fail", 
+                                           api_request = request_data,
+                                           api_response = return_response)
 
         return return_response
-
     
-    #====================================================================================
-    # Step-9 Online Leads eligibility CHECK 2 - Sector Validity 
-    #====================================================================================
-    # logs
-    message = f"Step-9 Online Leads eligibility CHECK 2 - Sector Validity"
-    avf.make_log(request_data=request_data, message=message, api_name=api_name)
-
-    business_main_sector = request_data['business_main_sector']
-    business_type = request_data['business_type']
-    
-    # validating sector and the fucntion returns True or False
-    is_sector = lf.validate_sector(business_main_sector, business_type)
-    
-    if not is_sector:
-        return_response = default_api_response_dict(request_status = "success", 
-                                                        request_message = 'successfully completed API call', 
-                                                        online_leads_eligibility_status = "fail", 
-                                                        body_message = f"Excluded Sector", 
-                                                        error_response_code = '253')
-        avf.add_api_call_hist_data(api_name,
-                                       api_error_label=f"Excluded Sector", 
-                                       api_status="success", 
-                                       logic_status="fail", 
-                                       api_request = request_data,
-                                       api_response = return_response)
-        return return_response    
-
+    finally:
+        lookups.close()
 
 
+async def _eligibility_with_lookups(lead, api_name, lookups):
+    '''Steps of the single lead API on top of the concurrent lookups of the request.'''
+    
+    request_data = lead.data
+    
     #====================================================================================
-    # Step-10 Online Leads eligibility CHECK 3 - Sub-Sector Validity 
+    # Step 2 - Token authentication
     #====================================================================================
-    # logs
-    message = f"Step-10 Online Leads eligibility CHECK 3 - Sub-Sector Validity"
-    avf.make_log(request_data=request_data, message=message, api_name=api_name)
-
-    business_main_sector = request_data['business_main_sector']
-    business_specific_sector = request_data['business_specific_sector']
-    business_type = request_data['business_type']
+    token_valid_flag = await lookups.token()
     
-    # validating sub-sector it return True or False
-    is_subsector = lf.validate_subsector(business_main_sector, business_type, business_specific_sector)
-
-    if is_subsector:
-        return_response = default_api_response_dict(request_status = "success", 
-                                                        request_message = 'successfully completed API call', 
-                                                        online_leads_eligibility_status = "fail", 
-                                                        body_message = f"Excluded Sub-Sector", 
-                                                        error_response_code = '254')
-
-        avf.add_api_call_hist_data(api_name,
-                                       api_error_label=f"Excluded Sub-Sector", 
-                                       api_status="success", 
-                                       logic_status="fail", 
-                                       api_request = request_data,
-                                       api_response = return_response)
-
-        return return_response 
-    
-    #===========================================================================================================
-    # Step-11 Online Leads eligibility CHECK 4 - Vintage Check for the given business with "business_type"
-    #===========================================================================================================
     # logs
-    message = f"Step-11 Online Leads eligibility CHECK 4 - Vintage Check for the given business"
-    avf.make_log(request_data=request_data, message=message, api_name=api_name)
-
-    business_type = (request_data['business_type']).lower()
-    vintage_months = int(request_data['vintage_months'])
+    step_trace.step("Token authentication")
+    
+    if token_valid_flag['status'] == "fail":
+        return template_response(response_templates.token_failure(token_valid_flag['error']), request_data, api_name)
     
-    if ((business_type == "manufacturing") & (vintage_months < min_vintage)) | ((business_type in ['trading', 'services']) & (vintage_months < max_vintage)):
-        return_response = default_api_response_dict(request_status = "success", 
-                                                        request_message = 'successfully completed API call', 
-                                                        online_leads_eligibility_status = "fail", 
-                                                        body_message = f"Low vintage", 
-                                                        error_response_code = '255')
-
-        avf.add_api_call_hist_data(api_name,
-                                       api_error_label=f"Low vintage", 
-                                       api_status="success", 
-                                       logic_status="fail", 
-                                       api_request = request_data,
-                                       api_response = return_response)
-
-        return return_response 
-
-
-
     #====================================================================================
-    # Step-12 Online Leads eligibility CHECK 5 - Annual Business Turnover check
+    # Step 3 - Mandatory params, then duplicate leads, dev_bypass and param values
     #====================================================================================
-    # logs
-    message = f"Step-12 Online Leads eligibility CHECK 5 - Annual Business Turnover check"
-    avf.make_log(request_data=request_data, message=message, api_name=api_name)
-
-    average_annual_turnover = int(request_data['average_annual_turnover'])
-    
-    # annual turnover amount validation here it should be
-    # >6L and <18Cr.
-    if ((average_annual_turnover < min_turnover) | (average_annual_turnover > max_turnover)):
-        return_response = default_api_response_dict(request_status = "success", 
-                                                        request_message = 'successfully completed API call', 
-                                                        online_leads_eligibility_status = "fail", 
-                                                        body_message = f"Low Annual Business Turnover", 
-                                                        error_response_code = '256')
-
-        avf.add_api_call_hist_data(api_name,
-                                       api_error_label=f"Low Annual Business Turnover", 
-                                       api_status="success", 
-                                       logic_status="fail", 
-                                       api_request = request_data,
-                                       api_response = return_response)
-
-        return return_response 
-
+    step_trace.step("Check all mandatory params in request data")
+    
+    if lead.missing_params:
+        return template_response(response_templates.TEMPLATES['missing_params'], request_data, api_name)
+    
+    thresholds = await lookups.thresholds()
+    
+    request_key, stored_response = result_cache.lookup(request_data, api_name, thresholds.version)
+    
+    if stored_response is not None:
+        step_trace.step("Duplicate lead - stored response returned")
+        result_cache.record_duplicate(api_name, request_key, stored_response)
+        return stored_response.response()
+    
+    step_trace.step("If dev_bypass is True, return success")
+    
+    if lead.dev_bypass:
+        return template_response(response_templates.TEMPLATES['dev_bypass'], request_data, api_name)
+    
+    step_trace.step("Check data type and non negative values of all numeric parameters")
+    
+    if lead.invalid_param is not None:
+        return template_response(response_templates.TEMPLATES[lead.invalid_param], request_data, api_name)
+    
+    step_trace.step('Thresholds required for this api --> %s', thresholds)
     
     #====================================================================================
-    # Step-13 Online Leads eligibility CHECK 6 - requested loan amount validation 
+    # Step-8 to Step-16 Online Leads eligibility CHECK 1 to CHECK 9, in precedence order
     #====================================================================================
-    # logs
-    message = f"Step-13 Online Leads eligibility CHECK 6 - requested loan amount validation"
-    avf.make_log(request_data=request_data, message=message, api_name=api_name)
-
-    required_loan_amount = int(request_data['required_loan_amount'])
-    
-    # requested loan amount validation here it should be
-    # >50K and <30L.
-    if ((required_loan_amount < min_loan_amount) | (required_loan_amount > max_loan_amount)):
-        return_response = default_api_response_dict(request_status = "success", 
-                                                        request_message = 'successfully completed API call', 
-                                                        online_leads_eligibility_status = "fail", 
-                                                        body_message = f"Loan Amount not in Range", 
-                                                        error_response_code = '257')
-
-        avf.add_api_call_hist_data(api_name,
-                                       api_error_label=f"Loan Amount not in Range", 
-                                       api_status="success", 
-                                       logic_status="fail", 
-                                       api_request = request_data,
-                                       api_response = return_response)
-        return return_response 
-
+    lookups.start_rules(thresholds)
+    failed_rule = await lookups.run_rules(thresholds)
+    
+    step_trace.step("All checks are completed")
+    
+    if failed_rule is not None:
+        return template_response(response_templates.for_outcome(failed_rule.outcome), request_data, api_name)
+    
+    return template_response(response_templates.TEMPLATES['success'], request_data, api_name)
 
-    #====================================================================================
-    # Step-14 Online Leads eligibility CHECK 7 - Highmark Score Check
-    #====================================================================================
-    # logs
-    message = f"Step-14 Online Leads eligibility CHECK 7 - Highmark Score Check"
-    avf.make_log(request_data=request_data, message=message, api_name=api_name)
 
-    app_highmark_score_A8 = int(request_data['app_highmark_score_A8'])
+@online_leads_eligibility_api.route("/los/v1/online_leads_eligibility_api/batch", methods=['POST'])
+@admission.admitted(cost=admission.lead_count)
+@step_trace.traced(API_NAME, payload=lambda: request.get_json(silent=True))
+@request_profiler.profiled(API_NAME)
+def online_leads_eligibility_batch():
     
-    if ((app_highmark_score_A8 < max_crif_score) & (app_highmark_score_A8 > min_crif_score)):
-        return_response = default_api_response_dict(request_status = "success", 
-                                                        request_message = 'successfully completed API call', 
-                                                        online_leads_eligibility_status = "fail", 
-                                                        body_message = f"Highmark Score is not as per the loan policy", 
-                                                        error_response_code = '258')
-
-        avf.add_api_call_hist_data(api_name,
-                                       api_error_label=f"Highmark Score is not as per the loan policy", 
-                                       api_status="success", 
-                                       logic_status="fail", 
-                                       api_request = request_data,
-                                       api_response = return_response)
-        return return_response     
+    """
+       @api {POST} /los/v1/online_leads_eligibility_api/batch
+       @apiName online leads eligibility batch
+       @apiGroup los
+       @apiVersion 0.0.1
+       
+       JSON body {"leads": [{...}, ...], <token params>} or a plain JSON array of leads
+       with the token params sent in the request headers.
+       Each lead carries the same params as the single lead API.
+    """
+    
+    # pandas is only needed by the batch checks, it is loaded on the first batch call (or by warm_up)
+    from online_leads import vectorized_rules as vr
+    
+    # same api_name as the single lead API, so the same token access applies
+    api_name = API_NAME
     
-
     #====================================================================================
-    # Step-15 Online Leads eligibility CHECK 8 - Loan Purpose
+    # Step 1 - Read the batch of leads from the JSON body
     #====================================================================================
-    # logs
-    message = f"Step-15 Online Leads eligibility CHECK 8 - Loan Purpose"
-    avf.make_log(request_data=request_data, message=message, api_name=api_name)
+    request_body = request.get_json(silent=True)
     
-    loan_purpose = "missing"
+    if isinstance(request_body, dict):
+        leads = request_body.get('leads')
+        request_data = {key: value for key, value in request_body.items() if key != 'leads'}
+    else:
+        leads = request_body
+        request_data = request.headers
     
-    if 'loan_purpose' in list(request_data.keys()):
-        loan_purpose = str(request_data['loan_purpose'])
-        
-    loan_purpose = loan_purpose.lower()
-    loan_purpose = loan_purpose.replace(" ", "_")
+    if not isinstance(leads, list) or not all(isinstance(lead, dict) for lead in leads):
+        return_response = default_api_response_dict(request_status = "fail", 
+                                                    request_message = "leads should be sent as a JSON array of objects", 
+                                                    online_leads_eligibility_status = "NA", 
+                                                    body_message = "NA", 
+                                                    error_response_code = 'NA')
+        return return_response
     
-    if ((loan_purpose == "machine_purchase") | (loan_purpose == "asset_purchase")):
-        message = f"Step 15 - Non Serviceable Loan Purpose"
-        avf.make_log(request_data=request_data, message=message,api_name=api_name)
-        
-        return_response = default_api_response_dict(request_status = "success", 
-                                                        request_message = 'successfully completed API call', 
-                                                        online_leads_eligibility_status = "fail", 
-                                                        body_message = f"Non Serviceable Loan Purpose", 
-                                                        error_response_code = '251')
-
-        avf.add_api_call_hist_data(api_name,
-                                       api_error_label=f"Non Serviceable Loan Purpose", 
-                                       api_status="success", 
-                                       logic_status="fail", 
-                                       api_request = request_data,
-                                       api_response = return_response)
-        return return_response     
-        
+    if len(leads) > vr.MAX_BATCH_SIZE:
+        return_response = default_api_response_dict(request_status = "fail", 
+                                                    request_message = f"maximum {vr.MAX_BATCH_SIZE} leads are allowed in one call", 
+                                                    online_leads_eligibility_status = "NA", 
+                                                    body_message = "NA", 
+                                                    error_response_code = 'NA')
+        return return_response
     
     #====================================================================================
-    # Step-16 Online Leads eligibility CHECK 9 - Highmark XML Extraction
+    # Step 2 - Token authentication, once for the whole batch
     #====================================================================================
-    # # Get the url of the B2C CRIF report in the XML format   
-    # applicant_highmark_XML = str(request_data['applicant_highmark_XML'])
-    # # sample_url = 'https://kinara-staging.autonom8.com/gcs/asia.a8flowapps.autonom8.com/kinara/assets/86a964f4-7a5e-4369-bb7c-9598996c711b'
+    with metrics.timed('validate_token_and_api_access'):
+        token_valid_flag = token_cache.validate_token_and_api_access(request_data, api_name)
 
-    # # read the XML URL using requests 
-    # b2c_xml = requests.get(applicant_highmark_XML)
+    # logs
+    step_trace.step("Token authentication for a batch of %s leads", len(leads))
 
-    # # convert the content of the URL into soup object using HTML parser
-    # soup= BeautifulSoup(b2c_xml.content,"html.parser")
+    if token_valid_flag['status'] == "fail":
+        return_response = default_api_response_dict(request_status = "fail", 
+                                                    request_message = token_valid_flag['error'], 
+                                                    online_leads_eligibility_status = "NA", 
+                                                    body_message = "NA", 
+                                                    error_response_code = 'NA')
+
+        # the batch params without the leads, only their count; for a plain JSON array the
+        # request data are the headers, which are not stored
+        batch_request = dict(request_data if isinstance(request_body, dict) else {}, leads=len(leads))
 
-    # # get score-value tag from the HTML 
-    # print(soup.find("score-value"))
+        hist_writer.add_api_call_hist_data(api_name,
+                                           api_error_label="token", 
+                                           api_status="success", 
+                                           logic_status="fail", 
+                                           api_request = batch_request,
+                                           api_response = return_response)
 
-    # # get score value in Integer from the Content of the "score-value" tag 
-    # extracted_score = (int(float(soup.find("score-value").contents[0])))
+        return return_response
     
+    #====================================================================================
+    # Step 3 - Thresholds once, then all checks vectorized over the batch
+    #====================================================================================
+    with metrics.timed('thresholds'):
+        thresholds = threshold_cache.get_thresholds(api_name)
     
+    with metrics.timed('batch_eligibility_rules'):
+        outcome_keys = vr.evaluate_leads(leads, thresholds, api_name)
     
+    # logs
+    step_trace.step("Batch eligibility checks completed for %s leads", len(leads))
     
     #====================================================================================
-    # Step-16 All checks are completed - Success response - customer eligible
+    # Step 4 - Per lead responses and history
     #====================================================================================
+    lead_responses = []
+    
+    for lead, outcome_key in zip(leads, outcome_keys):
+        template = response_templates.TEMPLATES[outcome_key]
+        lead_response = template.payload
+        
+        hist_writer.add_api_call_hist_data(api_name,
+                                           api_error_label=template.outcome.api_error_label, 
+                                           api_status="success", 
+                                           logic_status=template.outcome.logic_status, 
+                                           api_request = lead,
+                                           api_response = lead_response)
+        
+        lead_responses.append(dict(lead_response, application_id=lead.get('application_id', 'NA')))
+    
+    return_response = {
+                        'request_status': "success",
+                        'request_message': "successfully completed API call",
+                        'body': {
+                                    'leads': lead_responses
+                                }
+                      }
+    
+    return return_response
 
-    # logs
-    message = f"All checks are completed - Success response"
-    avf.make_log(request_data=request_data, message=message, api_name=api_name)
-
-    return_response = default_api_response_dict(request_status = "success", 
-                                                request_message = "successfully completed API call", 
-                                                online_leads_eligibility_status = "success", 
-                                                body_message = "online leads eligibility process completed successfully", 
-                                                error_response_code = 'NA')
-
-    avf.add_api_call_hist_data(api_name,
-                               api_error_label=f"NA",
-                               api_status="success",
-                               logic_status="success",
-                               api_request = request_data,
-                               api_response = return_response)
 
-    return return_response
+@online_leads_metrics_api.route("/metrics", methods=['GET'])
+def online_leads_metrics():
+    
+    """
+       @api {GET} /metrics
+       @apiName online leads eligibility metrics
+       @apiGroup los
+       @apiVersion 0.0.1
+       
+       Stage latency histograms and response counters of all workers in Prometheus text format.
+    """
+    
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 
 #====================================================================================
 # All the Functions used
 #====================================================================================
+def warm_up(batch=warmup.WARM_UP_BATCH):
+    '''Function loads the thresholds, reference data and background writers of the worker
+    before it accepts traffic, call it from the gunicorn post_worker_init hook:
+
+        def post_worker_init(worker):
+            blueprint_module.warm_up()
+
+    batch also loads the batch checks (pandas). Returns the seconds taken per step.'''
+
+    return warmup.warm_up(API_NAME, batch=batch)
+
+
+def template_response(template, request_data, api_name):
+    '''Function records the outcome of a response template in the history and returns
+    the pre-encoded response, see online_leads.response_templates'''
+
+    outcome = template.outcome
+
+    hist_writer.add_api_call_hist_data(api_name,
+                                       api_error_label=outcome.api_error_label, 
+                                       api_status="success", 
+                                       logic_status=outcome.logic_status, 
+                                       api_request = request_data,
+                                       api_response = template.payload)
+
+    return template.response()
+
+
 def default_api_response_dict(request_status, 
                               request_message, 
                               online_leads_eligibility_status, 
@@ -553,14 +461,11 @@ def default_api_response_dict(request_status,
     '''Function returns a dictionary with api output parameters.
     Function is called whenever the api response dict is to be sent'''
 
-    api_response_dict = {
-                            'request_status': request_status,
-                            'request_message': request_message,
-                            'body': {
-                                        'online_leads_eligibility_status': online_leads_eligibility_status, 
-                                        'body_message': body_message,
-                                        'error_response_code': error_response_code
-                                    }
-                        }
+    # same payload as the pre-encoded response templates
+    api_response_dict = response_templates.response_dict(request_status, 
+                                                         request_message, 
+                                                         online_leads_eligibility_status, 
+                                                         body_message, 
+                                                         error_response_code)
     
     return api_response_dict
@@ -0,0 +1,7 @@
+"""
+Load-test and benchmark harness for the online leads eligibility blueprint.
+
+Run from the "Online Leads Eligibility API in Flask" folder:
+    python -m benchmarks.run_benchmark --requests 5000 --output bench.json
+
+"""
@@ -0,0 +1,345 @@
+"""
+Local stand-ins for utilities.api_validation_function (avf) and los.los_function (lf).
+
+install() registers fake modules under the real module names, so the blueprint and the
+online_leads helpers import them instead of the real backends. Every call sleeps for the
+configured latency to mimic the database and the Pincode Eng API.
+
+"""
+
+import json
+import random
+import sqlite3
+import sys
+import threading
+import time
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+VALID_TOKEN = 'bench-token'
+
+DEFAULT_THRESHOLDS = {'MIN_VINTAGE': 12,
+                      'MAX_VINTAGE': 24,
+                      'MIN_TURNOVER': 600000,
+                      'MAX_TURNOVER': 180000000,
+                      'MIN_LOAN_AMOUNT': 50000,
+                      'MAX_LOAN_AMOUNT': 3000000,
+                      'MIN_CRIF_SCORE': 300,
+                      'MAX_CRIF_SCORE': 650}
+
+SERVICEABLE_PINCODE_PREFIXES = ('56', '40', '11')
+EXCLUDED_SECTORS = {('gambling', 'trading')}
+EXCLUDED_SUBSECTORS = {('retail', 'trading', 'liquor')}
+
+
+class Latency(object):
+    '''Milliseconds slept by each fake backend call.'''
+
+    def __init__(self, token_ms=1.0, thresholds_ms=5.0, pincode_ms=20.0, sector_ms=2.0,
+                 hist_ms=5.0, log_ms=0.0):
+        self.token_ms = token_ms
+        self.thresholds_ms = thresholds_ms
+        self.pincode_ms = pincode_ms
+        self.sector_ms = sector_ms
+        self.hist_ms = hist_ms
+        self.log_ms = log_ms
+
+    def as_dict(self):
+        return dict(vars(self))
+
+
+def _sleep(milliseconds):
+    if milliseconds > 0:
+        time.sleep(milliseconds / 1000.0)
+
+
+class FakeDatabase(object):
+    '''In-memory "los_thresholds" table and api call history table.'''
+
+    def __init__(self, thresholds=None):
+        self.thresholds = dict(thresholds or DEFAULT_THRESHOLDS)
+        self.history = []
+        self.logs = 0
+        self._lock = threading.Lock()
+
+    def thresholds_frame(self):
+        # imported here so the startup benchmark measures what the blueprint itself imports
+        import pandas as pd
+
+        return pd.DataFrame({'var_key': list(self.thresholds),
+                             'var_value': [str(value) for value in self.thresholds.values()]})
+
+    def add_history(self, row):
+        with self._lock:
+            self.history.append(row)
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS los_thresholds (api_name TEXT, var_key TEXT, var_value TEXT);
+CREATE TABLE IF NOT EXISTS api_call_hist (api_name TEXT, api_error_label TEXT, api_status TEXT,
+                                          logic_status TEXT, api_request TEXT, api_response TEXT,
+                                          created_at TEXT DEFAULT CURRENT_TIMESTAMP);
+"""
+
+
+def create_sqlite_database(path, api_name, thresholds=None):
+    '''SQLite stand-in of the "los_thresholds" and api call history tables for db_pool, used with
+    LOS_DB_DRIVER=sqlite3 LOS_DB_DSN=path LOS_DB_THRESHOLDS_TABLE=los_thresholds LOS_DB_HIST_TABLE=api_call_hist.'''
+
+    with sqlite3.connect(path) as conn:
+        conn.executescript(SQLITE_SCHEMA)
+        conn.execute('DELETE FROM los_thresholds WHERE api_name = ?', (api_name,))
+        conn.executemany('INSERT INTO los_thresholds VALUES (?, ?, ?)',
+                         [(api_name, key, str(value)) for key, value in (thresholds or DEFAULT_THRESHOLDS).items()])
+    conn.close()
+    return {'LOS_DB_DRIVER': 'sqlite3',
+            'LOS_DB_DSN': path,
+            'LOS_DB_THRESHOLDS_TABLE': 'los_thresholds',
+            'LOS_DB_HIST_TABLE': 'api_call_hist'}
+
+
+def sqlite_history_rows(path):
+    with sqlite3.connect(path) as conn:
+        count = conn.execute('SELECT COUNT(*) FROM api_call_hist').fetchone()[0]
+    conn.close()
+    return count
+
+
+class PincodeStub(object):
+    '''Pincode Eng API stand-in, serviceable when the pincode starts with a known prefix.'''
+
+    def __init__(self, prefixes=SERVICEABLE_PINCODE_PREFIXES):
+        self.prefixes = tuple(prefixes)
+        self.calls = 0
+
+    def is_serviceable(self, pincode):
+        self.calls += 1
+        return str(pincode).startswith(self.prefixes)
+
+
+class PincodeApiServer(object):
+    '''HTTP stand-in of the Pincode Eng API, GET /pincode/<pincode> answers {"serviceable": bool}.
+
+    latency_ms, slow_rate / slow_ms and error_rate can be changed while the server runs:
+    a share slow_rate of the calls sleeps slow_ms instead of latency_ms, and a share
+    error_rate of the calls fails with HTTP 503.'''
+
+    def __init__(self, pincode_stub=None, latency_ms=0.0, slow_rate=0.0, slow_ms=0.0, error_rate=0.0,
+                 seed=0, host='127.0.0.1', port=0):
+        self.pincode_stub = pincode_stub or PincodeStub()
+        self.latency_ms = latency_ms
+        self.slow_rate = slow_rate
+        self.slow_ms = slow_ms
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0
+        self._random = random.Random(seed)
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                stub.requests += 1
+                slow = stub._random.random() < stub.slow_rate
+                failed = stub._random.random() < stub.error_rate
+                _sleep(stub.slow_ms if slow else stub.latency_ms)
+
+                if failed:
+                    stub.errors += 1
+                    status, body = 503, b'{"error": "injected failure"}'
+                else:
+                    pincode = self.path.rstrip('/').rsplit('/', 1)[-1]
+                    status, body = 200, json.dumps({'serviceable': stub.pincode_stub.is_serviceable(pincode)}).encode()
+
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                try:
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    # the client gave up at its deadline
+                    pass
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread = threading.Thread(target=self.server.serve_forever, name='pincode-api-stub', daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def highmark_report_xml(score, padding_bytes=0):
+    '''Returns a B2C report with the score-value tag after padding_bytes of other sections.'''
+
+    padding = b'<INQUIRY-HISTORY>' + b'<INQUIRY>x</INQUIRY>' * (padding_bytes // 20) + b'</INQUIRY-HISTORY>'
+    return (b'<?xml version="1.0" encoding="UTF-8"?><B2C-REPORT><HEADER><REPORT-ID>1</REPORT-ID></HEADER>' +
+            padding +
+            b'<SCORES><SCORE><SCORE-TYPE>PERFORM CONSUMER 2.0</SCORE-TYPE>'
+            b'<SCORE-VALUE>' + str(score).encode('ascii') + b'</SCORE-VALUE></SCORE></SCORES>' +
+            padding +
+            b'</B2C-REPORT>')
+
+
+class HighmarkReportServer(object):
+    '''HTTP stand-in of the report storage, serves /<score>?padding=<bytes> as a B2C report
+    after latency_ms. Records the number of requests and of bytes sent.'''
+
+    def __init__(self, latency_ms=0.0, host='127.0.0.1', port=0):
+        self.latency_ms = latency_ms
+        self.requests = 0
+        self.bytes_sent = 0
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                stub.requests += 1
+                _sleep(stub.latency_ms)
+                path, _, query = self.path.partition('?')
+                padding_bytes = int(query.partition('padding=')[2] or 0)
+                report = highmark_report_xml(path.strip('/'), padding_bytes=padding_bytes)
+
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/xml')
+                self.send_header('Content-Length', str(len(report)))
+                self.end_headers()
+                try:
+                    for start in range(0, len(report), 65536):
+                        self.wfile.write(report[start:start + 65536])
+                        stub.bytes_sent += len(report[start:start + 65536])
+                except (BrokenPipeError, ConnectionResetError):
+                    # the client stopped reading after the score
+                    pass
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread = threading.Thread(target=self.server.serve_forever, name='highmark-report-stub', daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def report_url(self, score, padding_bytes=0):
+        return f'{self.url}/{score}?padding={padding_bytes}'
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def build_avf(database, latency):
+    avf = types.ModuleType('utilities.api_validation_function')
+
+    def validate_token_and_api_access(request_data, api_name):
+        _sleep(latency.token_ms)
+        if request_data.get('token') == VALID_TOKEN:
+            return {'status': 'success'}
+        return {'status': 'fail', 'error': 'invalid token'}
+
+    def make_log(request_data=None, message=None, api_name=None):
+        _sleep(latency.log_ms)
+        database.logs += 1
+
+    def check_required_parameter(request_data, param_lst):
+        return all(param in request_data for param in param_lst)
+
+    def add_api_call_hist_data(api_name, api_error_label, api_status, logic_status, api_request, api_response):
+        _sleep(latency.hist_ms)
+        database.add_history({'api_name': api_name,
+                              'api_error_label': api_error_label,
+                              'api_status': api_status,
+                              'logic_status': logic_status,
+                              'api_request': dict(api_request),
+                              'api_response': api_response})
+
+    avf.validate_token_and_api_access = validate_token_and_api_access
+    avf.make_log = make_log
+    avf.check_required_parameter = check_required_parameter
+    avf.add_api_call_hist_data = add_api_call_hist_data
+    return avf
+
+
+def build_lf(database, pincode_stub, latency, pincode_api_url=None):
+    lf = types.ModuleType('los.los_function')
+    session = None
+
+    if pincode_api_url:
+        import requests
+        session = requests.Session()
+
+    def get_env_variables(api_name):
+        _sleep(latency.thresholds_ms)
+        return database.thresholds_frame()
+
+    def check_pincode(business_pincode, request_data=None, api_name=None):
+        if session is not None:
+            # like the real client: no timeout of its own
+            response = session.get(f'{pincode_api_url}/pincode/{business_pincode}')
+            response.raise_for_status()
+            return response.json()['serviceable']
+        _sleep(latency.pincode_ms)
+        return pincode_stub.is_serviceable(business_pincode)
+
+    def validate_sector(business_main_sector, business_type):
+        _sleep(latency.sector_ms)
+        return (business_main_sector.lower(), business_type.lower()) not in EXCLUDED_SECTORS
+
+    def validate_subsector(business_main_sector, business_type, business_specific_sector):
+        _sleep(latency.sector_ms)
+        key = (business_main_sector.lower(), business_type.lower(), business_specific_sector.lower())
+        return key in EXCLUDED_SUBSECTORS
+
+    lf.get_env_variables = get_env_variables
+    lf.check_pincode = check_pincode
+    lf.validate_sector = validate_sector
+    lf.validate_subsector = validate_subsector
+    return lf
+
+
+def install(latency=None, database=None, pincode_stub=None, pincode_api_url=None):
+    '''Registers the fake avf and lf modules in sys.modules.
+    With pincode_api_url, lf.check_pincode calls that PincodeApiServer over HTTP.
+    Returns (database, pincode_stub) to inspect what the blueprint wrote and called.'''
+
+    latency = latency or Latency()
+    database = database or FakeDatabase()
+    pincode_stub = pincode_stub or PincodeStub()
+
+    utilities = types.ModuleType('utilities')
+    utilities.api_validation_function = build_avf(database, latency)
+    los = types.ModuleType('los')
+    los.los_function = build_lf(database, pincode_stub, latency, pincode_api_url=pincode_api_url)
+
+    sys.modules['utilities'] = utilities
+    sys.modules['utilities.api_validation_function'] = utilities.api_validation_function
+    sys.modules['los'] = los
+    sys.modules['los.los_function'] = los.los_function
+
+    return database, pincode_stub
@@ -0,0 +1,328 @@
+"""
+Throughput and latency benchmark of the online leads eligibility blueprint.
+
+Mounts the blueprint in a test Flask app backed by the fakes in benchmarks.fakes, sends a mix
+of leads hitting every reject path and the success path, and reports requests/s along with
+p50/p95/p99 latency per path. With --sqlite, thresholds and history rows go through the database
+pool (online_leads.db_pool) to a local SQLite file instead of the fakes. Results are saved as JSON
+so they can be compared between commits:
+
+    python -m benchmarks.run_benchmark --requests 5000 --concurrency 8 --output before.json
+    python -m benchmarks.run_benchmark --requests 5000 --concurrency 8 --output after.json --compare before.json
+
+"""
+
+import argparse
+import importlib.util
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+
+from benchmarks import fakes
+
+
+API_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BLUEPRINT_PATH = os.path.join(API_FOLDER, 'Template - Flask API.py')
+API_NAME = 'los/v1/online_leads_eligibility'
+API_URL = '/los/v1/online_leads_eligibility_api'
+BATCH_API_URL = '/los/v1/online_leads_eligibility_api/batch'
+ASYNC_API_URL = '/los/v1/online_leads_eligibility_api/async'
+
+BASE_LEAD = {'application_id': 'APP-0',
+             'business_name': 'Bench Traders',
+             'business_pincode': '560001',
+             'mobile_number': '9999999999',
+             'business_type': 'trading',
+             'business_main_sector': 'retail',
+             'business_specific_sector': 'grocery',
+             'vintage_months': '36',
+             'average_annual_turnover': '2500000',
+             'required_loan_amount': '500000',
+             'preferred_monthly_EMI': '15000',
+             'applicant_name': 'Bench Applicant',
+             'app_highmark_score_A8': '720',
+             'loan_purpose': 'working capital'}
+
+# path name -> (changes to the base lead, expected request_message or error_response_code)
+LEAD_PATHS = {
+    'success': ({}, 'NA'),
+    'token': ({'token': 'wrong-token'}, 'invalid token'),
+    'missing_params': ({'applicant_name': None}, 'all mandatory parameters are not sent'),
+    'dev_bypass': ({'dev_bypass': 'true'}, 'NA'),
+    'numeric': ({'vintage_months': 'abc'}, 'Parameter vintage_months should be numeric'),
+    'negative': ({'required_loan_amount': '-10'}, 'Parameter required_loan_amount should not be negative'),
+    'pincode_wrong': ({'business_pincode': '5600011'}, 'NA'),
+    '252_pincode': ({'business_pincode': '700001'}, '252'),
+    '253_sector': ({'business_main_sector': 'gambling'}, '253'),
+    '254_subsector': ({'business_specific_sector': 'liquor'}, '254'),
+    '255_vintage': ({'vintage_months': '6'}, '255'),
+    '256_turnover': ({'average_annual_turnover': '1000'}, '256'),
+    '257_loan_amount': ({'required_loan_amount': '1000'}, '257'),
+    '258_highmark_score': ({'app_highmark_score_A8': '500'}, '258'),
+    '251_loan_purpose': ({'loan_purpose': 'Machine Purchase'}, '251'),
+}
+
+
+def load_blueprint_module():
+    '''Imports the blueprint module from its file, the file name is not a valid module name.'''
+
+    if API_FOLDER not in sys.path:
+        sys.path.insert(0, API_FOLDER)
+
+    spec = importlib.util.spec_from_file_location('online_leads_eligibility_blueprint', BLUEPRINT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def create_app(latency=None, pincode_api_url=None):
+    '''Installs the fakes and returns (app, blueprint_module, database, pincode_stub).'''
+
+    from flask import Flask
+
+    database, pincode_stub = fakes.install(latency=latency, pincode_api_url=pincode_api_url)
+    module = load_blueprint_module()
+
+    app = Flask('online_leads_benchmark')
+    app.register_blueprint(module.online_leads_eligibility_api)
+    app.register_blueprint(module.online_leads_metrics_api)
+    return app, module, database, pincode_stub
+
+
+def make_lead(path, seq):
+    '''Returns the form data of a lead hitting the given path.'''
+
+    changes, _ = LEAD_PATHS[path]
+    lead = dict(BASE_LEAD, token=fakes.VALID_TOKEN, application_id=f'APP-{seq}')
+    for key, value in changes.items():
+        if value is None:
+            lead.pop(key, None)
+        else:
+            lead[key] = value
+    return lead
+
+
+def percentile(sorted_values, pct):
+    '''Nearest rank percentile of an already sorted list.'''
+
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, math.ceil(pct / 100.0 * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+
+def _matches(path, response_json):
+    _, expected = LEAD_PATHS[path]
+    body = response_json.get('body') or {}
+    return expected in (response_json.get('request_message'), body.get('error_response_code'))
+
+
+def run(app, paths, total_requests, concurrency, seed=0, api_url=API_URL):
+    '''Sends total_requests leads spread over concurrency threads.
+    Returns {path: [latency seconds, ...]}, the number of unexpected responses and the wall time.'''
+
+    rng = random.Random(seed)
+    plan = [(seq, rng.choice(paths)) for seq in range(total_requests)]
+    chunks = [plan[idx::concurrency] for idx in range(concurrency)]
+
+    latencies = {path: [] for path in paths}
+    unexpected = []
+    lock = threading.Lock()
+
+    def worker(chunk):
+        client = app.test_client()
+        local = {path: [] for path in paths}
+        local_unexpected = 0
+        for seq, path in chunk:
+            lead = make_lead(path, seq)
+            started_at = time.perf_counter()
+            response = client.post(api_url, data=lead)
+            local[path].append(time.perf_counter() - started_at)
+            if not _matches(path, response.get_json()):
+                local_unexpected += 1
+        with lock:
+            for path, values in local.items():
+                latencies[path].extend(values)
+            unexpected.append(local_unexpected)
+
+    # warm up caches and indexes before measuring
+    client = app.test_client()
+    for path in paths:
+        client.post(api_url, data=make_lead(path, -1))
+
+    threads = [threading.Thread(target=worker, args=(chunk,)) for chunk in chunks]
+    started_at = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_seconds = time.perf_counter() - started_at
+
+    return latencies, sum(unexpected), wall_seconds
+
+
+def run_batch(app, paths, batch_size, batches, seed=0):
+    '''Sends batches of leads to the batch route, returns the latency of each call.'''
+
+    rng = random.Random(seed)
+    client = app.test_client()
+    latencies = []
+
+    for batch_idx in range(batches):
+        leads = [make_lead(rng.choice([path for path in paths if path != 'token']), batch_idx * batch_size + idx)
+                 for idx in range(batch_size)]
+        for lead in leads:
+            lead.pop('token', None)
+        started_at = time.perf_counter()
+        client.post(BATCH_API_URL, json={'token': fakes.VALID_TOKEN, 'leads': leads})
+        latencies.append(time.perf_counter() - started_at)
+
+    return latencies
+
+
+def summarize(values):
+    values = sorted(values)
+    return {'count': len(values),
+            'mean_ms': round(1000 * sum(values) / len(values), 3) if values else 0.0,
+            'p50_ms': round(1000 * percentile(values, 50), 3),
+            'p95_ms': round(1000 * percentile(values, 95), 3),
+            'p99_ms': round(1000 * percentile(values, 99), 3)}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=API_FOLDER, stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current, previous):
+    '''Prints the change of throughput and latency percentiles against a previous result.'''
+
+    print(f"\nCompared with {previous.get('commit')}:")
+    old_rps = previous['total']['requests_per_second']
+    new_rps = current['total']['requests_per_second']
+    print(f"  requests/s {old_rps:>10.1f} -> {new_rps:>10.1f} ({_delta(old_rps, new_rps)})")
+
+    for path, stats in current['paths'].items():
+        old = previous['paths'].get(path)
+        if not old:
+            continue
+        print(f"  {path:<20} p50 {_delta(old['p50_ms'], stats['p50_ms']):>8}  "
+              f"p95 {_delta(old['p95_ms'], stats['p95_ms']):>8}  p99 {_delta(old['p99_ms'], stats['p99_ms']):>8}")
+
+
+def _delta(old, new):
+    if not old:
+        return 'n/a'
+    return f'{100.0 * (new - old) / old:+.1f}%'
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=2000, help='number of single lead requests')
+    parser.add_argument('--concurrency', type=int, default=4, help='number of client threads')
+    parser.add_argument('--paths', default=','.join(LEAD_PATHS), help='comma separated lead paths in the mix')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='send the single lead requests to the async route')
+    parser.add_argument('--batch-size', type=int, default=0, help='leads per batch call, 0 skips the batch route')
+    parser.add_argument('--batches', type=int, default=20, help='number of batch calls')
+    parser.add_argument('--token-ms', type=float, default=1.0)
+    parser.add_argument('--thresholds-ms', type=float, default=5.0)
+    parser.add_argument('--pincode-ms', type=float, default=20.0)
+    parser.add_argument('--sector-ms', type=float, default=2.0)
+    parser.add_argument('--hist-ms', type=float, default=5.0)
+    parser.add_argument('--log-ms', type=float, default=0.0)
+    parser.add_argument('--pincode-server', action='store_true',
+                        help='call a local Pincode Eng API stub over HTTP, --pincode-ms is its latency')
+    parser.add_argument('--pincode-error-rate', type=float, default=0.0, help='share of stub calls failing with 503')
+    parser.add_argument('--pincode-slow-rate', type=float, default=0.0, help='share of stub calls taking --pincode-slow-ms')
+    parser.add_argument('--pincode-slow-ms', type=float, default=5000.0)
+    parser.add_argument('--sqlite', metavar='PATH', help='read thresholds and write history through db_pool to this SQLite file')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='previous results JSON file to compare with')
+    args = parser.parse_args(argv)
+
+    paths = [path.strip() for path in args.paths.split(',') if path.strip()]
+    unknown = [path for path in paths if path not in LEAD_PATHS]
+    if unknown:
+        parser.error(f'unknown lead paths {unknown}, choose from {list(LEAD_PATHS)}')
+
+    latency = fakes.Latency(token_ms=args.token_ms, thresholds_ms=args.thresholds_ms, pincode_ms=args.pincode_ms,
+                            sector_ms=args.sector_ms, hist_ms=args.hist_ms, log_ms=args.log_ms)
+    pincode_server = None
+    if args.pincode_server:
+        pincode_server = fakes.PincodeApiServer(latency_ms=args.pincode_ms,
+                                                slow_rate=args.pincode_slow_rate,
+                                                slow_ms=args.pincode_slow_ms,
+                                                error_rate=args.pincode_error_rate,
+                                                seed=args.seed).start()
+
+    if args.sqlite:
+        # db_pool reads its settings at import, which happens in create_app
+        os.environ.update(fakes.create_sqlite_database(args.sqlite, API_NAME))
+
+    app, module, database, pincode_stub = create_app(latency, pincode_api_url=pincode_server.url if pincode_server else None)
+    # importable once create_app installed the fakes
+    from online_leads import pincode_index
+
+    api_url = ASYNC_API_URL if args.use_async else API_URL
+    latencies, unexpected, wall_seconds = run(app, paths, args.requests, args.concurrency, seed=args.seed, api_url=api_url)
+
+    result = {'commit': git_commit(),
+              'config': {'api_url': api_url,
+                         'requests': args.requests,
+                         'concurrency': args.concurrency,
+                         'paths': paths,
+                         'latency': latency.as_dict(),
+                         'sqlite': bool(args.sqlite)},
+              'total': {'requests': args.requests,
+                        'seconds': round(wall_seconds, 3),
+                        'requests_per_second': round(args.requests / wall_seconds, 1) if wall_seconds else 0.0,
+                        'unexpected_responses': unexpected,
+                        'pincode_api_calls': pincode_server.requests if pincode_server else pincode_stub.calls,
+                        'pincode_breaker': pincode_index.get_breaker().stats()},
+              'paths': {path: summarize(values) for path, values in latencies.items() if values}}
+
+    if args.batch_size:
+        batch_latencies = run_batch(app, paths, args.batch_size, args.batches, seed=args.seed)
+        batch_seconds = sum(batch_latencies)
+        result['batch'] = dict(summarize(batch_latencies),
+                               batch_size=args.batch_size,
+                               leads_per_second=round(args.batch_size * len(batch_latencies) / batch_seconds, 1))
+
+    # let the buffered history writer finish before reading the history table
+    module.hist_writer.get_writer().stop()
+    if pincode_server is not None:
+        pincode_server.stop()
+    result['total']['history_rows'] = fakes.sqlite_history_rows(args.sqlite) if args.sqlite else len(database.history)
+
+    print(f"{result['total']['requests_per_second']} requests/s over {args.requests} requests "
+          f"({unexpected} unexpected responses)")
+    print(f"{'path':<20} {'count':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for path, stats in result['paths'].items():
+        print(f"{path:<20} {stats['count']:>7} {stats['p50_ms']:>9} {stats['p95_ms']:>9} {stats['p99_ms']:>9}")
+    if 'batch' in result:
+        print(f"batch of {args.batch_size}: p50 {result['batch']['p50_ms']} ms, "
+              f"{result['batch']['leads_per_second']} leads/s")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output_file:
+            json.dump(result, output_file, indent=2)
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as previous_file:
+            compare(result, json.load(previous_file))
+
+    return result
+
+
+if __name__ == '__main__':
+    main()
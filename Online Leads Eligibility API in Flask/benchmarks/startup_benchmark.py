@@ -0,0 +1,135 @@
+"""
+Startup benchmark of the online leads eligibility blueprint.
+
+Every sample starts a fresh Python process which imports the blueprint backed by the fakes in
+benchmarks.fakes and sends its first requests, as a new gunicorn worker does. It reports, as
+medians over the samples, the import time, the memory after the import, the heavy modules
+loaded, the warm-up time and the latency of the first and second requests, both for a cold
+worker and for one warmed up with warm_up() first:
+
+    python -m benchmarks.startup_benchmark --samples 5 --output before.json
+    python -m benchmarks.startup_benchmark --samples 5 --output after.json --compare before.json
+
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from benchmarks import fakes
+from benchmarks.run_benchmark import API_FOLDER, API_URL, _delta, git_commit, load_blueprint_module, make_lead
+
+
+# modules the blueprint should only import when a code path needs them
+HEAVY_MODULES = ('pandas', 'numpy', 'requests', 'bs4')
+
+MEASURES = ('import_ms', 'rss_after_import_mb', 'warm_up_ms', 'first_request_ms', 'second_request_ms',
+            'rss_after_first_request_mb')
+
+
+def _rss_mb():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+
+
+def measure(warm_up):
+    '''Runs in the sample process: imports the blueprint and sends two requests.'''
+
+    from flask import Flask
+
+    fakes.install()
+
+    started_at = time.perf_counter()
+    module = load_blueprint_module()
+    app = Flask('online_leads_startup_benchmark')
+    app.register_blueprint(module.online_leads_eligibility_api)
+    sample = {'import_ms': 1000 * (time.perf_counter() - started_at),
+              'rss_after_import_mb': _rss_mb(),
+              'heavy_modules_after_import': [name for name in HEAVY_MODULES if name in sys.modules]}
+
+    if warm_up:
+        started_at = time.perf_counter()
+        module.warm_up()
+        sample['warm_up_ms'] = 1000 * (time.perf_counter() - started_at)
+
+    client = app.test_client()
+    for seq, measure_name in enumerate(('first_request_ms', 'second_request_ms')):
+        started_at = time.perf_counter()
+        client.post(API_URL, data=make_lead('success', seq))
+        sample[measure_name] = 1000 * (time.perf_counter() - started_at)
+
+    sample['rss_after_first_request_mb'] = _rss_mb()
+    module.hist_writer.get_writer().stop()
+    return sample
+
+
+def run_sample(warm_up):
+    '''Measures one fresh process, returns its sample.'''
+
+    command = [sys.executable, '-m', 'benchmarks.startup_benchmark', '--child']
+    if warm_up:
+        command.append('--warm-up')
+    output = subprocess.check_output(command, cwd=API_FOLDER, text=True)
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def summarize(samples):
+    summary = {}
+    for name in MEASURES:
+        values = [sample[name] for sample in samples if name in sample]
+        if values:
+            summary[name] = round(statistics.median(values), 3)
+    summary['heavy_modules_after_import'] = samples[0]['heavy_modules_after_import']
+    return summary
+
+
+def compare(current, previous):
+    print(f"\nCompared with {previous.get('commit')}:")
+    for mode, stats in current['modes'].items():
+        old = previous['modes'].get(mode)
+        if not old:
+            continue
+        changes = '  '.join(f"{name} {_delta(old[name], stats[name])}" for name in MEASURES
+                            if name in stats and name in old)
+        print(f"  {mode:<5} {changes}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--samples', type=int, default=5, help='fresh processes measured per mode')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='previous results JSON file to compare with')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--warm-up', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        print(json.dumps(measure(args.warm_up)))
+        return None
+
+    result = {'commit': git_commit(),
+              'config': {'samples': args.samples},
+              'modes': {mode: summarize([run_sample(mode == 'warm') for _ in range(args.samples)])
+                        for mode in ('cold', 'warm')}}
+
+    for mode, stats in result['modes'].items():
+        print(f"{mode}: " + ', '.join(f'{name} {stats[name]}' for name in MEASURES if name in stats))
+        print(f"      heavy modules after import: {stats['heavy_modules_after_import'] or 'none'}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output_file:
+            json.dump(result, output_file, indent=2)
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as previous_file:
+            compare(result, json.load(previous_file))
+
+    return result
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,4 @@
+"""
+Helper modules used by the Online Leads Eligibility API blueprint.
+
+"""
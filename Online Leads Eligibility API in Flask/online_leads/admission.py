@@ -0,0 +1,375 @@
+"""
+Admission control shared by the gunicorn workers of the online leads eligibility API.
+
+Two limits are checked before a request does any work, and a request over either of them is
+shed at once with a Retry-After header instead of queueing on the database and the pincode
+calls until it times out:
+
+- a token bucket per client address (LOS_ADMISSION_TOKEN_RATE leads/s, bursts of
+  LOS_ADMISSION_TOKEN_BURST), answered with 429. A batch is charged one per lead. The API
+  token is not validated yet at this point, so it is not used as the key: a client could
+  send a new made-up token with every request. The buckets live in a memory mapped file
+  shared by the workers, each bucket slot is guarded by an fcntl record lock. A slot whose
+  bucket refilled is free for another client.
+- a global concurrency limit (LOS_ADMISSION_MAX_CONCURRENCY requests in flight over all the
+  workers), answered with 503. Each slot is a lock file held with flock while the request
+  runs; the kernel frees the slots of a worker which dies.
+
+Both are off (0) by default. Admitted and shed requests are counted per reason, along with
+the requests in flight, to size the capacity.
+
+"""
+
+import fcntl
+import functools
+import hashlib
+import inspect
+import math
+import mmap
+import os
+import random
+import struct
+import tempfile
+import threading
+import time
+
+from flask import request
+
+from online_leads import metrics
+from online_leads import response_templates
+
+
+# leads per second allowed for one client, 0 for no limit
+ADMISSION_TOKEN_RATE = float(os.environ.get('LOS_ADMISSION_TOKEN_RATE', 0))
+
+# leads one client may send at once above its rate
+ADMISSION_TOKEN_BURST = float(os.environ.get('LOS_ADMISSION_TOKEN_BURST', max(1.0, 2 * ADMISSION_TOKEN_RATE)))
+
+# requests in flight over all the workers of the host, 0 for no limit
+ADMISSION_MAX_CONCURRENCY = int(os.environ.get('LOS_ADMISSION_MAX_CONCURRENCY', 0))
+
+# Retry-After sent when the concurrency limit is reached
+ADMISSION_RETRY_AFTER_SECONDS = int(os.environ.get('LOS_ADMISSION_RETRY_AFTER_SECONDS', 1))
+
+# directory of the shared state, the same for every worker of the host
+ADMISSION_DIR = os.environ.get('LOS_ADMISSION_DIR', os.path.join(tempfile.gettempdir(), 'online_leads_admission'))
+
+# header holding the client address set by the trusted proxy in front of the workers, e.g.
+# X-Forwarded-For (its first address is used); the address of the connection when not set
+ADMISSION_CLIENT_HEADER = os.environ.get('LOS_ADMISSION_CLIENT_HEADER')
+
+# token bucket slots in the shared file, clients hashing to a full probe sequence share the
+# bucket of the last probe
+ADMISSION_BUCKET_SLOTS = int(os.environ.get('LOS_ADMISSION_BUCKET_SLOTS', 4096))
+ADMISSION_BUCKET_PROBES = 8
+
+metrics.METRIC_HELP.update({
+    'online_leads_admission_total': 'Requests by admission result: admitted, shed_rate (429) or shed_concurrency (503).',
+    'online_leads_admission_in_flight': 'Admitted requests in flight, summed over the workers.',
+})
+
+# client hash, tokens left (negative after a batch larger than the burst), monotonic time of the last update
+_BUCKET = struct.Struct('<Qdd')
+
+
+class Shed(Exception):
+    '''The request is over a limit; status and retry_after_seconds of the response.'''
+
+    def __init__(self, reason, status, retry_after_seconds):
+        super().__init__(f'{reason}, retry after {retry_after_seconds} seconds')
+        self.reason = reason
+        self.status = status
+        self.retry_after_seconds = retry_after_seconds
+
+
+def _open_state_file(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+
+
+#====================================================================================
+# Token buckets
+#====================================================================================
+class TokenBuckets(object):
+    '''Token buckets keyed by client in a memory mapped file shared by the processes.
+
+    A bucket is found by hashing the client and probing up to ADMISSION_BUCKET_PROBES slots.
+    A slot is free when it was never used or its bucket refilled to the burst, since a new
+    bucket starts full anyway. When every probed slot holds a live bucket of other clients,
+    the client shares the bucket of the last probe; a bucket is never reset for another key.
+    Threads of a process are kept apart by a lock per slot stripe, processes by an fcntl
+    record lock on the slot.'''
+
+    def __init__(self, path, rate, burst, slots=ADMISSION_BUCKET_SLOTS):
+        self.rate = rate
+        self.burst = burst
+        self.slots = slots
+
+        self._fd = _open_state_file(path)
+        size = slots * _BUCKET.size
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        self._stripes = [threading.Lock() for _ in range(64)]
+
+    def take(self, client, cost=1.0):
+        '''Takes cost from the bucket of client. Returns 0 when admitted, else the seconds
+        until the bucket holds enough again. A cost above the burst is admitted from a full
+        bucket and leaves it in debt.'''
+
+        key = int.from_bytes(hashlib.blake2b(str(client).encode('utf-8'), digest_size=8).digest(), 'little') or 1
+        start = key % self.slots
+
+        for probe in range(ADMISSION_BUCKET_PROBES):
+            slot = (start + probe) % self.slots
+            last_probe = probe == ADMISSION_BUCKET_PROBES - 1
+            retry_after = self._take_slot(slot, key, cost, last_probe)
+            if retry_after is not None:
+                return retry_after
+
+    def _take_slot(self, slot, key, cost, share):
+        offset = slot * _BUCKET.size
+
+        with self._stripes[slot % len(self._stripes)]:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, _BUCKET.size, offset)
+            try:
+                stored_key, tokens, updated_at = _BUCKET.unpack_from(self._map, offset)
+                now = time.monotonic()
+
+                if now >= updated_at:
+                    tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+                else:
+                    # the clock went back (host restarted), start from a full bucket
+                    tokens = self.burst
+
+                if stored_key != key:
+                    if not stored_key or tokens >= self.burst:
+                        # never used, or refilled: the slot expired and starts a full bucket for key
+                        stored_key, tokens = key, self.burst
+                    elif not share:
+                        return None
+
+                needed = min(cost, self.burst)
+                if tokens >= needed:
+                    _BUCKET.pack_into(self._map, offset, stored_key, tokens - cost, now)
+                    return 0.0
+
+                _BUCKET.pack_into(self._map, offset, stored_key, tokens, now)
+                return (needed - tokens) / self.rate
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, _BUCKET.size, offset)
+
+
+#====================================================================================
+# Concurrency limit
+#====================================================================================
+class ConcurrencyLimiter(object):
+    '''At most max_concurrency slots held at once by the processes sharing state_dir.
+
+    A slot is one lock file held with a non blocking flock. flock does not keep threads of one
+    process apart (they share the file description), so the slots held by the process are
+    also tracked in memory.'''
+
+    def __init__(self, state_dir, max_concurrency):
+        self.state_dir = state_dir
+        self.max_concurrency = max_concurrency
+
+        self._fds = {}
+        self._held = set()
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        '''Returns the slot taken, or None when every slot is held.'''
+
+        self._check_fork()
+        start = random.randrange(self.max_concurrency)
+
+        for offset in range(self.max_concurrency):
+            slot = (start + offset) % self.max_concurrency
+
+            with self._lock:
+                if slot in self._held:
+                    continue
+                self._held.add(slot)
+
+            try:
+                fcntl.flock(self._fd(slot), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                with self._lock:
+                    self._held.discard(slot)
+                continue
+
+            with self._lock:
+                in_flight = len(self._held)
+            metrics.set_gauge('online_leads_admission_in_flight', in_flight)
+            return slot
+
+        return None
+
+    def release(self, slot):
+        fcntl.flock(self._fd(slot), fcntl.LOCK_UN)
+        with self._lock:
+            self._held.discard(slot)
+            in_flight = len(self._held)
+        metrics.set_gauge('online_leads_admission_in_flight', in_flight)
+
+    def _fd(self, slot):
+        fd = self._fds.get(slot)
+        if fd is None:
+            with self._lock:
+                fd = self._fds.get(slot)
+                if fd is None:
+                    fd = self._fds[slot] = _open_state_file(os.path.join(self.state_dir, f'slot_{slot}.lock'))
+        return fd
+
+    def _check_fork(self):
+        # a forked worker shares the file descriptions, and so the locks, of its parent
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid != os.getpid():
+                for fd in self._fds.values():
+                    os.close(fd)
+                self._fds = {}
+                self._held = set()
+                self._pid = os.getpid()
+
+
+#====================================================================================
+# Admission
+#====================================================================================
+class AdmissionController(object):
+    '''Token rate and concurrency limits of the API, either can be disabled with 0.'''
+
+    def __init__(self,
+                 state_dir = ADMISSION_DIR,
+                 token_rate = ADMISSION_TOKEN_RATE,
+                 token_burst = ADMISSION_TOKEN_BURST,
+                 max_concurrency = ADMISSION_MAX_CONCURRENCY,
+                 retry_after_seconds = ADMISSION_RETRY_AFTER_SECONDS):
+
+        self.retry_after_seconds = retry_after_seconds
+        self.buckets = (TokenBuckets(os.path.join(state_dir, 'token_buckets'), token_rate, token_burst)
+                        if token_rate > 0 else None)
+        self.limiter = ConcurrencyLimiter(state_dir, max_concurrency) if max_concurrency > 0 else None
+
+    @property
+    def enabled(self):
+        return self.buckets is not None or self.limiter is not None
+
+    def admit(self, client, cost=1):
+        '''Returns the concurrency slot taken (None when not limited) or raises Shed.'''
+
+        if self.buckets is not None and client is not None:
+            retry_after = self.buckets.take(client, cost)
+            if retry_after:
+                raise Shed('shed_rate', 429, max(1, math.ceil(retry_after)))
+
+        if self.limiter is None:
+            return None
+
+        slot = self.limiter.acquire()
+        if slot is None:
+            raise Shed('shed_concurrency', 503, self.retry_after_seconds)
+        return slot
+
+    def release(self, slot):
+        if slot is not None:
+            self.limiter.release(slot)
+
+
+_controller = None
+_controller_lock = threading.Lock()
+
+
+def get_controller():
+    '''Returns the process wide AdmissionController, created on first use.'''
+
+    global _controller
+
+    if _controller is None:
+        with _controller_lock:
+            if _controller is None:
+                _controller = AdmissionController()
+    return _controller
+
+
+def request_client():
+    '''Address of the client of the running request, None when it is not known.'''
+
+    if ADMISSION_CLIENT_HEADER:
+        forwarded = request.headers.get(ADMISSION_CLIENT_HEADER)
+        if forwarded:
+            return forwarded.split(',', 1)[0].strip()
+    return request.remote_addr
+
+
+def lead_count():
+    '''Leads in the body of a batch request, {"leads": [...]} or a plain array; 1 otherwise.'''
+
+    body = request.get_json(silent=True)
+    leads = body.get('leads') if isinstance(body, dict) else body
+    return max(1, len(leads)) if isinstance(leads, list) else 1
+
+
+def shed_response(shed):
+    if shed.status == 429:
+        response = response_templates.RATE_LIMITED.response()
+    else:
+        response = response_templates.OVERLOADED.response()
+    response.status_code = shed.status
+    response.headers['Retry-After'] = str(shed.retry_after_seconds)
+    return response
+
+
+def admitted(cost=None):
+    '''Decorator for a view (sync or async) applying the admission limits before it runs.
+
+    cost - callable returning what the request takes from the bucket of its client, 1 by
+           default; lead_count for the batch view'''
+
+    def decorator(view):
+
+        def admit():
+            controller = get_controller()
+            if not controller.enabled:
+                return controller, None, None
+
+            try:
+                slot = controller.admit(request_client(), cost() if cost is not None else 1)
+            except Shed as shed:
+                metrics.inc('online_leads_admission_total', result=shed.reason)
+                return controller, None, shed_response(shed)
+
+            metrics.inc('online_leads_admission_total', result='admitted')
+            return controller, slot, None
+
+        if inspect.iscoroutinefunction(view):
+
+            @functools.wraps(view)
+            async def async_wrapper(*args, **kwargs):
+                controller, slot, shed = admit()
+                if shed is not None:
+                    return shed
+                try:
+                    return await view(*args, **kwargs)
+                finally:
+                    controller.release(slot)
+
+            return async_wrapper
+
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            controller, slot, shed = admit()
+            if shed is not None:
+                return shed
+            try:
+                return view(*args, **kwargs)
+            finally:
+                controller.release(slot)
+
+        return wrapper
+
+    return decorator
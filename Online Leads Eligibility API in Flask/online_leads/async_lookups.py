@@ -0,0 +1,173 @@
+"""
+Concurrent lookups for the async variant of the online leads eligibility API.
+
+The I/O eligibility rules (pincode serviceability, sector, sub-sector, Highmark XML) do not
+depend on each other, so RequestLookups starts them together on a shared thread pool and the
+view awaits each result only when its check is reached. They are only started for a lead
+which reaches the eligibility checks: after the token validation, the duplicate lead check of
+the result_cache and the param checks, and not when CHECK 1 already rejects the pincode
+length. Every call has its own timeout. The checks are still decided in precedence order, so
+the response is the same as the one of the sync view, while the latency is about the token
+validation and the thresholds plus the slowest lookup instead of the sum of all of them.
+
+"""
+
+import asyncio
+import contextvars
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from online_leads import eligibility_rules
+from online_leads import metrics
+from online_leads import request_profiler
+from online_leads import step_trace
+from online_leads import threshold_cache
+from online_leads import token_cache
+from online_leads.rule_engine import COST_MEMORY
+
+
+# threads running the blocking lookups, shared by all requests of the process
+ASYNC_LOOKUP_WORKERS = int(os.environ.get('LOS_ASYNC_LOOKUP_WORKERS', 32))
+
+# seconds each lookup may take before the request fails
+ASYNC_LOOKUP_TIMEOUT_SECONDS = float(os.environ.get('LOS_ASYNC_LOOKUP_TIMEOUT_SECONDS', 5))
+
+LOOKUP_TIMEOUT_SECONDS = {
+    'token': float(os.environ.get('LOS_ASYNC_TOKEN_TIMEOUT_SECONDS', 2)),
+    'thresholds': float(os.environ.get('LOS_ASYNC_THRESHOLDS_TIMEOUT_SECONDS', ASYNC_LOOKUP_TIMEOUT_SECONDS)),
+    'pincode': float(os.environ.get('LOS_ASYNC_PINCODE_TIMEOUT_SECONDS', 3)),
+    'sector': float(os.environ.get('LOS_ASYNC_SECTOR_TIMEOUT_SECONDS', 2)),
+    'subsector': float(os.environ.get('LOS_ASYNC_SUBSECTOR_TIMEOUT_SECONDS', 2)),
+    'highmark_xml': float(os.environ.get('LOS_ASYNC_HIGHMARK_XML_TIMEOUT_SECONDS', 12)),
+}
+
+metrics.METRIC_HELP['online_leads_lookup_timeouts_total'] = 'Lookups of the async API which timed out, by stage.'
+
+
+class LookupTimeout(Exception):
+    '''A lookup did not finish within its timeout.'''
+
+    def __init__(self, stage, timeout_seconds):
+        super().__init__(f'{stage} lookup timed out after {timeout_seconds} seconds')
+        self.stage = stage
+        self.timeout_seconds = timeout_seconds
+
+
+#====================================================================================
+# Thread pool
+#====================================================================================
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    '''Returns the process wide lookup thread pool, created on first use.'''
+
+    global _executor
+
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=ASYNC_LOOKUP_WORKERS,
+                                               thread_name_prefix='online-leads-lookup')
+    return _executor
+
+
+def _timed_call(stage, func, args):
+    with metrics.timed(stage):
+        return request_profiler.sampled_call(func, *args)
+
+
+async def call(stage, func, *args):
+    '''Runs a blocking lookup on the thread pool within the timeout of its stage.
+    The lookup sees the context of the request, so its steps go to the request trace and
+    its thread is sampled with a profiled request.'''
+
+    timeout_seconds = LOOKUP_TIMEOUT_SECONDS.get(stage, ASYNC_LOOKUP_TIMEOUT_SECONDS)
+    context = contextvars.copy_context()
+    future = asyncio.get_running_loop().run_in_executor(get_executor(),
+                                                        functools.partial(context.run, _timed_call, stage, func, args))
+    try:
+        return await asyncio.wait_for(future, timeout_seconds)
+    except asyncio.TimeoutError:
+        metrics.inc('online_leads_lookup_timeouts_total', stage=stage)
+        raise LookupTimeout(stage, timeout_seconds)
+
+
+class RequestLookups(object):
+    '''Lookups of one request: the token validation, then the thresholds once the token is
+    valid, then the rule lookups started together by start_rules(), awaited in check order.
+
+    Must be created inside the running event loop of the request; close() cancels
+    the lookups which are no longer needed once the response is decided.'''
+
+    def __init__(self, lead, api_name, engine=eligibility_rules.ENGINE):
+        self.lead = lead
+        self.api_name = api_name
+        self.engine = engine
+        self.tasks = {}
+
+        self._start('token', token_cache.validate_token_and_api_access, lead.data, api_name)
+
+    def _start(self, stage, func, *args):
+        self.tasks[stage] = asyncio.ensure_future(call(stage, func, *args))
+
+    async def token(self):
+        '''Result of the token validation, the thresholds are looked up when it passed.'''
+
+        token_valid_flag = await self.tasks['token']
+        if token_valid_flag['status'] != 'fail' and 'thresholds' not in self.tasks:
+            self._start('thresholds', threshold_cache.get_thresholds, self.api_name)
+        return token_valid_flag
+
+    def start_rules(self, thresholds):
+        '''Starts the lookups of the I/O rules, for a lead past the duplicate and param checks.
+        Nothing is started when an in-memory rule with a lower precedence than every I/O rule
+        rejects the lead (CHECK 1 pincode length), the response does not depend on them then.'''
+
+        rules = self.engine.rules
+        lookup_rules = [rule for rule in rules if rule.cost != COST_MEMORY]
+        if not lookup_rules:
+            return
+
+        first_lookup = min(rule.precedence for rule in lookup_rules)
+        for rule in rules:
+            if rule.precedence < first_lookup and rule.cost == COST_MEMORY \
+                    and rule.check(self.lead, thresholds, self.api_name):
+                return
+
+        for rule in lookup_rules:
+            self._start(rule.name, rule.check, self.lead, thresholds, self.api_name)
+
+    async def thresholds(self):
+        return await asyncio.shield(self.tasks['thresholds'])
+
+    async def run_rules(self, thresholds):
+        '''Returns the failing Rule with the lowest precedence, or None if every rule passes.
+        Lookups are awaited in precedence order; an error or LookupTimeout of a lookup is
+        raised only when no rule with a lower precedence fails.'''
+
+        for rule in self.engine.rules:
+            step_trace.step(rule.description)
+
+            task = self.tasks.get(rule.name)
+            if task is not None:
+                rejected = await task
+            else:
+                rejected = rule.check(self.lead, thresholds, self.api_name)
+
+            if rejected:
+                return rule
+
+        return None
+
+    def close(self):
+        '''Cancels the lookups still running and consumes the errors of the finished ones.'''
+
+        for task in self.tasks.values():
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                task.exception()
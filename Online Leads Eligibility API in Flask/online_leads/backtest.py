@@ -0,0 +1,391 @@
+"""
+What-if backtest of threshold changes over the recorded lead traffic.
+
+load_history() reads the leads recorded by add_api_call_hist_data, either from a history
+export (CSV or Parquet with the request JSON in the api_request column) or from an export
+already flattened into one column per param. Backtest screens the leads once through the
+checks which do not depend on the thresholds (params, CHECK 1 to CHECK 3) and keeps typed
+columns of the leads reaching CHECK 4, so each set of thresholds only costs a few vectorized
+comparisons (CHECK 4 to CHECK 9) over those columns. run() evaluates a baseline and any number
+of candidate thresholds and reports the outcome counts of each with their deltas per outcome
+and reject code:
+
+    python -m online_leads.backtest history.parquet --baseline los_thresholds.csv \\
+        --set low_turnover:MIN_TURNOVER=400000 --candidates candidates.json --output report.json
+
+CHECK 9 needs the score read from the Highmark XML report, which is not recorded; it is only
+checked when the export has a highmark_xml_score column, other leads pass it as they do when
+their report cannot be read.
+
+"""
+
+import argparse
+import ast
+import json
+import logging
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from online_leads import vectorized_rules as vr
+from online_leads.eligibility_rules import OUTCOMES
+from online_leads.request_schema import ALL_PARAMS
+from online_leads.threshold_cache import THRESHOLD_KEYS, Thresholds
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+logger = logging.getLogger(__name__)
+
+API_NAME = "los/v1/online_leads_eligibility"
+
+# optional column of an export with the score extracted from the Highmark XML report
+HIGHMARK_XML_SCORE_COLUMN = 'highmark_xml_score'
+
+# history labels of rows whose lead never reached the checks
+SKIPPED_HISTORY_LABELS = ('token',)
+
+# outcome key <-> code used in the outcome arrays
+OUTCOME_KEYS = tuple(OUTCOMES)
+OUTCOME_CODES = {key: code for code, key in enumerate(OUTCOME_KEYS)}
+SUCCESS_CODE = OUTCOME_CODES['success']
+
+_FIELDS = {key: field for key, field in THRESHOLD_KEYS}
+
+
+#====================================================================================
+# History
+#====================================================================================
+def _parse_request(api_request):
+    if isinstance(api_request, dict):
+        return api_request
+    if not isinstance(api_request, (str, bytes)):
+        return {}
+
+    try:
+        request_data = orjson.loads(api_request) if orjson is not None else json.loads(api_request)
+    except ValueError:
+        # rows written with str(dict) instead of JSON
+        try:
+            request_data = ast.literal_eval(api_request if isinstance(api_request, str) else api_request.decode())
+        except (ValueError, SyntaxError):
+            return {}
+
+    return request_data if isinstance(request_data, dict) else {}
+
+
+def history_to_frame(history_df, api_name=API_NAME):
+    '''Returns a frame with one column per param from history rows.
+
+    Rows of another api_name (when the column is there) and rows whose lead never reached the
+    checks are left out. The api_error_label and highmark_xml_score columns are kept when sent.'''
+
+    if 'api_name' in history_df.columns and api_name is not None:
+        history_df = history_df[history_df['api_name'] == api_name]
+    if 'api_error_label' in history_df.columns:
+        history_df = history_df[~history_df['api_error_label'].isin(SKIPPED_HISTORY_LABELS)]
+
+    history_df = history_df.reset_index(drop=True)
+
+    if 'api_request' in history_df.columns:
+        records = [_parse_request(api_request) for api_request in history_df['api_request']]
+        leads_df = pd.DataFrame.from_records(records, columns=list(ALL_PARAMS))
+    else:
+        leads_df = history_df.reindex(columns=list(ALL_PARAMS))
+
+    for column in ('api_error_label', HIGHMARK_XML_SCORE_COLUMN):
+        if column in history_df.columns:
+            leads_df[column] = history_df[column].to_numpy()
+
+    return leads_df
+
+
+def read_export(path):
+    '''Reads a CSV (optionally compressed) or Parquet export into a frame.'''
+
+    if path.endswith(('.parquet', '.pq')):
+        return pd.read_parquet(path)
+    # every param is read as sent, the checks coerce them
+    return pd.read_csv(path, dtype=str, keep_default_na=False, na_values=[''])
+
+
+def load_history(path, api_name=API_NAME):
+    '''Reads a history export and returns its leads, see history_to_frame.'''
+
+    with _timed('load_history'):
+        return history_to_frame(read_export(path), api_name=api_name)
+
+
+#====================================================================================
+# Thresholds
+#====================================================================================
+def thresholds_from_values(values, version='baseline'):
+    '''Thresholds from a {var_key: value} mapping holding every key of "los_thresholds".'''
+
+    threshold_df = pd.DataFrame({'var_key': list(values), 'var_value': list(values.values())})
+    return Thresholds.from_frame(threshold_df, version=version)
+
+
+def with_changes(thresholds, name, changes):
+    '''Copy of thresholds with the given {var_key or field: value} changes, named after name.'''
+
+    fields = {}
+    for key, value in changes.items():
+        field = _FIELDS.get(key, key)
+        if field not in _FIELDS.values():
+            raise KeyError(f'unknown threshold {key}')
+        fields[field] = int(value)
+
+    return thresholds._replace(version=name, **fields)
+
+
+def threshold_values(thresholds):
+    return {key: getattr(thresholds, field) for key, field in THRESHOLD_KEYS}
+
+
+#====================================================================================
+# Backtest
+#====================================================================================
+class Backtest(object):
+    '''Leads screened once, ready to be evaluated under any number of Thresholds.
+
+    leads_df - frame with one column per param, as returned by load_history
+    check_pincode, validate_sector, validate_subsector - lookups of CHECK 1 to CHECK 3,
+               the pincode and sector indexes by default; each runs once per distinct value'''
+
+    def __init__(self, leads_df, api_name=API_NAME,
+                 check_pincode = None,
+                 validate_sector = None,
+                 validate_subsector = None):
+
+        leads_df = leads_df.reindex(columns=list(dict.fromkeys(ALL_PARAMS + tuple(leads_df.columns))))
+
+        with _timed('screen_leads'):
+            outcome, pending = vr.screen_leads(leads_df, api_name,
+                                               check_pincode=check_pincode,
+                                               validate_sector=validate_sector,
+                                               validate_subsector=validate_subsector)
+
+        self.size = len(leads_df)
+
+        # outcome code of every lead decided before CHECK 4, success for the others
+        self.fixed_codes = pd.Series(outcome).map(OUTCOME_CODES).to_numpy(dtype=np.int16)
+        self.pending = pending
+
+        with _timed('rule_columns'):
+            pending_df = leads_df[pending]
+            self.columns = vr.rule_columns(pending_df)
+            if HIGHMARK_XML_SCORE_COLUMN in pending_df.columns:
+                self.xml_score = pd.to_numeric(pending_df[HIGHMARK_XML_SCORE_COLUMN], errors='coerce').to_numpy(dtype=float)
+            else:
+                self.xml_score = None
+
+        self.recorded_labels = (leads_df['api_error_label'].to_numpy(dtype=object)
+                                if 'api_error_label' in leads_df.columns else None)
+
+    def evaluate(self, thresholds):
+        '''Returns the outcome code of every lead reaching CHECK 4 under thresholds.'''
+
+        codes = np.full(len(self.columns.turnover), SUCCESS_CODE, dtype=np.int16)
+        pending = np.ones(len(codes), dtype=bool)
+
+        masks = vr.rule_masks(self.columns, thresholds)
+        if self.xml_score is not None:
+            masks.append(('highmark_xml', (self.xml_score < thresholds.max_crif_score) &
+                                          (self.xml_score > thresholds.min_crif_score)))
+
+        for key, mask in masks:
+            rejected = mask & pending
+            codes[rejected] = OUTCOME_CODES[key]
+            pending &= ~mask
+
+        return codes
+
+    def outcome_keys(self, thresholds):
+        '''Returns the eligibility_rules.OUTCOMES key of every lead under thresholds.'''
+
+        codes = self.fixed_codes.copy()
+        codes[self.pending] = self.evaluate(thresholds)
+        return np.asarray(OUTCOME_KEYS, dtype=object)[codes]
+
+    def run(self, baseline, candidates=()):
+        '''Evaluates baseline and every candidate Thresholds (named by their version).
+        Returns the report: outcome counts of each and, for the candidates, their deltas.'''
+
+        fixed_counts = np.bincount(self.fixed_codes[~self.pending], minlength=len(OUTCOME_KEYS))
+
+        with _timed('evaluate'):
+            baseline_codes = self.evaluate(baseline)
+        baseline_summary = self._summary(baseline, fixed_counts, baseline_codes)
+
+        report = {'leads': self.size,
+                  'reaching_threshold_checks': int(self.pending.sum()),
+                  'highmark_xml_checked': self.xml_score is not None,
+                  'baseline': baseline_summary,
+                  'candidates': []}
+
+        if self.recorded_labels is not None:
+            report['baseline']['matches_history'] = self._matches_history(baseline_codes)
+
+        for candidate in candidates:
+            with _timed('evaluate'):
+                codes = self.evaluate(candidate)
+            summary = self._summary(candidate, fixed_counts, codes)
+            summary.update(_deltas(baseline_summary, summary))
+            summary['newly_approved'] = int(((codes == SUCCESS_CODE) & (baseline_codes != SUCCESS_CODE)).sum())
+            summary['newly_rejected'] = int(((codes != SUCCESS_CODE) & (baseline_codes == SUCCESS_CODE)).sum())
+            report['candidates'].append(summary)
+
+        return report
+
+    def _summary(self, thresholds, fixed_counts, codes):
+        counts = fixed_counts + np.bincount(codes, minlength=len(OUTCOME_KEYS))
+        approved = int(counts[SUCCESS_CODE])
+
+        return {'name': thresholds.version,
+                'thresholds': threshold_values(thresholds),
+                'approved': approved,
+                'approval_rate': approved / self.size if self.size else 0.0,
+                'outcomes': {key: int(count) for key, count in zip(OUTCOME_KEYS, counts) if count}}
+
+    def _matches_history(self, baseline_codes):
+        '''Share of the leads whose history label is the one of the baseline outcome.'''
+
+        codes = self.fixed_codes.copy()
+        codes[self.pending] = baseline_codes
+        labels = np.asarray([OUTCOMES[key].api_error_label for key in OUTCOME_KEYS], dtype=object)[codes]
+        return float((labels == self.recorded_labels).mean()) if self.size else 1.0
+
+
+def _deltas(baseline_summary, summary):
+    outcome_deltas = {}
+    code_deltas = {}
+
+    for key in OUTCOME_KEYS:
+        delta = summary['outcomes'].get(key, 0) - baseline_summary['outcomes'].get(key, 0)
+        if not delta:
+            continue
+        outcome_deltas[key] = delta
+        code = OUTCOMES[key].error_response_code
+        if code != 'NA':
+            code_deltas[code] = code_deltas.get(code, 0) + delta
+
+    return {'approval_rate_delta': summary['approval_rate'] - baseline_summary['approval_rate'],
+            'outcome_deltas': outcome_deltas,
+            'reject_code_deltas': code_deltas}
+
+
+class StageTimer(object):
+    '''Logs the seconds taken by a backtest stage.'''
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.started_at = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        logger.info('%s took %.2f s', self.stage, time.perf_counter() - self.started_at)
+
+
+def _timed(stage):
+    return StageTimer(stage)
+
+
+#====================================================================================
+# Command line
+#====================================================================================
+def read_baseline(path):
+    '''Baseline Thresholds from a JSON {var_key: value} file or a "los_thresholds" CSV export.'''
+
+    if path.endswith('.json'):
+        with open(path) as baseline_file:
+            return thresholds_from_values(json.load(baseline_file))
+    return Thresholds.from_frame(pd.read_csv(path), version='baseline')
+
+
+def read_candidates(path, baseline):
+    '''Candidates from a JSON file, {name: {var_key: value}} or [{"name": ..., var_key: value}].'''
+
+    with open(path) as candidates_file:
+        content = json.load(candidates_file)
+
+    if isinstance(content, dict):
+        content = [dict(changes, name=name) for name, changes in content.items()]
+
+    candidates = []
+    for changes in content:
+        changes = dict(changes)
+        candidates.append(with_changes(baseline, str(changes.pop('name')), changes))
+    return candidates
+
+
+def parse_set(option, baseline):
+    '''Candidate from a --set option, name:KEY=VALUE[,KEY=VALUE...].'''
+
+    name, _, assignments = option.partition(':')
+    changes = dict(assignment.split('=', 1) for assignment in assignments.split(',') if assignment)
+    return with_changes(baseline, name, changes)
+
+
+def format_report(report):
+    lines = [f"{report['leads']} leads, {report['reaching_threshold_checks']} reach the threshold checks"
+             + ('' if report['highmark_xml_checked'] else ', CHECK 9 not replayed (no highmark_xml_score column)')]
+
+    baseline = report['baseline']
+    lines.append(f"baseline: approval rate {baseline['approval_rate']:.4%}"
+                 + (f", matches history for {baseline['matches_history']:.2%} of the leads"
+                    if 'matches_history' in baseline else ''))
+
+    for candidate in report['candidates']:
+        lines.append('')
+        lines.append(f"{candidate['name']}: approval rate {candidate['approval_rate']:.4%} "
+                     f"({candidate['approval_rate_delta']:+.4%}), "
+                     f"{candidate['newly_approved']} newly approved, {candidate['newly_rejected']} newly rejected")
+        for key, delta in candidate['outcome_deltas'].items():
+            code = OUTCOMES[key].error_response_code
+            lines.append(f"    {key:<20} {code:>4} {baseline['outcomes'].get(key, 0):>12} {delta:>+12}")
+
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('history', help='history export, CSV or Parquet')
+    parser.add_argument('--baseline', required=True, help='current thresholds, JSON {var_key: value} or los_thresholds CSV')
+    parser.add_argument('--candidates', help='JSON file of candidate threshold changes')
+    parser.add_argument('--set', action='append', default=[], metavar='NAME:KEY=VALUE[,KEY=VALUE]',
+                        help='one candidate, can be repeated')
+    parser.add_argument('--api-name', default=API_NAME, help='api_name of the history rows to replay')
+    parser.add_argument('--save-leads', help='writes the flattened leads to this CSV/Parquet file for later runs')
+    parser.add_argument('--output', help='writes the report as JSON to this file')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s', stream=sys.stderr)
+
+    baseline = read_baseline(args.baseline)
+    candidates = read_candidates(args.candidates, baseline) if args.candidates else []
+    candidates += [parse_set(option, baseline) for option in args.set]
+
+    leads_df = load_history(args.history, api_name=args.api_name)
+    if args.save_leads:
+        if args.save_leads.endswith(('.parquet', '.pq')):
+            leads_df.to_parquet(args.save_leads, index=False)
+        else:
+            leads_df.to_csv(args.save_leads, index=False)
+
+    report = Backtest(leads_df, api_name=args.api_name).run(baseline, candidates)
+    print(format_report(report))
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
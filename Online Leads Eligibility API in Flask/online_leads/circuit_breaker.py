@@ -0,0 +1,264 @@
+"""
+Circuit breaker for calls to a remote dependency.
+
+Every call runs on a small thread pool and is abandoned at its deadline, so a slow dependency
+cannot hold a worker for longer than call_timeout_seconds. An abandoned call keeps its pool
+thread until the dependency answers, so at most max_in_flight calls, abandoned ones included,
+are running or queued at a time; above that a call fails at once with PoolSaturated, and counts
+as a failure, instead of queueing behind the stuck ones. Calls are counted over a sliding
+window; once at least min_calls were made and the share of failures (errors and deadlines)
+reaches failure_rate_threshold, the circuit opens and calls fail at once with CircuitOpenError
+for open_seconds. After that up to half_open_max_calls probe calls are let through: the
+circuit closes when they all succeed and opens again on the first failure.
+
+With hedge_after_seconds set, a second attempt is started when the first one has not answered
+(or has failed) within that time, and the first successful answer is used.
+
+"""
+
+import contextvars
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from online_leads import metrics
+
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+metrics.METRIC_HELP.update({
+    'online_leads_circuit_breaker_calls_total': 'Calls through a circuit breaker by result.',
+    'online_leads_circuit_breaker_transitions_total': 'Circuit breaker state changes by new state, open counts the trips.',
+    'online_leads_circuit_breaker_open': 'Workers whose circuit is open (1 per worker).',
+})
+
+
+class CircuitOpenError(Exception):
+    '''The circuit is open, the call was not made.'''
+
+
+class CallTimeout(Exception):
+    '''The call did not answer before its deadline.'''
+
+
+class PoolSaturated(Exception):
+    '''max_in_flight calls, abandoned ones included, are still running, the call was not made.'''
+
+
+class CircuitBreaker(object):
+    '''Deadline, failure rate window, half-open probing and optional hedging around one dependency.'''
+
+    def __init__(self, name,
+                 call_timeout_seconds = 2.0,
+                 window_seconds = 30.0,
+                 min_calls = 20,
+                 failure_rate_threshold = 0.5,
+                 open_seconds = 15.0,
+                 half_open_max_calls = 3,
+                 hedge_after_seconds = 0.0,
+                 max_workers = 16,
+                 max_in_flight = None):
+
+        self.name = name
+        self.call_timeout_seconds = call_timeout_seconds
+        self.window_seconds = window_seconds
+        self.min_calls = min_calls
+        self.failure_rate_threshold = failure_rate_threshold
+        self.open_seconds = open_seconds
+        self.half_open_max_calls = half_open_max_calls
+        self.hedge_after_seconds = hedge_after_seconds
+        self.max_in_flight = max_in_flight or max_workers
+
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f'{name}-call')
+        self._calls = deque()
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probes = 0
+        self._probe_successes = 0
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+        metrics.set_gauge('online_leads_circuit_breaker_open', 0, breaker=name)
+
+    @property
+    def state(self):
+        with self._lock:
+            self._refresh_state(time.monotonic())
+            return self._state
+
+    def call(self, func, *args, **kwargs):
+        '''Calls func(*args, **kwargs) through the breaker and returns its result.
+        Raises CircuitOpenError, CallTimeout, PoolSaturated or the error of the call.'''
+
+        probe = self._acquire()
+
+        try:
+            result = self._call_with_deadline(func, args, kwargs)
+        except CallTimeout:
+            metrics.inc('online_leads_circuit_breaker_calls_total', breaker=self.name, result='timeout')
+            self._record(False, probe)
+            raise
+        except PoolSaturated:
+            metrics.inc('online_leads_circuit_breaker_calls_total', breaker=self.name, result='saturated')
+            self._record(False, probe)
+            raise
+        except Exception:
+            metrics.inc('online_leads_circuit_breaker_calls_total', breaker=self.name, result='failure')
+            self._record(False, probe)
+            raise
+
+        metrics.inc('online_leads_circuit_breaker_calls_total', breaker=self.name, result='success')
+        self._record(True, probe)
+        return result
+
+    def reset(self):
+        '''Closes the circuit and forgets the window.'''
+
+        with self._lock:
+            self._calls.clear()
+            self._transition(CLOSED)
+
+    def stats(self):
+        '''Returns the state, the calls and failures in the current window and the calls in flight.'''
+
+        with self._lock:
+            now = time.monotonic()
+            self._refresh_state(now)
+            self._prune(now)
+            failures = sum(1 for _, success in self._calls if not success)
+            return {'state': self._state, 'calls': len(self._calls), 'failures': failures,
+                    'in_flight': self._in_flight}
+
+    #====================================================================================
+    # State
+    #====================================================================================
+    def _acquire(self):
+        '''Returns True for a half-open probe, False for a normal call; raises while open.'''
+
+        with self._lock:
+            self._refresh_state(time.monotonic())
+
+            if self._state == CLOSED:
+                return False
+
+            if self._state == HALF_OPEN and self._probes < self.half_open_max_calls:
+                self._probes += 1
+                return True
+
+        metrics.inc('online_leads_circuit_breaker_calls_total', breaker=self.name, result='rejected')
+        raise CircuitOpenError(f'circuit {self.name} is {self._state}')
+
+    def _record(self, success, probe):
+        with self._lock:
+            now = time.monotonic()
+
+            if probe:
+                if self._state != HALF_OPEN:
+                    return
+                if not success:
+                    self._transition(OPEN, now)
+                    return
+                self._probe_successes += 1
+                if self._probe_successes >= self.half_open_max_calls:
+                    self._calls.clear()
+                    self._transition(CLOSED)
+                return
+
+            if self._state != CLOSED:
+                return
+
+            self._calls.append((now, success))
+            self._prune(now)
+
+            if len(self._calls) >= self.min_calls:
+                failures = sum(1 for _, call_success in self._calls if not call_success)
+                if failures / len(self._calls) >= self.failure_rate_threshold:
+                    logger.warning('circuit %s opened, %s of the last %s calls failed',
+                                   self.name, failures, len(self._calls))
+                    self._transition(OPEN, now)
+
+    def _refresh_state(self, now):
+        if self._state == OPEN and now - self._opened_at >= self.open_seconds:
+            self._transition(HALF_OPEN)
+
+    def _prune(self, now):
+        while self._calls and now - self._calls[0][0] > self.window_seconds:
+            self._calls.popleft()
+
+    def _transition(self, state, now=None):
+        if state == self._state:
+            return
+
+        self._state = state
+        self._probes = 0
+        self._probe_successes = 0
+        if state == OPEN:
+            self._opened_at = now if now is not None else time.monotonic()
+
+        metrics.inc('online_leads_circuit_breaker_transitions_total', breaker=self.name, state=state)
+        metrics.set_gauge('online_leads_circuit_breaker_open', 1 if state == OPEN else 0, breaker=self.name)
+
+    #====================================================================================
+    # Calls
+    #====================================================================================
+    def _submit(self, func, args, kwargs):
+        '''Starts an attempt on the pool, None when max_in_flight attempts are still running.'''
+
+        with self._lock:
+            if self._in_flight >= self.max_in_flight:
+                return None
+            self._in_flight += 1
+
+        # run with the context of the caller, e.g. for the profiler of its request
+        future = self._executor.submit(contextvars.copy_context().run, func, *args, **kwargs)
+        future.add_done_callback(self._attempt_done)
+        return future
+
+    def _attempt_done(self, future):
+        with self._lock:
+            self._in_flight -= 1
+
+    def _call_with_deadline(self, func, args, kwargs):
+        deadline = time.monotonic() + self.call_timeout_seconds
+        first = self._submit(func, args, kwargs)
+        if first is None:
+            raise PoolSaturated(f'{self.name} has {self.max_in_flight} calls in flight')
+
+        pending = {first}
+        hedged = not self.hedge_after_seconds
+        error = None
+
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+
+            timeout = remaining if hedged else min(remaining, self.hedge_after_seconds)
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+
+            if not hedged and (not done or not pending):
+                # no answer yet, or the first attempt failed: start one more attempt if a thread is free
+                hedged = True
+                attempt = self._submit(func, args, kwargs)
+                if attempt is not None:
+                    metrics.inc('online_leads_circuit_breaker_calls_total', breaker=self.name, result='hedged')
+                    pending.add(attempt)
+
+        # attempts still queued are dropped, the running ones keep their thread until they answer
+        for future in pending:
+            future.cancel()
+
+        if pending or error is None:
+            raise CallTimeout(f'{self.name} call did not answer within {self.call_timeout_seconds} seconds')
+        raise error
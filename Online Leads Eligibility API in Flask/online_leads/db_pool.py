@@ -0,0 +1,496 @@
+"""
+Pooled database connections for the threshold reads and the history inserts.
+
+lf.get_env_variables and avf.add_api_call_hist_data open a connection and parse their
+statement on every call. When LOS_DB_DSN is set, threshold_cache reads "los_thresholds" and
+hist_writer inserts its batches through a ConnectionPool instead: connections stay open
+between calls, at most LOS_DB_POOL_MAX_SIZE per worker, and a connection idle for longer than
+LOS_DB_POOL_HEALTH_CHECK_SECONDS is pinged before it is handed out again.
+
+The pool runs its own statements, so the tables and columns the helpers use are configured
+with the LOS_DB_* settings below. The warm-up checks them with check_schema(); when a table or
+column is missing, the worker logs it and keeps using lf and avf. The token, the credential
+params and the request headers are not written to the history rows.
+
+Any DB-API 2.0 driver works, LOS_DB_DRIVER names its module (psycopg2 by default, sqlite3 for
+a local stand-in). Statements are rendered once for the driver's paramstyle and sent with
+the same text every time, so drivers that cache statements per connection (sqlite3) or
+prepare repeated ones (psycopg 3) parse each of them once per connection.
+
+"""
+
+import atexit
+import contextlib
+import importlib
+import json
+import logging
+import os
+import threading
+import time
+
+from online_leads import metrics
+from online_leads import request_schema
+from online_leads import token_cache
+
+
+logger = logging.getLogger(__name__)
+
+# DB-API 2.0 module of the database driver
+DB_DRIVER = os.environ.get('LOS_DB_DRIVER', 'psycopg2')
+
+# connection string passed to the driver's connect(), lf and avf are used while this is not set
+DB_DSN = os.environ.get('LOS_DB_DSN')
+
+# connections opened by the worker warm-up
+DB_POOL_MIN_SIZE = int(os.environ.get('LOS_DB_POOL_MIN_SIZE', 1))
+
+# maximum number of connections of a worker, callers wait for a free one above that
+DB_POOL_MAX_SIZE = int(os.environ.get('LOS_DB_POOL_MAX_SIZE', 4))
+
+# seconds a caller waits for a free connection before PoolTimeout is raised
+DB_POOL_TIMEOUT_SECONDS = float(os.environ.get('LOS_DB_POOL_TIMEOUT_SECONDS', 2))
+
+# connections idle for longer than this are pinged before they are reused
+DB_POOL_HEALTH_CHECK_SECONDS = float(os.environ.get('LOS_DB_POOL_HEALTH_CHECK_SECONDS', 30))
+
+# connections are closed and replaced once they are this old
+DB_POOL_MAX_LIFETIME_SECONDS = float(os.environ.get('LOS_DB_POOL_MAX_LIFETIME_SECONDS', 3600))
+
+# tables read and written through the pool
+DB_THRESHOLDS_TABLE = os.environ.get('LOS_DB_THRESHOLDS_TABLE', 'dsapi.los_thresholds')
+DB_HIST_TABLE = os.environ.get('LOS_DB_HIST_TABLE', 'dsapi.api_call_hist')
+
+# columns of the thresholds table: api name, threshold name, threshold value
+DB_THRESHOLDS_COLUMNS = tuple(column.strip() for column in os.environ.get('LOS_DB_THRESHOLDS_COLUMNS',
+                                                                          'api_name,var_key,var_value').split(','))
+
+# columns of the history table receiving api_name, api_error_label, api_status, logic_status,
+# api_request and api_response, in this order
+DB_HIST_COLUMNS = tuple(column.strip() for column in os.environ.get('LOS_DB_HIST_COLUMNS',
+                                                                    'api_name,api_error_label,api_status,'
+                                                                    'logic_status,api_request,api_response').split(','))
+
+# request params and headers left out of the history rows, besides the token credential params
+DB_HIST_REDACTED_PARAMS = frozenset(param.strip().lower() for param in
+                                    os.environ.get('LOS_DB_HIST_REDACTED_PARAMS',
+                                                   'token,password,api_key,secret,authorization,'
+                                                   'proxy-authorization,cookie').split(',')
+                                    if param.strip()) | frozenset(param.lower() for param in token_cache.TOKEN_CREDENTIAL_PARAMS)
+
+metrics.METRIC_HELP.update({
+    'online_leads_db_pool_wait_seconds': 'Time taken to get a pooled database connection, opening it included.',
+    'online_leads_db_query_seconds': 'Latency of the statements run through the database pool.',
+    'online_leads_db_connections_total': 'Database connections by event: opened, closed, expired, health_check_failed, broken.',
+    'online_leads_db_pool_timeouts_total': 'Callers which found no free database connection within the pool timeout.',
+    'online_leads_db_pool_connections': 'Pooled database connections by state, in_use or idle.',
+})
+
+# paramstyle -> marker of the n-th parameter
+_MARKERS = {'qmark': lambda idx: '?',
+            'format': lambda idx: '%s',
+            'numeric': lambda idx: f':{idx}',
+            'named': lambda idx: f':p{idx}',
+            'pyformat': lambda idx: f'%(p{idx})s'}
+
+
+class PoolTimeout(Exception):
+    '''No connection of the pool was free within its timeout.'''
+
+
+class SchemaError(Exception):
+    '''A table or column the pool reads or writes is missing.'''
+
+
+class Statement(object):
+    '''SQL written with ? markers, rendered once per paramstyle and reused as is.'''
+
+    __slots__ = ('name', 'sql', '_rendered')
+
+    def __init__(self, name, sql):
+        self.name = name
+        self.sql = sql
+        self._rendered = {}
+
+    def render(self, paramstyle):
+        rendered = self._rendered.get(paramstyle)
+        if rendered is None:
+            marker = _MARKERS[paramstyle]
+            parts = self.sql.split('?')
+            rendered = parts[0] + ''.join(marker(idx) + part for idx, part in enumerate(parts[1:], 1))
+            self._rendered[paramstyle] = rendered
+        return rendered
+
+    @staticmethod
+    def bind(paramstyle, values):
+        if paramstyle in ('named', 'pyformat'):
+            return {f'p{idx}': value for idx, value in enumerate(values, 1)}
+        return tuple(values)
+
+
+class _PooledConnection(object):
+
+    __slots__ = ('raw', 'opened_at', 'returned_at')
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.opened_at = self.returned_at = time.monotonic()
+
+
+def _close(raw):
+    try:
+        raw.close()
+    except Exception:
+        logger.debug('closing a database connection failed', exc_info=True)
+
+
+#====================================================================================
+# Pool
+#====================================================================================
+class ConnectionPool(object):
+    '''Bounded pool of DB-API connections shared by the threads of a process.
+
+    connect    - callable() opening a new connection
+    paramstyle - paramstyle of the driver, the statements are rendered for it
+    Idle connections are reused most recently returned first, so the connections beyond the
+    steady state load age out and are the ones found stale by the health check.'''
+
+    def __init__(self,
+                 connect,
+                 paramstyle = 'qmark',
+                 max_size = DB_POOL_MAX_SIZE,
+                 timeout_seconds = DB_POOL_TIMEOUT_SECONDS,
+                 health_check_seconds = DB_POOL_HEALTH_CHECK_SECONDS,
+                 max_lifetime_seconds = DB_POOL_MAX_LIFETIME_SECONDS,
+                 ping_sql = 'SELECT 1',
+                 name = 'los'):
+
+        self.connect = connect
+        self.paramstyle = paramstyle
+        self.max_size = max_size
+        self.timeout_seconds = timeout_seconds
+        self.health_check_seconds = health_check_seconds
+        self.max_lifetime_seconds = max_lifetime_seconds
+        self.ping_sql = ping_sql
+        self.name = name
+
+        self._idle = []
+        self._size = 0
+        self._pid = os.getpid()
+        self._cond = threading.Condition()
+
+    @contextlib.contextmanager
+    def connection(self):
+        '''with pool.connection() as conn: ... commits on success, rolls back on error.
+        A connection which cannot be rolled back is closed instead of returned to the pool.'''
+
+        pooled = self.acquire()
+        try:
+            yield pooled.raw
+            pooled.raw.commit()
+        except BaseException:
+            self.release(pooled, broken=not self._rollback(pooled.raw))
+            raise
+        self.release(pooled)
+
+    def fetchall(self, statement, values=()):
+        '''Runs a statement and returns its rows.'''
+
+        with self.connection() as conn, self._cursor(conn, statement) as cursor:
+            cursor.execute(statement.render(self.paramstyle), statement.bind(self.paramstyle, values))
+            return cursor.fetchall()
+
+    def executemany(self, statement, rows):
+        '''Runs a statement once per row of values, in one transaction.'''
+
+        bound = [statement.bind(self.paramstyle, values) for values in rows]
+        with self.connection() as conn, self._cursor(conn, statement) as cursor:
+            cursor.executemany(statement.render(self.paramstyle), bound)
+
+    def acquire(self):
+        '''Returns a connection, opening one while the pool is below max_size. Waits up to
+        timeout_seconds for one to be released otherwise, then raises PoolTimeout.'''
+
+        self._check_fork()
+        started_at = time.perf_counter()
+        deadline = time.monotonic() + self.timeout_seconds
+        pooled = None
+
+        while pooled is None:
+            with self._cond:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        metrics.inc('online_leads_db_pool_timeouts_total', pool=self.name)
+                        raise PoolTimeout(f'no {self.name} database connection free within '
+                                          f'{self.timeout_seconds} seconds')
+                    self._cond.wait(remaining)
+
+                if self._idle:
+                    pooled = self._idle.pop()
+                else:
+                    # the slot is taken now, the connection is opened outside the lock
+                    self._size += 1
+
+            if pooled is None:
+                pooled = self._open()
+            elif not self._usable(pooled):
+                pooled = None
+
+        metrics.observe('online_leads_db_pool_wait_seconds', time.perf_counter() - started_at, pool=self.name)
+        self._update_gauges()
+        return pooled
+
+    def release(self, pooled, broken=False):
+        '''Returns a connection to the pool, or closes it when broken or too old.'''
+
+        if broken:
+            self._discard(pooled, 'broken')
+        elif time.monotonic() - pooled.opened_at >= self.max_lifetime_seconds:
+            self._discard(pooled, 'expired')
+        else:
+            pooled.returned_at = time.monotonic()
+            with self._cond:
+                self._idle.append(pooled)
+                self._cond.notify()
+        self._update_gauges()
+
+    def fill(self, count):
+        '''Opens connections until count are idle or max_size are open, e.g. at warm-up.'''
+
+        self._check_fork()
+        while True:
+            with self._cond:
+                if len(self._idle) >= count or self._size >= self.max_size:
+                    break
+                self._size += 1
+            self.release(self._open())
+
+    def close(self):
+        '''Closes the idle connections, the ones in use are closed when released.'''
+
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+        for pooled in idle:
+            _close(pooled.raw)
+            metrics.inc('online_leads_db_connections_total', pool=self.name, event='closed')
+        self._update_gauges()
+
+    def stats(self):
+        with self._cond:
+            return {'size': self._size, 'idle': len(self._idle), 'max_size': self.max_size}
+
+    @contextlib.contextmanager
+    def _cursor(self, conn, statement):
+        started_at = time.perf_counter()
+        cursor = conn.cursor()
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+            metrics.observe('online_leads_db_query_seconds', time.perf_counter() - started_at,
+                            pool=self.name, query=statement.name)
+
+    def _open(self):
+        try:
+            pooled = _PooledConnection(self.connect())
+        except BaseException:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        metrics.inc('online_leads_db_connections_total', pool=self.name, event='opened')
+        return pooled
+
+    def _usable(self, pooled):
+        now = time.monotonic()
+        if now - pooled.opened_at >= self.max_lifetime_seconds:
+            self._discard(pooled, 'expired')
+            return False
+
+        if now - pooled.returned_at < self.health_check_seconds:
+            return True
+
+        try:
+            cursor = pooled.raw.cursor()
+            try:
+                cursor.execute(self.ping_sql)
+                cursor.fetchall()
+            finally:
+                cursor.close()
+            pooled.raw.rollback()
+        except Exception:
+            logger.warning('%s database connection failed its health check, reconnecting', self.name)
+            self._discard(pooled, 'health_check_failed')
+            return False
+        return True
+
+    def _discard(self, pooled, event):
+        _close(pooled.raw)
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+        metrics.inc('online_leads_db_connections_total', pool=self.name, event=event)
+
+    @staticmethod
+    def _rollback(raw):
+        try:
+            raw.rollback()
+        except Exception:
+            return False
+        return True
+
+    def _update_gauges(self):
+        with self._cond:
+            idle = len(self._idle)
+            in_use = self._size - idle
+        metrics.set_gauge('online_leads_db_pool_connections', in_use, pool=self.name, state='in_use')
+        metrics.set_gauge('online_leads_db_pool_connections', idle, pool=self.name, state='idle')
+
+    def _check_fork(self):
+        # connections inherited from the parent are dropped, not closed, closing them would
+        # end the sessions the parent is still using
+        if self._pid == os.getpid():
+            return
+
+        with self._cond:
+            if self._pid != os.getpid():
+                self._idle = []
+                self._size = 0
+                self._pid = os.getpid()
+
+
+#====================================================================================
+# Module level pool
+#====================================================================================
+_pool = None
+_pool_lock = threading.Lock()
+_schema_error = None
+_schema_checked = False
+_schema_lock = threading.Lock()
+
+
+def enabled():
+    '''True when LOS_DB_DSN is set and the queries go through the pool. The first call, made
+    before the pool is first used, runs check_schema(): False as well once it found the
+    configured tables do not match.'''
+
+    if not DB_DSN:
+        return False
+
+    if not _schema_checked:
+        with _schema_lock:
+            if not _schema_checked:
+                try:
+                    check_schema()
+                except SchemaError as error:
+                    logger.error('%s', error)
+                except Exception:
+                    # e.g. the database is not reachable yet: the pool is used, checked on the next call
+                    logger.exception('checking the database schema failed')
+
+    return _schema_error is None
+
+
+def get_pool():
+    '''Returns the process wide ConnectionPool on LOS_DB_DSN, created on first use.'''
+
+    global _pool
+
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                driver = importlib.import_module(DB_DRIVER)
+                kwargs = {}
+                if DB_DRIVER == 'sqlite3':
+                    # pooled connections are used by whichever thread takes them
+                    kwargs['check_same_thread'] = False
+                pool = ConnectionPool(lambda: driver.connect(DB_DSN, **kwargs), paramstyle=driver.paramstyle)
+                atexit.register(pool.close)
+                _pool = pool
+    return _pool
+
+
+if len(DB_THRESHOLDS_COLUMNS) != 3:
+    raise ValueError(f'LOS_DB_THRESHOLDS_COLUMNS should name 3 columns, got {DB_THRESHOLDS_COLUMNS}')
+
+# history row fields, stored in the DB_HIST_COLUMNS of the same position
+HIST_COLUMNS = ('api_name', 'api_error_label', 'api_status', 'logic_status', 'api_request', 'api_response')
+
+if len(DB_HIST_COLUMNS) != len(HIST_COLUMNS):
+    raise ValueError(f'LOS_DB_HIST_COLUMNS should name {len(HIST_COLUMNS)} columns, got {DB_HIST_COLUMNS}')
+
+THRESHOLDS_QUERY = Statement('read_thresholds',
+                             f'SELECT {DB_THRESHOLDS_COLUMNS[1]}, {DB_THRESHOLDS_COLUMNS[2]} '
+                             f'FROM {DB_THRESHOLDS_TABLE} WHERE {DB_THRESHOLDS_COLUMNS[0]} = ?')
+
+HIST_INSERT = Statement('insert_hist_rows',
+                        f'INSERT INTO {DB_HIST_TABLE} ({", ".join(DB_HIST_COLUMNS)}) '
+                        f'VALUES ({", ".join("?" for _ in DB_HIST_COLUMNS)})')
+
+# statements selecting no rows, they only fail when a table or column is missing
+SCHEMA_PROBES = ((Statement('probe_thresholds_table',
+                            f'SELECT {", ".join(DB_THRESHOLDS_COLUMNS)} FROM {DB_THRESHOLDS_TABLE} WHERE 1 = 0'),
+                  'LOS_DB_THRESHOLDS_TABLE and LOS_DB_THRESHOLDS_COLUMNS'),
+                 (Statement('probe_hist_table',
+                            f'SELECT {", ".join(DB_HIST_COLUMNS)} FROM {DB_HIST_TABLE} WHERE 1 = 0'),
+                  'LOS_DB_HIST_TABLE and LOS_DB_HIST_COLUMNS'))
+
+
+def check_schema():
+    '''Runs the schema probes, on the first enabled() call and at warm-up. When one fails, the queries go back to lf and avf
+    (enabled() turns False) and SchemaError is raised.'''
+
+    global _schema_error, _schema_checked
+
+    pool = get_pool()
+    for probe, settings in SCHEMA_PROBES:
+        try:
+            pool.fetchall(probe)
+        except PoolTimeout:
+            raise
+        except Exception as error:
+            _schema_error = SchemaError(f'{probe.name} failed, check {settings}; '
+                                        f'lf and avf are used instead: {error}')
+            _schema_checked = True
+            raise _schema_error from error
+
+    _schema_checked = True
+
+
+def read_thresholds(api_name):
+    '''threshold_cache loader, the "los_thresholds" rows of api_name as the var_key / var_value
+    frame lf.get_env_variables returns.'''
+
+    import pandas as pd
+
+    rows = get_pool().fetchall(THRESHOLDS_QUERY, (api_name,))
+    return pd.DataFrame.from_records(rows, columns=['var_key', 'var_value'])
+
+
+def history_request(api_request):
+    '''The request params stored in a history row: the token and credential params are dropped,
+    and of request headers only the lead params are kept.'''
+
+    if not hasattr(api_request, 'items'):
+        return api_request
+    if isinstance(api_request, dict):
+        return {key: value for key, value in api_request.items() if str(key).lower() not in DB_HIST_REDACTED_PARAMS}
+    return {key: value for key, value in api_request.items() if key in request_schema.ALL_PARAMS}
+
+
+def _column_value(value):
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value, default=str)
+
+
+def _history_values(row):
+    return [_column_value(history_request(row[column]) if column == 'api_request' else row[column])
+            for column in HIST_COLUMNS]
+
+
+def write_history_rows(rows):
+    '''hist_writer sink, inserts a batch of history rows with one executemany.'''
+
+    get_pool().executemany(HIST_INSERT, [_history_values(row) for row in rows])
@@ -0,0 +1,197 @@
+"""
+Definitions of the online leads eligibility checks.
+
+Holds the possible outcomes of the checks (response values and history labels) and the
+eligibility rules run by the rule engine; the request params are declared in request_schema.
+Rules keep the precedence of the documented check order, the first failing check decides
+the response.
+
+"""
+
+import logging
+from collections import namedtuple
+
+from online_leads import highmark_report
+from online_leads import metrics
+from online_leads import pincode_index
+from online_leads import sector_index
+from online_leads.request_schema import NUMERIC_PARAMS
+from online_leads.rule_engine import Rule, RuleEngine, COST_MEMORY, COST_LOOKUP, COST_IO
+
+
+logger = logging.getLogger(__name__)
+
+NON_SERVICEABLE_LOAN_PURPOSES = ('machine_purchase', 'asset_purchase')
+
+
+class Outcome(namedtuple('Outcome', ['request_status',
+                                     'request_message',
+                                     'online_leads_eligibility_status',
+                                     'body_message',
+                                     'error_response_code',
+                                     'api_error_label',
+                                     'logic_status'])):
+    '''Response and history values of one possible result of the eligibility checks.'''
+
+    __slots__ = ()
+
+    def response_kwargs(self):
+        '''Returns the keyword arguments for default_api_response_dict.'''
+
+        return {'request_status': self.request_status,
+                'request_message': self.request_message,
+                'online_leads_eligibility_status': self.online_leads_eligibility_status,
+                'body_message': self.body_message,
+                'error_response_code': self.error_response_code}
+
+
+COMPLETED = 'successfully completed API call'
+
+OUTCOMES = {
+    'missing_params': Outcome('fail', 'all mandatory parameters are not sent', 'NA', 'NA', 'NA',
+                              'missing mandatory parameter', 'fail'),
+    'dev_bypass': Outcome('success', COMPLETED, 'success',
+                          'DEV_BYPASS -> online_leads_eligibility process has been by-passed successfully', 'NA',
+                          'NA', 'success'),
+    'pincode_wrong': Outcome('success', COMPLETED, 'fail', 'entered pincode is wrong', 'NA',
+                             'entered pincode is wrong', 'fail'),
+    'pincode': Outcome('success', COMPLETED, 'NA', 'Non Serviceable Pin-code', '252',
+                       'Non Serviceable Pin-code', 'fail'),
+    'sector': Outcome('success', COMPLETED, 'fail', 'Excluded Sector', '253',
+                      'Excluded Sector', 'fail'),
+    'subsector': Outcome('success', COMPLETED, 'fail', 'Excluded Sub-Sector', '254',
+                         'Excluded Sub-Sector', 'fail'),
+    'vintage': Outcome('success', COMPLETED, 'fail', 'Low vintage', '255',
+                       'Low vintage', 'fail'),
+    'turnover': Outcome('success', COMPLETED, 'fail', 'Low Annual Business Turnover', '256',
+                        'Low Annual Business Turnover', 'fail'),
+    'loan_amount': Outcome('success', COMPLETED, 'fail', 'Loan Amount not in Range', '257',
+                           'Loan Amount not in Range', 'fail'),
+    'highmark_score': Outcome('success', COMPLETED, 'fail', 'Highmark Score is not as per the loan policy', '258',
+                              'Highmark Score is not as per the loan policy', 'fail'),
+    'loan_purpose': Outcome('success', COMPLETED, 'fail', 'Non Serviceable Loan Purpose', '251',
+                            'Non Serviceable Loan Purpose', 'fail'),
+    # CHECK 9 had no error code while it was commented out; 259 is new, next to the 258 of CHECK 7
+    'highmark_xml': Outcome('success', COMPLETED, 'fail', 'Highmark XML Score is not as per the loan policy', '259',
+                            'Highmark XML Score is not as per the loan policy', 'fail'),
+    'success': Outcome('success', COMPLETED, 'success', 'online leads eligibility process completed successfully', 'NA',
+                       'NA', 'success'),
+}
+
+for _param in NUMERIC_PARAMS + ('app_highmark_score_A8',):
+    OUTCOMES[f'numeric:{_param}'] = Outcome('fail', f'Parameter {_param} should be numeric', 'NA', 'NA', 'NA',
+                                            f'{_param} data type', 'fail')
+    OUTCOMES[f'negative:{_param}'] = Outcome('fail', f'Parameter {_param} should not be negative', 'NA', 'NA', 'NA',
+                                             f'{_param} negative', 'fail')
+
+OUTCOMES['integer:app_highmark_score_A8'] = Outcome('fail', 'Parameter app_highmark_score_A8 should be an integer',
+                                                    'NA', 'NA', 'NA', 'app_highmark_score_A8 integer', 'fail')
+
+
+#====================================================================================
+# Eligibility checks on a request_schema.LeadRequest, each returns True when the lead fails
+#====================================================================================
+def pincode_is_wrong(lead, thresholds, api_name):
+    return len(lead.business_pincode) >= 7
+
+
+def pincode_not_serviceable(lead, thresholds, api_name):
+    # local pincode index, the Pincode Eng API is only called while no snapshot is loaded
+    with metrics.timed('check_pincode'):
+        return not pincode_index.check_pincode(lead.business_pincode, request_data=lead.data, api_name=api_name)
+
+
+def sector_excluded(lead, thresholds, api_name):
+    with metrics.timed('validate_sector'):
+        return not sector_index.validate_sector(lead.business_main_sector, lead.business_type)
+
+
+def subsector_excluded(lead, thresholds, api_name):
+    with metrics.timed('validate_subsector'):
+        return sector_index.validate_subsector(lead.business_main_sector,
+                                               lead.business_type,
+                                               lead.business_specific_sector)
+
+
+def low_vintage(lead, thresholds, api_name):
+    business_type = lead.business_type.lower()
+    vintage_months = int(lead.vintage_months)
+
+    return (((business_type == "manufacturing") and (vintage_months < thresholds.min_vintage)) or
+            ((business_type in ['trading', 'services']) and (vintage_months < thresholds.max_vintage)))
+
+
+def turnover_not_in_range(lead, thresholds, api_name):
+    # annual turnover amount validation here it should be >6L and <18Cr.
+    average_annual_turnover = int(lead.average_annual_turnover)
+    return (average_annual_turnover < thresholds.min_turnover) or (average_annual_turnover > thresholds.max_turnover)
+
+
+def loan_amount_not_in_range(lead, thresholds, api_name):
+    # requested loan amount validation here it should be >50K and <30L.
+    required_loan_amount = int(lead.required_loan_amount)
+    return (required_loan_amount < thresholds.min_loan_amount) or (required_loan_amount > thresholds.max_loan_amount)
+
+
+def score_not_eligible(score, thresholds):
+    return (score < thresholds.max_crif_score) and (score > thresholds.min_crif_score)
+
+
+def highmark_score_not_eligible(lead, thresholds, api_name):
+    if lead.app_highmark_score_A8 is None:
+        raise ValueError(f'app_highmark_score_A8 is not an integer: {lead.data.get("app_highmark_score_A8")!r}')
+    return score_not_eligible(lead.app_highmark_score_A8, thresholds)
+
+
+def loan_purpose_not_serviceable(lead, thresholds, api_name):
+    loan_purpose = lead.loan_purpose if lead.loan_purpose is not None else 'missing'
+    loan_purpose = loan_purpose.lower().replace(" ", "_")
+    return loan_purpose in NON_SERVICEABLE_LOAN_PURPOSES
+
+
+def highmark_xml_score_not_eligible(lead, thresholds, api_name):
+    applicant_highmark_XML = lead.applicant_highmark_XML
+    if not highmark_report.HIGHMARK_XML_ENABLED or not applicant_highmark_XML:
+        return False
+
+    try:
+        # a URL outside the allowed schemes and hosts is not fetched and is skipped like an
+        # unreadable report (HighmarkReportError)
+        extracted_score = highmark_report.get_score(applicant_highmark_XML)
+    except highmark_report.HighmarkReportError as error:
+        # an unreadable report does not reject the lead, CHECK 7 already ran on the sent score
+        logger.warning('Highmark XML score of application %s not checked: %s',
+                       lead.application_id, error)
+        # the fail open answer is not stored for redelivered leads
+        from online_leads import result_cache
+        result_cache.skip()
+        return False
+
+    return score_not_eligible(extracted_score, thresholds)
+
+
+ELIGIBILITY_RULES = (
+    Rule('pincode_wrong', 0, COST_MEMORY, OUTCOMES['pincode_wrong'], pincode_is_wrong,
+         "Step-8 Online Leads eligibility CHECK 1 - Business Pincode Eligibility"),
+    Rule('pincode', 1, COST_IO, OUTCOMES['pincode'], pincode_not_serviceable,
+         "Step-8 Online Leads eligibility CHECK 1 - Business Pincode Serviceability"),
+    Rule('sector', 2, COST_LOOKUP, OUTCOMES['sector'], sector_excluded,
+         "Step-9 Online Leads eligibility CHECK 2 - Sector Validity"),
+    Rule('subsector', 3, COST_LOOKUP, OUTCOMES['subsector'], subsector_excluded,
+         "Step-10 Online Leads eligibility CHECK 3 - Sub-Sector Validity"),
+    Rule('vintage', 4, COST_MEMORY, OUTCOMES['vintage'], low_vintage,
+         "Step-11 Online Leads eligibility CHECK 4 - Vintage Check for the given business"),
+    Rule('turnover', 5, COST_MEMORY, OUTCOMES['turnover'], turnover_not_in_range,
+         "Step-12 Online Leads eligibility CHECK 5 - Annual Business Turnover check"),
+    Rule('loan_amount', 6, COST_MEMORY, OUTCOMES['loan_amount'], loan_amount_not_in_range,
+         "Step-13 Online Leads eligibility CHECK 6 - requested loan amount validation"),
+    Rule('highmark_score', 7, COST_MEMORY, OUTCOMES['highmark_score'], highmark_score_not_eligible,
+         "Step-14 Online Leads eligibility CHECK 7 - Highmark Score Check"),
+    Rule('loan_purpose', 8, COST_MEMORY, OUTCOMES['loan_purpose'], loan_purpose_not_serviceable,
+         "Step-15 Online Leads eligibility CHECK 8 - Loan Purpose"),
+    Rule('highmark_xml', 9, COST_IO, OUTCOMES['highmark_xml'], highmark_xml_score_not_eligible,
+         "Step-16 Online Leads eligibility CHECK 9 - Highmark XML Extraction"),
+)
+
+# engine used by the single lead API
+ENGINE = RuleEngine(ELIGIBILITY_RULES)
@@ -0,0 +1,290 @@
+"""
+Highmark (CRIF) B2C report score extraction for CHECK 9.
+
+The report XML is streamed from its URL through a pooled requests session with strict
+timeouts and fed chunk by chunk to an incremental XML parser, which stops at the first
+score-value tag, so the rest of a large report is never downloaded or parsed. Extracted
+scores are kept in a bounded LRU cache keyed by report URL.
+
+Reports are only fetched from the schemes and hosts of LOS_HIGHMARK_XML_ALLOWED_SCHEMES and
+LOS_HIGHMARK_XML_ALLOWED_HOSTS, and redirects are not followed, so a lead cannot make the API
+request internal addresses. request_schema.parse() reports any other URL as an invalid param.
+
+Reports can also be read from local files (file:// URLs or plain paths) when
+LOS_HIGHMARK_ALLOW_FILE_URLS is set, which is meant for testing against saved reports.
+
+"""
+
+import logging
+import os
+import threading
+import time
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+from urllib.parse import urlparse
+from urllib.request import url2pathname
+
+from online_leads import metrics
+
+
+logger = logging.getLogger(__name__)
+
+# CHECK 9 is only run when enabled, leads without applicant_highmark_XML always pass it
+HIGHMARK_XML_ENABLED = os.environ.get('LOS_HIGHMARK_XML_ENABLED', 'false').lower() == 'true'
+
+# seconds to connect / between two received bytes / for the whole report
+HIGHMARK_CONNECT_TIMEOUT_SECONDS = float(os.environ.get('LOS_HIGHMARK_CONNECT_TIMEOUT_SECONDS', 2))
+HIGHMARK_READ_TIMEOUT_SECONDS = float(os.environ.get('LOS_HIGHMARK_READ_TIMEOUT_SECONDS', 5))
+HIGHMARK_TOTAL_TIMEOUT_SECONDS = float(os.environ.get('LOS_HIGHMARK_TOTAL_TIMEOUT_SECONDS', 10))
+
+# pooled connections kept per report host
+HIGHMARK_POOL_SIZE = int(os.environ.get('LOS_HIGHMARK_POOL_SIZE', 20))
+
+# bytes read per chunk, and read at most before giving up on a report
+HIGHMARK_CHUNK_SIZE = int(os.environ.get('LOS_HIGHMARK_CHUNK_SIZE', 16384))
+HIGHMARK_MAX_REPORT_BYTES = int(os.environ.get('LOS_HIGHMARK_MAX_REPORT_BYTES', 20 * 1024 * 1024))
+
+# extracted scores cached per report URL
+HIGHMARK_CACHE_TTL_SECONDS = float(os.environ.get('LOS_HIGHMARK_CACHE_TTL_SECONDS', 3600))
+HIGHMARK_CACHE_MAX_SIZE = int(os.environ.get('LOS_HIGHMARK_CACHE_MAX_SIZE', 10000))
+
+# read reports from local files, only for testing
+HIGHMARK_ALLOW_FILE_URLS = os.environ.get('LOS_HIGHMARK_ALLOW_FILE_URLS', 'false').lower() == 'true'
+
+# report URL schemes and hosts reports are fetched from, a host starting with a dot also allows
+# its subdomains. No report URL is allowed while the hosts are not set.
+HIGHMARK_XML_ALLOWED_SCHEMES = tuple(scheme.strip().lower() for scheme in
+                                     os.environ.get('LOS_HIGHMARK_XML_ALLOWED_SCHEMES', 'https').split(',')
+                                     if scheme.strip())
+HIGHMARK_XML_ALLOWED_HOSTS = tuple(host.strip().lower() for host in
+                                   os.environ.get('LOS_HIGHMARK_XML_ALLOWED_HOSTS', '').split(',')
+                                   if host.strip())
+
+SCORE_TAG = 'score-value'
+
+metrics.METRIC_HELP['online_leads_highmark_report_total'] = 'Highmark report score lookups by result.'
+
+
+class HighmarkReportError(Exception):
+    '''The report could not be read or has no score-value tag.'''
+
+
+def _local_name(tag):
+    # drop the {namespace} prefix, tags are compared case insensitive like the html parser did
+    return tag.rsplit('}', 1)[-1].lower()
+
+
+def extract_score(chunks, max_bytes=HIGHMARK_MAX_REPORT_BYTES, deadline=None):
+    '''Returns the integer score of the first score-value tag in a report given as an
+    iterable of byte chunks. Stops reading the chunks as soon as the tag is closed.'''
+
+    parser = ET.XMLPullParser(events=('end',))
+    received = 0
+
+    try:
+        for chunk in chunks:
+            received += len(chunk)
+            if received > max_bytes:
+                raise HighmarkReportError(f'no {SCORE_TAG} in the first {max_bytes} bytes of the report')
+            if deadline is not None and time.monotonic() > deadline:
+                raise HighmarkReportError('report was not read in time')
+
+            parser.feed(chunk)
+            for _, element in parser.read_events():
+                if _local_name(element.tag) == SCORE_TAG:
+                    try:
+                        return int(float(element.text.strip()))
+                    except (AttributeError, ValueError):
+                        raise HighmarkReportError(f'{SCORE_TAG} is not a number: {element.text!r}')
+                # keep memory flat on large reports
+                element.clear()
+
+        parser.close()
+    except ET.ParseError as error:
+        raise HighmarkReportError(f'report is not valid XML: {error}')
+
+    raise HighmarkReportError(f'report has no {SCORE_TAG} tag')
+
+
+def allowed_url(url, allowed_schemes=None, allowed_hosts=None, allow_file_urls=None):
+    '''True if a report may be read from url: an allowed scheme and host, or a local file while
+    file URLs are allowed. The module settings are used for the arguments left to None.'''
+
+    allowed_schemes = HIGHMARK_XML_ALLOWED_SCHEMES if allowed_schemes is None else allowed_schemes
+    allowed_hosts = HIGHMARK_XML_ALLOWED_HOSTS if allowed_hosts is None else allowed_hosts
+    allow_file_urls = HIGHMARK_ALLOW_FILE_URLS if allow_file_urls is None else allow_file_urls
+
+    try:
+        parsed = urlparse(url)
+        host = (parsed.hostname or '').lower()
+    except ValueError:
+        return False
+
+    if parsed.scheme in ('', 'file'):
+        return allow_file_urls
+    if parsed.scheme not in allowed_schemes or not host:
+        return False
+    return any(host == allowed or (allowed.startswith('.') and host.endswith(allowed)) for allowed in allowed_hosts)
+
+
+def create_session(pool_size=HIGHMARK_POOL_SIZE):
+    '''requests session with pooled keep-alive connections and no automatic retries.'''
+
+    # imported on first use, most workers never read a Highmark report
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class HighmarkReportFetcher(object):
+    '''Streams Highmark reports and caches the extracted score per report URL.'''
+
+    def __init__(self,
+                 session = None,
+                 connect_timeout_seconds = HIGHMARK_CONNECT_TIMEOUT_SECONDS,
+                 read_timeout_seconds = HIGHMARK_READ_TIMEOUT_SECONDS,
+                 total_timeout_seconds = HIGHMARK_TOTAL_TIMEOUT_SECONDS,
+                 chunk_size = HIGHMARK_CHUNK_SIZE,
+                 max_report_bytes = HIGHMARK_MAX_REPORT_BYTES,
+                 cache_ttl_seconds = HIGHMARK_CACHE_TTL_SECONDS,
+                 cache_max_size = HIGHMARK_CACHE_MAX_SIZE,
+                 allow_file_urls = HIGHMARK_ALLOW_FILE_URLS,
+                 allowed_schemes = HIGHMARK_XML_ALLOWED_SCHEMES,
+                 allowed_hosts = HIGHMARK_XML_ALLOWED_HOSTS):
+
+        self.session = session or create_session()
+        self.timeout = (connect_timeout_seconds, read_timeout_seconds)
+        self.total_timeout_seconds = total_timeout_seconds
+        self.chunk_size = chunk_size
+        self.max_report_bytes = max_report_bytes
+        self.cache_ttl_seconds = cache_ttl_seconds
+        self.cache_max_size = cache_max_size
+        self.allow_file_urls = allow_file_urls
+        self.allowed_schemes = allowed_schemes
+        self.allowed_hosts = allowed_hosts
+
+        self._scores = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _cached(self, url):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._scores.get(url)
+            if entry is None:
+                return None
+            score, expires_at = entry
+            if expires_at <= now:
+                del self._scores[url]
+                return None
+            self._scores.move_to_end(url)
+            return score
+
+    def _store(self, url, score):
+        with self._lock:
+            self._scores[url] = (score, time.monotonic() + self.cache_ttl_seconds)
+            self._scores.move_to_end(url)
+            while len(self._scores) > self.cache_max_size:
+                self._scores.popitem(last=False)
+
+    def _read_file(self, path, deadline):
+        with open(path, 'rb') as report_file:
+            return extract_score(iter(lambda: report_file.read(self.chunk_size), b''),
+                                 max_bytes=self.max_report_bytes, deadline=deadline)
+
+    def _read_url(self, url, deadline):
+        import requests
+
+        try:
+            # leaving the block closes the connection when the report was not read to the end
+            with self.session.get(url, stream=True, timeout=self.timeout, allow_redirects=False) as response:
+                response.raise_for_status()
+                if response.is_redirect:
+                    raise HighmarkReportError(f'report url redirects to {response.headers.get("Location")!r}')
+                return extract_score(response.iter_content(chunk_size=self.chunk_size),
+                                     max_bytes=self.max_report_bytes, deadline=deadline)
+        except requests.RequestException as error:
+            raise HighmarkReportError(f'report could not be fetched: {error}')
+
+    def fetch_score(self, url):
+        '''Reads the report and returns its score, without the cache.'''
+
+        if not allowed_url(url, self.allowed_schemes, self.allowed_hosts, self.allow_file_urls):
+            raise HighmarkReportError(f'report url {url!r} is not allowed')
+
+        deadline = time.monotonic() + self.total_timeout_seconds
+        parsed = urlparse(url)
+
+        if parsed.scheme in ('http', 'https'):
+            return self._read_url(url, deadline)
+
+        if parsed.scheme in ('', 'file') and self.allow_file_urls:
+            path = url2pathname(parsed.path) if parsed.scheme == 'file' else url
+            try:
+                return self._read_file(path, deadline)
+            except OSError as error:
+                raise HighmarkReportError(f'report file could not be read: {error}')
+
+        raise HighmarkReportError(f'unsupported report url {url!r}')
+
+    def get_score(self, url):
+        '''Returns the score of the report at url, from the cache when it was read before.
+        Raises HighmarkReportError when the report cannot be read or has no score.'''
+
+        score = self._cached(url)
+        if score is not None:
+            metrics.inc('online_leads_highmark_report_total', result='hit')
+            return score
+
+        if not allowed_url(url, self.allowed_schemes, self.allowed_hosts, self.allow_file_urls):
+            metrics.inc('online_leads_highmark_report_total', result='not_allowed')
+            raise HighmarkReportError(f'report url {url!r} is not allowed')
+
+        try:
+            with metrics.timed('highmark_report'):
+                score = self.fetch_score(url)
+        except HighmarkReportError:
+            metrics.inc('online_leads_highmark_report_total', result='error')
+            raise
+
+        metrics.inc('online_leads_highmark_report_total', result='miss')
+        self._store(url, score)
+        return score
+
+    def clear(self):
+        '''Drops every cached score.'''
+
+        with self._lock:
+            self._scores.clear()
+
+    def __len__(self):
+        return len(self._scores)
+
+
+#====================================================================================
+# Module level fetcher
+#====================================================================================
+_fetcher = None
+_fetcher_lock = threading.Lock()
+
+
+def get_fetcher():
+    '''Returns the process wide HighmarkReportFetcher, created on first use.'''
+
+    global _fetcher
+
+    if _fetcher is None:
+        with _fetcher_lock:
+            if _fetcher is None:
+                _fetcher = HighmarkReportFetcher()
+    return _fetcher
+
+
+def get_score(url):
+    '''Returns the score of the Highmark report at url, see HighmarkReportFetcher.get_score().'''
+
+    return get_fetcher().get_score(url)
@@ -0,0 +1,250 @@
+"""
+Buffered writer for the api call history table.
+
+Responses no longer wait on the history insert: rows are put on a bounded in-process queue
+and a worker thread writes them in batches of up to HIST_BATCH_SIZE rows, at least every
+HIST_FLUSH_INTERVAL_SECONDS. Whatever is still queued is written when the worker stops.
+With the database pool enabled (db_pool), a batch is one executemany on a pooled connection.
+
+"""
+
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
+from utilities import api_validation_function as avf
+from online_leads import db_pool
+from online_leads import metrics
+
+
+logger = logging.getLogger(__name__)
+
+# maximum number of history rows waiting to be written
+HIST_QUEUE_MAX_SIZE = int(os.environ.get('LOS_HIST_QUEUE_MAX_SIZE', 10000))
+
+# maximum number of rows written in one batch
+HIST_BATCH_SIZE = int(os.environ.get('LOS_HIST_BATCH_SIZE', 200))
+
+# maximum seconds a row waits in the queue before its batch is written
+HIST_FLUSH_INTERVAL_SECONDS = float(os.environ.get('LOS_HIST_FLUSH_INTERVAL_SECONDS', 0.5))
+
+# what to do when the queue is full, "sync" writes the row in the request thread, "drop" discards it
+HIST_OVERFLOW_POLICY = os.environ.get('LOS_HIST_OVERFLOW_POLICY', 'sync')
+
+_STOP = object()
+
+
+def write_rows_one_by_one(rows):
+    '''Default sink, writes each row through avf.add_api_call_hist_data, with the request
+    redacted as db_pool.write_history_rows does.'''
+
+    for row in rows:
+        avf.add_api_call_hist_data(**dict(row, api_request=db_pool.history_request(row['api_request'])))
+
+
+class HistoryWriter(object):
+    '''Bounded queue of history rows drained by a background worker thread.
+
+    sink - callable(rows) writing a list of rows, each row holding the keyword arguments
+           of avf.add_api_call_hist_data. db_pool.write_history_rows when the database pool
+           is enabled, write_rows_one_by_one otherwise.'''
+
+    def __init__(self,
+                 sink = None,
+                 max_queue_size = HIST_QUEUE_MAX_SIZE,
+                 batch_size = HIST_BATCH_SIZE,
+                 flush_interval_seconds = HIST_FLUSH_INTERVAL_SECONDS,
+                 overflow_policy = HIST_OVERFLOW_POLICY):
+
+        if overflow_policy not in ('sync', 'drop'):
+            raise ValueError(f'overflow_policy should be "sync" or "drop", got {overflow_policy}')
+
+        self.sink = sink or (db_pool.write_history_rows if db_pool.enabled() else write_rows_one_by_one)
+        self.batch_size = batch_size
+        self.flush_interval_seconds = flush_interval_seconds
+        self.overflow_policy = overflow_policy
+
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stats = {'enqueued': 0,
+                       'written': 0,
+                       'batches': 0,
+                       'failed': 0,
+                       'overflow_sync_writes': 0,
+                       'dropped': 0,
+                       'queue_high_water': 0}
+
+    def add_api_call_hist_data(self, api_name, api_error_label, api_status, logic_status, api_request, api_response):
+        '''Queues one history row, same arguments as avf.add_api_call_hist_data.'''
+
+        row = {'api_name': api_name,
+               'api_error_label': api_error_label,
+               'api_status': api_status,
+               'logic_status': logic_status,
+               'api_request': api_request,
+               'api_response': api_response}
+
+        thread = self._thread
+        if thread is None or not thread.is_alive():
+            # not started yet, or lost: threads do not survive a fork and the worker may have died
+            self.start()
+
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            self._overflow(row)
+            return
+
+        with self._lock:
+            self._stats['enqueued'] += 1
+            queue_size = self._queue.qsize()
+            if queue_size > self._stats['queue_high_water']:
+                self._stats['queue_high_water'] = queue_size
+
+    def stats(self):
+        '''Returns a copy of the writer counters along with the current queue size.'''
+
+        with self._lock:
+            stats = dict(self._stats)
+        stats['queue_size'] = self._queue.qsize()
+        return stats
+
+    def start(self):
+        '''Starts the worker thread.'''
+
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+
+            self._thread = threading.Thread(target=self._run, name='hist-writer', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=10):
+        '''Stops the worker thread after every queued row has been written. Without a running
+        worker thread, the queued rows are written in the calling thread.'''
+
+        thread = self._thread
+        if thread is not None and thread.is_alive():
+            self._queue.put(_STOP)
+            thread.join(timeout=timeout)
+        else:
+            self._drain()
+        self._thread = None
+
+    def _overflow(self, row):
+        if self.overflow_policy == 'sync':
+            with self._lock:
+                self._stats['overflow_sync_writes'] += 1
+            metrics.inc('online_leads_hist_rows_total', result='overflow_sync')
+            self._write([row])
+        else:
+            with self._lock:
+                self._stats['dropped'] += 1
+            metrics.inc('online_leads_hist_rows_total', result='dropped')
+            logger.warning('history queue full, row dropped for %s', row['api_name'])
+
+    def _write(self, rows):
+        try:
+            with metrics.timed('hist_write_batch'):
+                self.sink(rows)
+        except Exception:
+            logger.exception('writing %s history rows failed', len(rows))
+            with self._lock:
+                self._stats['failed'] += len(rows)
+            metrics.inc('online_leads_hist_rows_total', len(rows), result='failed')
+            return
+
+        with self._lock:
+            self._stats['written'] += len(rows)
+            self._stats['batches'] += 1
+        metrics.inc('online_leads_hist_rows_total', len(rows), result='written')
+
+    def _run(self):
+        stopping = False
+
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+
+            # collect a batch until it is full or the flush interval has passed
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval_seconds
+
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            self._write(batch)
+
+        self._drain()
+
+    def _drain(self):
+        '''Writes whatever is left on the queue.'''
+
+        batch = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                continue
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                self._write(batch)
+                batch = []
+        if batch:
+            self._write(batch)
+
+
+#====================================================================================
+# Module level writer
+#====================================================================================
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    '''Returns the process wide HistoryWriter, created on first use.'''
+
+    global _writer
+
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = HistoryWriter()
+                _writer.start()
+                atexit.register(_writer.stop)
+    return _writer
+
+
+def add_api_call_hist_data(api_name, api_error_label, api_status, logic_status, api_request, api_response):
+    '''Drop-in replacement of avf.add_api_call_hist_data that does not wait on the insert.
+    Every exit path of the API goes through here, so the response counters are kept here too.'''
+
+    with metrics.timed('add_api_call_hist_data'):
+        get_writer().add_api_call_hist_data(api_name,
+                                            api_error_label=api_error_label,
+                                            api_status=api_status,
+                                            logic_status=logic_status,
+                                            api_request=api_request,
+                                            api_response=api_response)
+
+    body = (api_response.get('body') or {}) if isinstance(api_response, dict) else {}
+    metrics.inc('online_leads_responses_total', error_response_code=body.get('error_response_code', 'NA'))
+    if logic_status == 'fail':
+        metrics.inc('online_leads_failures_total', label=api_error_label)
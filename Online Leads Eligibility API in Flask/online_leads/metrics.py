@@ -0,0 +1,342 @@
+"""
+Latency histograms, counters and gauges for the online leads eligibility API, in Prometheus text format.
+
+Stages are timed with time.perf_counter and aggregated in memory per process. When
+LOS_METRICS_DIR is set, every gunicorn worker writes its totals to its own file in that
+directory every LOS_METRICS_FLUSH_SECONDS, and once more when it exits, and the metrics route
+adds up the files of all workers, gauges included (e.g. the number of workers with an open
+circuit). Clear the directory when the service (re)starts, as with prometheus_client.
+
+"""
+
+import atexit
+import bisect
+import glob
+import json
+import logging
+import os
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# shared directory for the per worker metric files, metrics are per process when not set
+METRICS_DIR = os.environ.get('LOS_METRICS_DIR')
+
+# seconds between two writes of the worker metric file
+METRICS_FLUSH_SECONDS = float(os.environ.get('LOS_METRICS_FLUSH_SECONDS', 5))
+
+# latency histogram buckets in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+METRIC_HELP = {
+    'online_leads_stage_seconds': 'Latency of the stages of the online leads eligibility API.',
+    'online_leads_request_seconds': 'Latency of the online leads eligibility API requests.',
+    'online_leads_responses_total': 'Responses by error_response_code.',
+    'online_leads_failures_total': 'Failed checks by api_error_label.',
+    'online_leads_hist_rows_total': 'History rows by result of the buffered history writer.',
+}
+
+
+class Histogram(object):
+    '''Latency histogram, the per bucket counts are made cumulative when rendered.'''
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        idx = bisect.bisect_left(self.buckets, value)
+        if idx < len(self.counts):
+            self.counts[idx] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry(object):
+    '''Counters, gauges and histograms of the current process.'''
+
+    def __init__(self):
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def snapshot(self):
+        '''Returns the current values as a JSON serializable dict.'''
+
+        with self._lock:
+            return {'counters': [[name, list(labels), value]
+                                 for (name, labels), value in self._counters.items()],
+                    'gauges': [[name, list(labels), value]
+                               for (name, labels), value in self._gauges.items()],
+                    'histograms': [[name, list(labels), list(histogram.buckets), list(histogram.counts),
+                                    histogram.sum, histogram.count]
+                                   for (name, labels), histogram in self._histograms.items()]}
+
+
+class Timer(object):
+    '''Context manager observing the elapsed time of a stage.'''
+
+    __slots__ = ('stage', 'started_at')
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        observe('online_leads_stage_seconds', time.perf_counter() - self.started_at, stage=self.stage)
+        return False
+
+
+REGISTRY = Registry()
+
+
+def inc(name, value=1, **labels):
+    '''Increments a counter of the current process.'''
+
+    _ensure_flusher()
+    REGISTRY.inc(name, value, **labels)
+
+
+def set_gauge(name, value, **labels):
+    '''Sets a gauge of the current process.'''
+
+    _ensure_flusher()
+    REGISTRY.set_gauge(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    '''Observes a value in a histogram of the current process.'''
+
+    _ensure_flusher()
+    REGISTRY.observe(name, value, **labels)
+
+
+def timed(stage):
+    '''with metrics.timed("check_pincode"): ... observes the latency of the block.'''
+
+    return Timer(stage)
+
+
+#====================================================================================
+# Multi process aggregation
+#====================================================================================
+_flusher = None
+_flusher_lock = threading.Lock()
+
+
+def _worker_file(pid=None):
+    return os.path.join(METRICS_DIR, f'metrics_{pid or os.getpid()}.json')
+
+
+def flush():
+    '''Writes the metrics of the current process to its file in METRICS_DIR.'''
+
+    if not METRICS_DIR:
+        return
+
+    pid = os.getpid()
+    snapshot = REGISTRY.snapshot()
+    # the start time tells this worker apart from a later process given the same pid
+    snapshot['worker'] = {'pid': pid, 'started': _process_started(pid)}
+
+    path = _worker_file(pid)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as tmp_file:
+        json.dump(snapshot, tmp_file)
+    os.replace(tmp_path, path)
+
+
+def _flush_at_exit():
+    try:
+        flush()
+    except OSError:
+        logger.exception('writing metrics file at exit failed')
+
+
+def _run_flusher():
+    while True:
+        time.sleep(METRICS_FLUSH_SECONDS)
+        try:
+            flush()
+        except OSError:
+            logger.exception('writing metrics file failed')
+
+
+def _ensure_flusher():
+    global _flusher
+
+    if not METRICS_DIR or (_flusher is not None and _flusher.is_alive()):
+        return
+
+    with _flusher_lock:
+        # a forked worker inherits the variable but not the thread
+        if _flusher is None or not _flusher.is_alive():
+            if _flusher is None:
+                # inherited by forked workers, each flushes its own file
+                atexit.register(_flush_at_exit)
+            _flusher = threading.Thread(target=_run_flusher, name='metrics-flusher', daemon=True)
+            _flusher.start()
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _process_started(pid):
+    '''Start time of a process in clock ticks after boot, None when /proc cannot tell.'''
+
+    try:
+        with open(f'/proc/{pid}/stat', 'rb') as stat_file:
+            stat = stat_file.read()
+    except OSError:
+        return None
+
+    # fields after the command name, which may hold spaces and parentheses; starttime is field 22
+    fields = stat[stat.rfind(b')') + 2:].split()
+    try:
+        return int(fields[19])
+    except (IndexError, ValueError):
+        return None
+
+
+def _worker_alive(worker):
+    pid, started = worker.get('pid'), worker.get('started')
+    if not isinstance(pid, int) or not _pid_alive(pid):
+        return False
+    if started is None:
+        return True
+    current = _process_started(pid)
+    # another process reusing the pid of an exited worker started later
+    return current is None or current == started
+
+
+def collect():
+    '''Returns the snapshots of every worker, or of the current process only. The counters and
+    histograms of a worker which has exited are kept, its gauges are dropped: they describe
+    state (requests in flight, open circuits) which ended with the worker.'''
+
+    if not METRICS_DIR:
+        return [REGISTRY.snapshot()]
+
+    flush()
+
+    snapshots = []
+    for path in glob.glob(os.path.join(METRICS_DIR, 'metrics_*.json')):
+        try:
+            with open(path, 'r', encoding='utf-8') as worker_file:
+                snapshot = json.load(worker_file)
+        except (OSError, ValueError):
+            logger.warning('skipping unreadable metrics file %s', path)
+            continue
+
+        if not _worker_alive(snapshot.get('worker', {})):
+            snapshot['gauges'] = []
+        snapshots.append(snapshot)
+    return snapshots
+
+
+#====================================================================================
+# Prometheus text format
+#====================================================================================
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in pairs) + '}'
+
+
+def render(snapshots=None):
+    '''Adds up the snapshots and renders them in Prometheus text format.'''
+
+    if snapshots is None:
+        snapshots = collect()
+
+    counters = {}
+    gauges = {}
+    histograms = {}
+
+    for snapshot in snapshots:
+        for name, labels, value in snapshot['counters']:
+            key = (name, tuple(tuple(label) for label in labels))
+            counters[key] = counters.get(key, 0) + value
+
+        for name, labels, value in snapshot.get('gauges', ()):
+            key = (name, tuple(tuple(label) for label in labels))
+            gauges[key] = gauges.get(key, 0) + value
+
+        for name, labels, buckets, counts, total, count in snapshot['histograms']:
+            key = (name, tuple(tuple(label) for label in labels))
+            merged = histograms.get(key)
+            if merged is None:
+                merged = histograms[key] = Histogram(buckets)
+            for idx, bucket_count in enumerate(counts):
+                merged.counts[idx] += bucket_count
+            merged.sum += total
+            merged.count += count
+
+    lines = []
+    described = set()
+
+    def describe(name, metric_type):
+        if name not in described:
+            described.add(name)
+            lines.append(f'# HELP {name} {METRIC_HELP.get(name, name)}')
+            lines.append(f'# TYPE {name} {metric_type}')
+
+    for (name, labels), value in sorted(counters.items()):
+        describe(name, 'counter')
+        lines.append(f'{name}{_labels(labels)} {value}')
+
+    for (name, labels), value in sorted(gauges.items()):
+        describe(name, 'gauge')
+        lines.append(f'{name}{_labels(labels)} {value}')
+
+    for (name, labels), histogram in sorted(histograms.items()):
+        describe(name, 'histogram')
+        cumulative = 0
+        for bucket, bucket_count in zip(histogram.buckets, histogram.counts):
+            cumulative += bucket_count
+            lines.append(f'{name}_bucket{_labels(labels, [("le", bucket)])} {cumulative}')
+        lines.append(f'{name}_bucket{_labels(labels, [("le", "+Inf")])} {histogram.count}')
+        lines.append(f'{name}_sum{_labels(labels)} {histogram.sum}')
+        lines.append(f'{name}_count{_labels(labels)} {histogram.count}')
+
+    return '\n'.join(lines) + '\n'
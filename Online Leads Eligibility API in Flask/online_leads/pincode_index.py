@@ -0,0 +1,331 @@
+"""
+Local pincode serviceability index for the online leads eligibility API.
+
+The serviceable pincodes are held in a 1,000,000 bit bitmap (125 KB), so a check is one
+bit test instead of a call to the Pincode Eng API. The bitmap is loaded from a snapshot
+file (one pincode per line, first CSV column) and rebuilt when the file changes; the new
+bitmap replaces the old one in a single assignment. Publish new snapshots by writing a
+temporary file and renaming it over the old one.
+
+A compiled reference_snapshot, when configured, is asked before this index.
+
+The Pincode Eng API (lf.check_pincode) is only called when no snapshot is loaded, and by
+reconcile() to compare the snapshot against it. Those calls go through a circuit breaker with
+a deadline per call (see circuit_breaker). While the circuit is open, or when a call fails,
+the pincode is answered from the last known good set: the answers the API gave before and
+the pincodes of the LOS_PINCODE_LAST_KNOWN_GOOD_PATH file.
+
+"""
+
+import logging
+import os
+import threading
+
+from los import los_function as lf
+from online_leads import metrics
+from online_leads import reference_snapshot
+from online_leads import request_profiler
+from online_leads.circuit_breaker import CircuitBreaker
+from online_leads.snapshot_watcher import SnapshotWatcher
+
+
+logger = logging.getLogger(__name__)
+
+# snapshot of serviceable pincodes, the remote API is used while this is not set
+PINCODE_SNAPSHOT_PATH = os.environ.get('LOS_PINCODE_SNAPSHOT_PATH')
+
+# seconds between two checks of the snapshot file for changes
+PINCODE_RELOAD_CHECK_SECONDS = float(os.environ.get('LOS_PINCODE_RELOAD_CHECK_SECONDS', 30))
+
+# 6 digit pincodes fit in 0 .. 999999
+PINCODE_SPACE = 1000000
+
+# circuit breaker around the Pincode Eng API, see circuit_breaker.CircuitBreaker
+PINCODE_API_TIMEOUT_SECONDS = float(os.environ.get('LOS_PINCODE_API_TIMEOUT_SECONDS', 2))
+PINCODE_BREAKER_WINDOW_SECONDS = float(os.environ.get('LOS_PINCODE_BREAKER_WINDOW_SECONDS', 30))
+PINCODE_BREAKER_MIN_CALLS = int(os.environ.get('LOS_PINCODE_BREAKER_MIN_CALLS', 20))
+PINCODE_BREAKER_FAILURE_RATE = float(os.environ.get('LOS_PINCODE_BREAKER_FAILURE_RATE', 0.5))
+PINCODE_BREAKER_OPEN_SECONDS = float(os.environ.get('LOS_PINCODE_BREAKER_OPEN_SECONDS', 15))
+PINCODE_BREAKER_HALF_OPEN_CALLS = int(os.environ.get('LOS_PINCODE_BREAKER_HALF_OPEN_CALLS', 3))
+
+# seconds before a second attempt of a slow call is started, 0 disables hedging
+PINCODE_HEDGE_AFTER_SECONDS = float(os.environ.get('LOS_PINCODE_HEDGE_AFTER_SECONDS', 0))
+
+# threads making the Pincode Eng API calls
+PINCODE_API_WORKERS = int(os.environ.get('LOS_PINCODE_API_WORKERS', 16))
+
+# Pincode Eng API calls running at a time, the ones abandoned at their deadline included; a call
+# above that fails at once and is answered from the last known good set
+PINCODE_API_MAX_IN_FLIGHT = int(os.environ.get('LOS_PINCODE_API_MAX_IN_FLIGHT', PINCODE_API_WORKERS))
+
+# serviceable pincodes used while the Pincode Eng API is unavailable, same format as the snapshot
+PINCODE_LAST_KNOWN_GOOD_PATH = os.environ.get('LOS_PINCODE_LAST_KNOWN_GOOD_PATH')
+
+# answer for a pincode the last known good set knows nothing about. Not serviceable (252) by
+# default: a lead is not approved on a pincode nobody checked, and the answer is not stored,
+# so the lead is decided again once the API is back
+PINCODE_FALLBACK_SERVICEABLE = os.environ.get('LOS_PINCODE_FALLBACK_SERVICEABLE', 'false').lower() == 'true'
+
+metrics.METRIC_HELP['online_leads_pincode_fallback_total'] = 'Pincodes answered from the last known good set, by source.'
+
+
+def parse_pincode(pincode):
+    '''Returns the pincode as an int in 0 .. 999999, or None if it is not a valid pincode.'''
+
+    try:
+        value = int(str(pincode).strip())
+    except ValueError:
+        try:
+            value = float(pincode)
+        except (TypeError, ValueError):
+            return None
+        if not value.is_integer():
+            return None
+        value = int(value)
+
+    if 0 <= value < PINCODE_SPACE:
+        return value
+    return None
+
+
+class PincodeIndex(object):
+    '''Immutable bitmap of serviceable pincodes.'''
+
+    __slots__ = ('bitmap', 'count', 'version')
+
+    def __init__(self, bitmap, count, version):
+        self.bitmap = bytes(bitmap)
+        self.count = count
+        self.version = version
+
+    @classmethod
+    def from_pincodes(cls, pincodes, version=None):
+        '''Builds the index from an iterable of pincodes, invalid entries are skipped.'''
+
+        bitmap = bytearray(PINCODE_SPACE // 8)
+        count = 0
+
+        for pincode in pincodes:
+            value = parse_pincode(pincode)
+            if value is None:
+                continue
+            byte, bit = divmod(value, 8)
+            if not bitmap[byte] & (1 << bit):
+                bitmap[byte] |= 1 << bit
+                count += 1
+
+        return cls(bitmap, count, version)
+
+    @classmethod
+    def from_snapshot(cls, path, version=None):
+        '''Builds the index from a snapshot file, one pincode per line or in the first CSV column.'''
+
+        with open(path, 'r', encoding='utf-8') as snapshot:
+            return cls.from_pincodes((line.split(',', 1)[0] for line in snapshot), version=version)
+
+    def __contains__(self, pincode):
+        value = parse_pincode(pincode)
+        if value is None:
+            return False
+        byte, bit = divmod(value, 8)
+        return bool(self.bitmap[byte] & (1 << bit))
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for byte_idx, byte in enumerate(self.bitmap):
+            if byte:
+                for bit in range(8):
+                    if byte & (1 << bit):
+                        yield byte_idx * 8 + bit
+
+
+class PincodeServiceability(SnapshotWatcher):
+    '''Keeps a PincodeIndex loaded from a snapshot file and reloads it when the file changes.'''
+
+    def __init__(self,
+                 snapshot_path = PINCODE_SNAPSHOT_PATH,
+                 reload_check_seconds = PINCODE_RELOAD_CHECK_SECONDS):
+
+        super().__init__(paths=(snapshot_path,),
+                         build=_build_index,
+                         reload_check_seconds=reload_check_seconds,
+                         name='pincode index')
+        self.snapshot_path = snapshot_path
+
+    @property
+    def index(self):
+        '''The current PincodeIndex, None until a snapshot is loaded.'''
+
+        return self.value
+
+    def load(self, pincodes, version=None):
+        '''Replaces the index with one built from an iterable of pincodes,
+        e.g. rows read from the serviceable pincode table.'''
+
+        return self.replace(PincodeIndex.from_pincodes(pincodes, version=version), version)
+
+    def is_serviceable(self, pincode):
+        '''Returns True or False from the local index, None if no index is loaded.'''
+
+        index = self.value
+        if index is None:
+            return None
+        return pincode in index
+
+
+def _build_index(paths):
+    snapshot_path, = paths
+    index = PincodeIndex.from_snapshot(snapshot_path, version=os.stat(snapshot_path).st_mtime_ns)
+    if index.count == 0:
+        raise ValueError(f'pincode snapshot {snapshot_path} is empty')
+    return index
+
+
+class LastKnownGood(object):
+    '''Answers of the Pincode Eng API seen so far, kept as two bitmaps (serviceable and not
+    serviceable), seeded with the serviceable pincodes of a snapshot file.'''
+
+    def __init__(self, seed_path=PINCODE_LAST_KNOWN_GOOD_PATH):
+        self._serviceable = bytearray(PINCODE_SPACE // 8)
+        self._not_serviceable = bytearray(PINCODE_SPACE // 8)
+
+        if seed_path:
+            try:
+                seed = PincodeIndex.from_snapshot(seed_path)
+            except OSError:
+                logger.exception('last known good pincodes %s could not be read', seed_path)
+            else:
+                self._serviceable[:] = seed.bitmap
+                logger.info('loaded %s last known good pincodes from %s', seed.count, seed_path)
+
+    def record(self, pincode, is_serviceable):
+        value = parse_pincode(pincode)
+        if value is None:
+            return
+        byte, bit = divmod(value, 8)
+        known, other = ((self._serviceable, self._not_serviceable) if is_serviceable else
+                        (self._not_serviceable, self._serviceable))
+        known[byte] |= 1 << bit
+        other[byte] &= ~(1 << bit) & 0xFF
+
+    def lookup(self, pincode):
+        '''Returns the last known answer for a pincode, None if it is not known.'''
+
+        value = parse_pincode(pincode)
+        if value is None:
+            return None
+        byte, bit = divmod(value, 8)
+        if self._serviceable[byte] & (1 << bit):
+            return True
+        if self._not_serviceable[byte] & (1 << bit):
+            return False
+        return None
+
+
+#====================================================================================
+# Module level index
+#====================================================================================
+_serviceability = None
+_serviceability_lock = threading.Lock()
+
+_breaker = None
+_last_known_good = None
+_remote_lock = threading.Lock()
+
+
+def get_serviceability():
+    '''Returns the process wide PincodeServiceability, started on first use.'''
+
+    global _serviceability
+
+    if _serviceability is None:
+        with _serviceability_lock:
+            if _serviceability is None:
+                serviceability = PincodeServiceability()
+                serviceability.start()
+                _serviceability = serviceability
+    return _serviceability
+
+
+def get_breaker():
+    '''Returns the process wide circuit breaker of the Pincode Eng API and its last known good set.'''
+
+    global _breaker, _last_known_good
+
+    if _breaker is None:
+        with _remote_lock:
+            if _breaker is None:
+                _last_known_good = LastKnownGood()
+                _breaker = CircuitBreaker('pincode_api',
+                                          call_timeout_seconds=PINCODE_API_TIMEOUT_SECONDS,
+                                          window_seconds=PINCODE_BREAKER_WINDOW_SECONDS,
+                                          min_calls=PINCODE_BREAKER_MIN_CALLS,
+                                          failure_rate_threshold=PINCODE_BREAKER_FAILURE_RATE,
+                                          open_seconds=PINCODE_BREAKER_OPEN_SECONDS,
+                                          half_open_max_calls=PINCODE_BREAKER_HALF_OPEN_CALLS,
+                                          hedge_after_seconds=PINCODE_HEDGE_AFTER_SECONDS,
+                                          max_workers=PINCODE_API_WORKERS,
+                                          max_in_flight=PINCODE_API_MAX_IN_FLIGHT)
+    return _breaker
+
+
+def remote_check_pincode(business_pincode, request_data=None, api_name=None):
+    '''lf.check_pincode through the circuit breaker. Answers from the last known good set
+    while the circuit is open or when the call fails or misses its deadline.'''
+
+    breaker = get_breaker()
+
+    try:
+        is_pincode = bool(breaker.call(request_profiler.sampled_call, lf.check_pincode, business_pincode,
+                                       request_data=request_data, api_name=api_name))
+    except Exception as error:
+        is_pincode = _last_known_good.lookup(business_pincode)
+        if is_pincode is None:
+            metrics.inc('online_leads_pincode_fallback_total', source='default')
+            is_pincode = PINCODE_FALLBACK_SERVICEABLE
+        else:
+            metrics.inc('online_leads_pincode_fallback_total', source='last_known_good')
+        # a fallback answer is not stored for redelivered leads, imported here as result_cache imports this module
+        from online_leads import result_cache
+        result_cache.skip()
+        logger.debug('pincode %s answered %s without the Pincode Eng API: %s', business_pincode, is_pincode, error)
+        return is_pincode
+
+    _last_known_good.record(business_pincode, is_pincode)
+    return is_pincode
+
+
+def check_pincode(business_pincode, request_data=None, api_name=None):
+    '''Drop-in replacement of lf.check_pincode answered from the reference snapshot or the local
+    index. Falls back to the Pincode Eng API, through its circuit breaker, while neither is loaded.'''
+
+    snapshot = reference_snapshot.current()
+    is_pincode = snapshot.is_serviceable(business_pincode) if snapshot is not None else None
+    if is_pincode is None:
+        is_pincode = get_serviceability().is_serviceable(business_pincode)
+    if is_pincode is None:
+        return remote_check_pincode(business_pincode, request_data=request_data, api_name=api_name)
+    return is_pincode
+
+
+def reconcile(pincodes, request_data=None, api_name=None):
+    '''Compares the local index against the Pincode Eng API for the given pincodes.
+    Returns a list of (pincode, local_result, remote_result) for every mismatch.'''
+
+    pincodes = list(pincodes)
+    serviceability = get_serviceability()
+    mismatches = []
+
+    for pincode in pincodes:
+        local_result = serviceability.is_serviceable(pincode)
+        remote_result = bool(lf.check_pincode(str(pincode), request_data=request_data, api_name=api_name))
+        if local_result != remote_result:
+            mismatches.append((pincode, local_result, remote_result))
+
+    if mismatches:
+        logger.warning('pincode index differs from the Pincode Eng API for %s of %s pincodes',
+                       len(mismatches), len(pincodes))
+
+    return mismatches
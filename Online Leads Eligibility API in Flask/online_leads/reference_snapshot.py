@@ -0,0 +1,304 @@
+"""
+Binary reference data snapshot shared by the workers through a read-only memory map.
+
+An offline compile step writes the thresholds, the serviceable pincodes and the excluded
+sectors and sub-sectors into one file. Every worker maps the file read-only and answers from
+it in place: the pincodes are the 125 KB bitmap of pincode_index, the excluded sector and
+sub-sector keys are sorted arrays of 64 bit hashes searched with bisect. Nothing is
+deserialized into per-worker objects except the few threshold values, so the pages are
+shared through the page cache and the memory of a worker does not grow with the data.
+
+    python -m online_leads.reference_snapshot --output /srv/los/reference.snap \\
+        --pincodes serviceable_pincodes.csv \\
+        --excluded-sectors excluded_sectors.csv --excluded-subsectors excluded_subsectors.csv \\
+        --thresholds los/v1/online_leads_eligibility
+
+The file is written next to the target and renamed over it, so a new version is published
+atomically. Workers check LOS_REFERENCE_SNAPSHOT_PATH every LOS_REFERENCE_RELOAD_CHECK_SECONDS
+and map the new file; requests holding the previous snapshot finish on it. Data missing from
+the snapshot (a section not compiled in) is answered by the existing indexes and lf.
+
+File layout, little endian:
+    header   - magic, format version, section count, created_at, crc32 of the sections
+    sections - (name, offset, length) per section, each section aligned to 8 bytes
+    META     - JSON: created_at, counts and the thresholds per api_name
+    PINC     - pincode bitmap, bit p set when pincode p is serviceable
+    SECT     - sorted uint64 hashes of the excluded (main sector, business type) keys
+    SUBS     - sorted uint64 hashes of the excluded (main sector, business type, specific sector) keys
+
+"""
+
+import argparse
+import bisect
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+from online_leads import pincode_index
+from online_leads import sector_index
+from online_leads import threshold_cache
+from online_leads.snapshot_watcher import SnapshotWatcher
+
+
+logger = logging.getLogger(__name__)
+
+# compiled snapshot, the existing indexes and lf are used while this is not set
+REFERENCE_SNAPSHOT_PATH = os.environ.get('LOS_REFERENCE_SNAPSHOT_PATH')
+
+# seconds between two checks of the snapshot file for a new version
+REFERENCE_RELOAD_CHECK_SECONDS = float(os.environ.get('LOS_REFERENCE_RELOAD_CHECK_SECONDS', 10))
+
+MAGIC = b'OLREFSNP'
+FORMAT_VERSION = 1
+
+_HEADER = struct.Struct('<8sIIQI')
+_SECTION = struct.Struct('<4sQQ')
+
+SECTION_META = b'META'
+SECTION_PINCODES = b'PINC'
+SECTION_SECTORS = b'SECT'
+SECTION_SUBSECTORS = b'SUBS'
+
+
+def key_hash(*values):
+    '''64 bit hash of a normalized sector key, the same in every process.'''
+
+    key = '\x1f'.join(sector_index.normalize(value) for value in values).encode('utf-8')
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little')
+
+
+#====================================================================================
+# Compile
+#====================================================================================
+def _hash_array(rows, width):
+    hashes = sorted({key_hash(*row[:width]) for row in rows
+                     if len(row) >= width and any(str(cell).strip() for cell in row)})
+    return struct.pack(f'<{len(hashes)}Q', *hashes), len(hashes)
+
+
+def compile_snapshot(path, pincodes=None, excluded_sector_rows=None, excluded_subsector_rows=None,
+                     thresholds=None):
+    '''Writes a snapshot file and publishes it atomically at path.
+
+    pincodes                - iterable of serviceable pincodes
+    excluded_sector_rows    - rows of (business_main_sector, business_type)
+    excluded_subsector_rows - rows of (business_main_sector, business_type, business_specific_sector)
+    thresholds              - {api_name: threshold_cache.Thresholds}
+    A section is left out when its data is None.'''
+
+    created_at = int(time.time())
+    meta = {'created_at': created_at}
+    sections = []
+
+    if pincodes is not None:
+        index = pincode_index.PincodeIndex.from_pincodes(pincodes)
+        sections.append((SECTION_PINCODES, index.bitmap))
+        meta['pincodes'] = index.count
+
+    if excluded_sector_rows is not None:
+        data, meta['excluded_sectors'] = _hash_array(excluded_sector_rows, 2)
+        sections.append((SECTION_SECTORS, data))
+
+    if excluded_subsector_rows is not None:
+        data, meta['excluded_subsectors'] = _hash_array(excluded_subsector_rows, 3)
+        sections.append((SECTION_SUBSECTORS, data))
+
+    if thresholds:
+        meta['thresholds'] = {api_name: {key: getattr(values, field) for key, field in threshold_cache.THRESHOLD_KEYS}
+                              for api_name, values in thresholds.items()}
+
+    sections.insert(0, (SECTION_META, json.dumps(meta, sort_keys=True).encode('utf-8')))
+
+    # section table, then every section aligned to 8 bytes
+    offset = _HEADER.size + _SECTION.size * len(sections)
+    table = []
+    body = bytearray()
+    for name, data in sections:
+        padding = -(offset + len(body)) % 8
+        body += b'\0' * padding
+        table.append(_SECTION.pack(name, offset + len(body), len(data)))
+        body += data
+
+    sections_bytes = b''.join(table) + bytes(body)
+    header = _HEADER.pack(MAGIC, FORMAT_VERSION, len(sections), created_at, zlib.crc32(sections_bytes))
+
+    directory = os.path.dirname(os.path.abspath(path))
+    tmp_path = os.path.join(directory, f'.{os.path.basename(path)}.{os.getpid()}.tmp')
+    with open(tmp_path, 'wb') as snapshot_file:
+        snapshot_file.write(header)
+        snapshot_file.write(sections_bytes)
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+    os.replace(tmp_path, path)
+
+    logger.info('reference snapshot written to %s: %s', path, meta)
+    return meta
+
+
+#====================================================================================
+# Read
+#====================================================================================
+class ReferenceSnapshot(object):
+    '''Read-only view of a snapshot file, queried in place through its memory map.'''
+
+    def __init__(self, path):
+        with open(path, 'rb') as snapshot_file:
+            self._map = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self._map) < _HEADER.size:
+            raise ValueError(f'reference snapshot {path} is truncated')
+
+        magic, format_version, section_count, created_at, checksum = _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or format_version != FORMAT_VERSION:
+            raise ValueError(f'reference snapshot {path} has an unknown format')
+
+        view = memoryview(self._map)
+        if zlib.crc32(view[_HEADER.size:]) != checksum:
+            raise ValueError(f'reference snapshot {path} is corrupted')
+
+        sections = {}
+        for idx in range(section_count):
+            name, offset, length = _SECTION.unpack_from(self._map, _HEADER.size + idx * _SECTION.size)
+            if offset + length > len(self._map):
+                raise ValueError(f'reference snapshot {path} is truncated')
+            sections[name] = view[offset:offset + length]
+
+        self.path = path
+        self.created_at = created_at
+        self.version = f'snapshot-{created_at}-{checksum:08x}'
+        self.meta = json.loads(bytes(sections[SECTION_META]))
+
+        pincodes = sections.get(SECTION_PINCODES)
+        if pincodes is not None and len(pincodes) != pincode_index.PINCODE_SPACE // 8:
+            raise ValueError(f'reference snapshot {path} has a pincode bitmap of {len(pincodes)} bytes')
+        self._pincodes = pincodes
+        self._sectors = self._hashes(sections.get(SECTION_SECTORS))
+        self._subsectors = self._hashes(sections.get(SECTION_SUBSECTORS))
+
+        self._thresholds = {api_name: threshold_cache.Thresholds(version=self.version,
+                                                                 **{field: int(values[key])
+                                                                    for key, field in threshold_cache.THRESHOLD_KEYS})
+                            for api_name, values in self.meta.get('thresholds', {}).items()}
+
+    @staticmethod
+    def _hashes(section):
+        # zero-copy uint64 view of the section, bisect works on it directly
+        return section.cast('Q') if section is not None else None
+
+    def is_serviceable(self, pincode):
+        '''True or False from the pincode bitmap, None when the snapshot has no pincodes.'''
+
+        if self._pincodes is None:
+            return None
+        value = pincode_index.parse_pincode(pincode)
+        if value is None:
+            return False
+        byte, bit = divmod(value, 8)
+        return bool(self._pincodes[byte] & (1 << bit))
+
+    def is_valid_sector(self, business_main_sector, business_type):
+        '''True if the sector is not excluded, None when the snapshot has no sectors.'''
+
+        if self._sectors is None:
+            return None
+        return not _contains(self._sectors, key_hash(business_main_sector, business_type))
+
+    def is_excluded_subsector(self, business_main_sector, business_type, business_specific_sector):
+        '''True if the sub-sector is excluded, None when the snapshot has no sub-sectors.'''
+
+        if self._subsectors is None:
+            return None
+        return _contains(self._subsectors, key_hash(business_main_sector, business_type, business_specific_sector))
+
+    def thresholds(self, api_name):
+        '''Thresholds of api_name, None when the snapshot has none for it.'''
+
+        return self._thresholds.get(api_name)
+
+
+def _contains(hashes, value):
+    idx = bisect.bisect_left(hashes, value)
+    return idx < len(hashes) and hashes[idx] == value
+
+
+#====================================================================================
+# Module level snapshot
+#====================================================================================
+_reference = None
+_reference_lock = threading.Lock()
+
+
+def get_reference():
+    '''Returns the process wide watcher of the snapshot file, started on first use.'''
+
+    global _reference
+
+    if _reference is None:
+        with _reference_lock:
+            if _reference is None:
+                reference = SnapshotWatcher(paths=(REFERENCE_SNAPSHOT_PATH,),
+                                            build=lambda paths: ReferenceSnapshot(*paths),
+                                            reload_check_seconds=REFERENCE_RELOAD_CHECK_SECONDS,
+                                            name='reference data')
+                reference.start()
+                _reference = reference
+    return _reference
+
+
+def current():
+    '''The current ReferenceSnapshot, None when none is configured or loaded.'''
+
+    if not REFERENCE_SNAPSHOT_PATH:
+        return None
+    return get_reference().value
+
+
+#====================================================================================
+# Command line
+#====================================================================================
+def _read_lines(path):
+    with open(path, 'r', encoding='utf-8') as lines:
+        return [line.split(',', 1)[0] for line in lines]
+
+
+def _read_thresholds(option):
+    '''Thresholds from API_NAME=los_thresholds CSV export, or from lf for API_NAME alone.'''
+
+    import pandas as pd
+
+    api_name, _, path = option.partition('=')
+    if path:
+        threshold_df = pd.read_csv(path)
+    else:
+        threshold_df = threshold_cache.lf.get_env_variables(api_name)
+    return api_name, threshold_cache.Thresholds.from_frame(threshold_df)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', required=True, help='snapshot file to publish')
+    parser.add_argument('--pincodes', help='serviceable pincodes, one per line or in the first CSV column')
+    parser.add_argument('--excluded-sectors', help='CSV of business_main_sector,business_type')
+    parser.add_argument('--excluded-subsectors', help='CSV of business_main_sector,business_type,business_specific_sector')
+    parser.add_argument('--thresholds', action='append', default=[], metavar='API_NAME[=CSV]',
+                        help='thresholds of an api_name, read from "los_thresholds" when no CSV is given')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    compile_snapshot(args.output,
+                     pincodes=_read_lines(args.pincodes) if args.pincodes else None,
+                     excluded_sector_rows=sector_index._read_rows(args.excluded_sectors) if args.excluded_sectors else None,
+                     excluded_subsector_rows=(sector_index._read_rows(args.excluded_subsectors)
+                                              if args.excluded_subsectors else None),
+                     thresholds=dict(_read_thresholds(option) for option in args.thresholds))
+
+
+if __name__ == '__main__':
+    main()
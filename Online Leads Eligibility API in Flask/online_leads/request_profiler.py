@@ -0,0 +1,343 @@
+"""
+On-demand profiling of single requests of the online leads eligibility API.
+
+A request is profiled when it carries the X-LOS-Profile header set to LOS_PROFILE_TOKEN, or
+for a share LOS_PROFILE_SAMPLE_RATE of the requests. A sampler thread then reads the stacks
+of the request thread, and of the threads working for the request, every LOS_PROFILE_INTERVAL_MS
+while the view runs, so the time spent in the avf and lf helpers, waiting on the database or
+the Pincode Eng API included, shows up under the frames which called them. Each sample is
+weighted by the wall time since the previous one, for every sampled thread, so a profile of
+concurrent lookups adds up to more than the request took. The profile is written to
+LOS_PROFILE_DIR as collapsed stacks (flamegraph.pl, speedscope, inferno; weights in
+microseconds) or as a speedscope JSON file, and its file name is sent back in the
+X-LOS-Profile-File response header.
+
+The threads working for a request are the async lookup threads and the circuit breaker call
+threads (Pincode Eng API): they run their calls through sampled_call() with a copy of the
+request context, and their stacks appear under a [thread name] frame. Work done later on other
+threads, such as the history rows written by hist_writer, is not part of the profile.
+
+With neither a token nor a sample rate configured, profiled() returns the view unchanged.
+Otherwise an unprofiled request costs a header lookup and a random draw, and only one request
+per worker is profiled at a time. Async views are sampled on the event loop thread; time
+spent awaiting the async lookups shows up as [awaiting] there, and under the lookup threads.
+
+"""
+
+import contextvars
+import functools
+import hmac
+import inspect
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+from flask import after_this_request, request
+
+from online_leads import metrics
+from online_leads import step_trace
+
+
+logger = logging.getLogger(__name__)
+
+# value of the X-LOS-Profile header which profiles a request, header triggered profiles are off when not set
+PROFILE_TOKEN = os.environ.get('LOS_PROFILE_TOKEN')
+
+# share of the requests profiled without the header
+PROFILE_SAMPLE_RATE = float(os.environ.get('LOS_PROFILE_SAMPLE_RATE', 0))
+
+# milliseconds between two samples of the request stack
+PROFILE_INTERVAL_MS = float(os.environ.get('LOS_PROFILE_INTERVAL_MS', 1))
+
+# "collapsed" or "speedscope"
+PROFILE_FORMAT = os.environ.get('LOS_PROFILE_FORMAT', 'collapsed')
+
+# directory the profiles are written to
+PROFILE_DIR = os.environ.get('LOS_PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'online_leads_profiles'))
+
+PROFILE_HEADER = 'X-LOS-Profile'
+PROFILE_FILE_HEADER = 'X-LOS-Profile-File'
+
+AWAITING = '[awaiting]'
+
+metrics.METRIC_HELP.update({
+    'online_leads_profiles_total': 'Profiled requests by trigger: header or sampled.',
+})
+
+_busy = threading.Lock()
+_sequence = itertools.count()
+
+# StackSampler of the profiled request, seen by the threads which run with a copy of its context
+_active_sampler = contextvars.ContextVar('online_leads_request_profiler', default=None)
+
+
+def enabled():
+    return bool(PROFILE_TOKEN) or PROFILE_SAMPLE_RATE > 0
+
+
+def _trigger():
+    '''header, sampled or None for a request which is not profiled.'''
+
+    header = request.headers.get(PROFILE_HEADER)
+    if header and PROFILE_TOKEN and hmac.compare_digest(header.encode('utf-8'), PROFILE_TOKEN.encode('utf-8')):
+        return 'header'
+    if PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+        return 'sampled'
+    return None
+
+
+def _label(code, module_name):
+    name = getattr(code, 'co_qualname', code.co_name)
+    return f'{module_name}.{name}' if module_name else name
+
+
+#====================================================================================
+# Sampler
+#====================================================================================
+def _walk(frame, root_frame):
+    '''Stack of (code, module name) from below root_frame to frame, None when root_frame is not on it.'''
+
+    stack = []
+    while frame is not None and frame is not root_frame:
+        stack.append((frame.f_code, frame.f_globals.get('__name__')))
+        frame = frame.f_back
+    if frame is None:
+        return None
+    return tuple(reversed(stack))
+
+
+class StackSampler(object):
+    '''Samples the stack of one thread below root_frame from a background thread, along with
+    the stacks of the threads attached while they work for the same request.
+
+    Stacks are kept as tuples of (code, module name) until the profile is written, so a sample
+    costs a walk of the frames and a dict update.'''
+
+    def __init__(self, thread_id, root_frame, interval_seconds=PROFILE_INTERVAL_MS / 1000):
+        self.thread_id = thread_id
+        self.root_frame = root_frame
+        self.interval_seconds = interval_seconds
+        self.samples = {}
+        self.started_at = None
+        self.duration = 0.0
+
+        self._attached = {}
+        self._attached_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def attach(self, thread_id, thread_name, root_frame):
+        '''Samples the stack of another thread below root_frame until detach().'''
+
+        with self._attached_lock:
+            self._attached[thread_id] = (thread_name, root_frame)
+
+    def detach(self, thread_id):
+        with self._attached_lock:
+            self._attached.pop(thread_id, None)
+
+    def start(self):
+        self.started_at = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name='request-profiler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        self.duration = time.perf_counter() - self.started_at
+
+    def _stacks(self):
+        '''[(thread name, stack)] of a sample, thread name None for the request thread.'''
+
+        frames = sys._current_frames()
+        # None when the root frame is not on the stack, the coroutine of an async view is suspended
+        stacks = [(None, _walk(frames.get(self.thread_id), self.root_frame))]
+
+        with self._attached_lock:
+            attached = list(self._attached.items())
+        for thread_id, (thread_name, root_frame) in attached:
+            stack = _walk(frames.get(thread_id), root_frame)
+            if stack is not None:
+                stacks.append((thread_name, stack))
+        return stacks
+
+    def _run(self):
+        last_at = self.started_at
+        while not self._stopped.wait(self.interval_seconds):
+            stacks = self._stacks()
+            now = time.perf_counter()
+            for key in stacks:
+                self.samples[key] = self.samples.get(key, 0.0) + (now - last_at)
+            last_at = now
+
+    def weighted_stacks(self, root_label):
+        '''[(labels from root to leaf, seconds)] of the samples.'''
+
+        stacks = []
+        for (thread_name, stack), seconds in self.samples.items():
+            labels = (root_label,) if thread_name is None else (root_label, f'[{thread_name}]')
+            if stack is None:
+                labels += (AWAITING,)
+            else:
+                labels += tuple(_label(code, module_name) for code, module_name in stack)
+            stacks.append((labels, seconds))
+        return stacks
+
+
+def sampled_call(func, *args, **kwargs):
+    '''Calls func(*args, **kwargs). While the request whose context the calling thread runs
+    with is profiled, the thread is sampled along with it for the duration of the call.'''
+
+    sampler = _active_sampler.get()
+    if sampler is None:
+        return func(*args, **kwargs)
+
+    thread_id = threading.get_ident()
+    sampler.attach(thread_id, threading.current_thread().name, sys._getframe())
+    try:
+        return func(*args, **kwargs)
+    finally:
+        sampler.detach(thread_id)
+
+
+#====================================================================================
+# Output
+#====================================================================================
+def collapsed(stacks):
+    '''Collapsed stack lines, "frame;frame;frame weight" with weights in microseconds.'''
+
+    lines = []
+    for labels, seconds in sorted(stacks):
+        weight = round(seconds * 1e6)
+        if weight:
+            lines.append(';'.join(label.replace(';', ':') for label in labels) + f' {weight}')
+    return '\n'.join(lines) + '\n'
+
+
+def speedscope(stacks, name, duration):
+    '''speedscope file of a sampled profile, weights in milliseconds.'''
+
+    frames = []
+    frame_index = {}
+    samples = []
+    weights = []
+
+    for labels, seconds in stacks:
+        sample = []
+        for label in labels:
+            idx = frame_index.get(label)
+            if idx is None:
+                idx = frame_index[label] = len(frames)
+                frames.append({'name': label})
+            sample.append(idx)
+        samples.append(sample)
+        weights.append(round(seconds * 1000, 3))
+
+    return {'$schema': 'https://www.speedscope.app/file-format-schema.json',
+            'name': name,
+            'exporter': __name__,
+            'activeProfileIndex': 0,
+            'shared': {'frames': frames},
+            'profiles': [{'type': 'sampled',
+                          'name': name,
+                          'unit': 'milliseconds',
+                          'startValue': 0,
+                          'endValue': round(duration * 1000, 3),
+                          'samples': samples,
+                          'weights': weights}]}
+
+
+def write_profile(sampler, view_name, api_name, trigger, profile_format=PROFILE_FORMAT, directory=PROFILE_DIR):
+    '''Writes the profile of a request, returns its file name.'''
+
+    stacks = sampler.weighted_stacks(view_name)
+    name = f"{api_name.replace('/', '_')}-{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}-{next(_sequence)}-{trigger}"
+    os.makedirs(directory, exist_ok=True)
+
+    if profile_format == 'speedscope':
+        file_name = f'{name}.speedscope.json'
+        content = json.dumps(speedscope(stacks, name, sampler.duration))
+    else:
+        file_name = f'{name}.collapsed.txt'
+        content = collapsed(stacks)
+
+    with open(os.path.join(directory, file_name), 'w', encoding='utf-8') as profile_file:
+        profile_file.write(content)
+    return file_name
+
+
+#====================================================================================
+# Decorator
+#====================================================================================
+def profiled(api_name):
+    '''Decorator for a view (sync or async), profiles the requests triggered by the header or
+    the sample rate. Returns the view itself when profiling is not configured.'''
+
+    def decorator(view):
+        if not enabled():
+            return view
+
+        def start(root_frame):
+            trigger = _trigger()
+            if trigger is None or not _busy.acquire(blocking=False):
+                return None, None, None
+            sampler = StackSampler(threading.get_ident(), root_frame).start()
+            return trigger, sampler, _active_sampler.set(sampler)
+
+        def finish(trigger, sampler, token):
+            _active_sampler.reset(token)
+            try:
+                sampler.stop()
+                file_name = write_profile(sampler, view.__name__, api_name, trigger)
+            except Exception:
+                logger.exception('writing the profile of %s failed', view.__name__)
+                return
+            finally:
+                _busy.release()
+
+            metrics.inc('online_leads_profiles_total', trigger=trigger)
+            step_trace.step('request profiled to %s', file_name)
+
+            # only the caller which asked with the profile token is told where the profile is
+            if trigger != 'header':
+                return
+
+            @after_this_request
+            def add_profile_header(response):
+                response.headers[PROFILE_FILE_HEADER] = file_name
+                return response
+
+        if inspect.iscoroutinefunction(view):
+
+            @functools.wraps(view)
+            async def async_wrapper(*args, **kwargs):
+                trigger, sampler, token = start(sys._getframe())
+                if sampler is None:
+                    return await view(*args, **kwargs)
+                try:
+                    return await view(*args, **kwargs)
+                finally:
+                    finish(trigger, sampler, token)
+
+            return async_wrapper
+
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            trigger, sampler, token = start(sys._getframe())
+            if sampler is None:
+                return view(*args, **kwargs)
+            try:
+                return view(*args, **kwargs)
+            finally:
+                finish(trigger, sampler, token)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,182 @@
+"""
+Request schema of the online leads eligibility API.
+
+parse() reads a lead once, from form data or a JSON object, and returns a LeadRequest with
+every mandatory and optional param coerced to its type: text params as str, the amounts as
+float, the Highmark score as int and dev_bypass as bool. The validation results of Steps 3,
+5 and 6 are kept on the object in the order the API reports them, so the views and the
+eligibility rules work on typed values and never parse request.form again.
+
+A mandatory param sent as null or as empty text counts as not sent. The numeric params must be
+finite numbers: nan and inf, which float() reads, are reported as not numeric.
+
+"""
+
+import math
+
+from flask import request
+
+
+
+MANDATORY_PARAMS = ('application_id',
+                    'business_name',
+                    'business_pincode',
+                    'mobile_number',
+                    'business_type',
+                    'business_main_sector',
+                    'business_specific_sector',
+                    'vintage_months',
+                    'average_annual_turnover',
+                    'required_loan_amount',
+                    'preferred_monthly_EMI',
+                    'applicant_name',
+                    'app_highmark_score_A8')
+
+OPTIONAL_PARAMS = ('loan_purpose',
+                   'applicant_pan_number',
+                   'email_address',
+                   'email_type',
+                   'dev_bypass',
+                   'loan_type',
+                   'applicant_highmark_XML')
+
+# checked in this order, business_mobile is not considered into this list
+NUMERIC_PARAMS = ('vintage_months',
+                  'average_annual_turnover',
+                  'required_loan_amount',
+                  'preferred_monthly_EMI',
+                  'business_pincode')
+
+NON_NEGATIVE_PARAMS = NUMERIC_PARAMS
+
+ALL_PARAMS = MANDATORY_PARAMS + OPTIONAL_PARAMS
+
+# numeric params kept as text, the pincode length check works on the text sent
+TEXT_NUMERIC_PARAMS = ('business_pincode',)
+
+
+def is_blank(value):
+    '''True for a param sent as null or as empty text.'''
+
+    return value is None or (isinstance(value, str) and not value.strip())
+
+
+def parse_number(value):
+    '''Returns value as a finite float, None if it is not a number (nan and inf included).'''
+
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    if not math.isfinite(number):
+        return None
+    return number
+
+
+def parse_int(value):
+    '''Returns value as an int, None if it is not an integer. A whole number written as a
+    float ("720.0", 720.0) is accepted, a fractional one is not.'''
+
+    if isinstance(value, (int, str)):
+        try:
+            return int(value)
+        except ValueError:
+            pass
+
+    number = parse_number(value)
+    if number is not None and number.is_integer():
+        return int(number)
+    return None
+
+
+def parse_text(value):
+    return None if value is None else str(value)
+
+
+def parse_flag(value):
+    return str(value).lower() == 'true'
+
+
+# param -> coercion, compiled once
+_PARSERS = {param: parse_text for param in ALL_PARAMS}
+_PARSERS['app_highmark_score_A8'] = parse_int
+_PARSERS['dev_bypass'] = parse_flag
+
+# position of a numeric param in the order the errors are reported
+_NUMERIC_ORDER = {param: order for order, param in enumerate(NUMERIC_PARAMS)}
+
+
+class LeadRequest(object):
+    '''One lead parsed by parse().
+
+    data           - the request data as sent, for the token check, logs and history
+    missing_params - True when a mandatory param is not sent, or sent null or empty (Step 3)
+    invalid_param  - eligibility_rules.OUTCOMES key of the first non numeric, then of the first
+                     negative numeric param (Steps 5 and 6), then of a Highmark score which is not
+                     a number or not a whole one, None when all are valid
+    <param>        - typed value of every mandatory and optional param, None when not sent'''
+
+    __slots__ = ('data', 'missing_params', 'invalid_param') + ALL_PARAMS
+
+    def __init__(self, data):
+        self.data = data
+        self.missing_params = False
+        self.invalid_param = None
+
+    def __repr__(self):
+        return f'LeadRequest(application_id={self.application_id!r})'
+
+
+def parse(data):
+    '''Parses, coerces and validates the params of a lead in one pass over the request data.'''
+
+    lead = LeadRequest(data)
+    first_not_numeric = None
+    first_negative = None
+
+    for param in ALL_PARAMS:
+        raw_value = data.get(param)
+        if raw_value is None or (param in MANDATORY_PARAMS and is_blank(raw_value)):
+            setattr(lead, param, None)
+            if param in MANDATORY_PARAMS:
+                lead.missing_params = True
+            continue
+
+        order = _NUMERIC_ORDER.get(param)
+
+        if order is None:
+            setattr(lead, param, _PARSERS[param](raw_value))
+            continue
+
+        number = parse_number(raw_value)
+        setattr(lead, param, number if param not in TEXT_NUMERIC_PARAMS else parse_text(raw_value))
+
+        if number is None:
+            if first_not_numeric is None or order < _NUMERIC_ORDER[first_not_numeric]:
+                first_not_numeric = param
+        elif number < 0:
+            if first_negative is None or order < _NUMERIC_ORDER[first_negative]:
+                first_negative = param
+
+    if first_not_numeric is not None:
+        lead.invalid_param = f'numeric:{first_not_numeric}'
+    elif first_negative is not None:
+        lead.invalid_param = f'negative:{first_negative}'
+    elif lead.app_highmark_score_A8 is None and not lead.missing_params:
+        # reported like the batch checks do, instead of failing CHECK 7
+        if parse_number(data.get('app_highmark_score_A8')) is None:
+            lead.invalid_param = 'numeric:app_highmark_score_A8'
+        else:
+            lead.invalid_param = 'integer:app_highmark_score_A8'
+
+    return lead
+
+
+def request_payload():
+    '''Request data of the running request: the JSON object when one is sent, else the form.'''
+
+    if request.is_json:
+        body = request.get_json(silent=True)
+        if isinstance(body, dict):
+            return body
+    return request.form
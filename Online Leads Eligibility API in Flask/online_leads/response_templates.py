@@ -0,0 +1,151 @@
+"""
+Pre-serialized responses of the online leads eligibility API.
+
+Nearly every response is one of the fixed eligibility_rules.OUTCOMES payloads, so each of them
+is built once at import into a ResponseTemplate: a read-only payload dict, reused as the
+api_response of the history rows, and its JSON bytes encoded the way Flask's jsonify does
+(sorted keys, compact separators, trailing newline). A view returns template.response(),
+which wraps the bytes without building or encoding anything. orjson is used to encode when
+installed, the standard json module otherwise.
+
+"""
+
+import json
+import threading
+
+from flask import Response
+
+from online_leads.eligibility_rules import OUTCOMES, Outcome
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# token failure messages kept as templates, other messages are encoded per request
+MAX_DYNAMIC_TEMPLATES = 256
+
+
+class FrozenDict(dict):
+    '''dict which refuses changes, the payload of a template is shared by every request.'''
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError('response template payloads are read-only')
+
+    __setitem__ = __delitem__ = __ior__ = clear = pop = popitem = setdefault = update = _readonly
+
+    def __copy__(self):
+        return dict(self)
+
+    def __reduce__(self):
+        return (dict, (dict(self),))
+
+
+def freeze(value):
+    if isinstance(value, dict):
+        return FrozenDict((key, freeze(item)) for key, item in value.items())
+    return value
+
+
+def response_dict(request_status,
+                  request_message,
+                  online_leads_eligibility_status,
+                  body_message,
+                  error_response_code):
+    '''Payload of an api response, see default_api_response_dict of the blueprint.'''
+
+    return {
+                'request_status': request_status,
+                'request_message': request_message,
+                'body': {
+                            'online_leads_eligibility_status': online_leads_eligibility_status,
+                            'body_message': body_message,
+                            'error_response_code': error_response_code
+                        }
+           }
+
+
+def encode(payload):
+    '''JSON bytes of a payload, byte for byte the body jsonify() would send.'''
+
+    if orjson is not None:
+        encoded = orjson.dumps(payload, option=orjson.OPT_SORT_KEYS | orjson.OPT_APPEND_NEWLINE)
+        # jsonify escapes non ASCII characters, orjson does not
+        if encoded.isascii():
+            return encoded
+    return (json.dumps(payload, sort_keys=True, separators=(',', ':')) + '\n').encode('ascii')
+
+
+class TemplateResponse(Response):
+    '''Response sent from a ResponseTemplate, template gives access to its payload.'''
+
+    template = None
+
+
+class ResponseTemplate(object):
+    '''Read-only payload and its encoded JSON body.'''
+
+    __slots__ = ('payload', 'body', 'outcome')
+
+    def __init__(self, payload, outcome=None):
+        self.payload = freeze(payload)
+        self.body = encode(self.payload)
+        self.outcome = outcome
+
+    @classmethod
+    def from_outcome(cls, outcome):
+        return cls(response_dict(**outcome.response_kwargs()), outcome=outcome)
+
+    def response(self):
+        '''A new response object around the pre-encoded body.'''
+
+        response = TemplateResponse(self.body, mimetype='application/json')
+        response.template = self
+        return response
+
+
+# eligibility_rules.OUTCOMES key -> template, built at import
+TEMPLATES = {key: ResponseTemplate.from_outcome(outcome) for key, outcome in OUTCOMES.items()}
+
+INVALID_METHOD = ResponseTemplate(response_dict(request_status = "fail",
+                                                request_message = "invalid API request method",
+                                                online_leads_eligibility_status = "NA",
+                                                body_message = "NA",
+                                                error_response_code = 'NA'))
+
+# requests shed by admission control, sent with a Retry-After header
+RATE_LIMITED = ResponseTemplate(response_dict(request_status = "fail",
+                                              request_message = "too many requests from this client, retry later",
+                                              online_leads_eligibility_status = "NA",
+                                              body_message = "NA",
+                                              error_response_code = 'NA'))
+
+OVERLOADED = ResponseTemplate(response_dict(request_status = "fail",
+                                            request_message = "service busy, retry later",
+                                            online_leads_eligibility_status = "NA",
+                                            body_message = "NA",
+                                            error_response_code = 'NA'))
+
+_templates_by_outcome = {template.outcome: template for template in TEMPLATES.values()}
+_dynamic_templates = {}
+_dynamic_lock = threading.Lock()
+
+
+def for_outcome(outcome):
+    '''Template of any Outcome, e.g. a token failure with the message of the token check.
+    Built on first use and kept while fewer than MAX_DYNAMIC_TEMPLATES are known.'''
+
+    template = _templates_by_outcome.get(outcome) or _dynamic_templates.get(outcome)
+    if template is None:
+        template = ResponseTemplate.from_outcome(outcome)
+        with _dynamic_lock:
+            if len(_dynamic_templates) < MAX_DYNAMIC_TEMPLATES:
+                template = _dynamic_templates.setdefault(outcome, template)
+    return template
+
+
+def token_failure(error_message):
+    '''Template of a failed token check.'''
+
+    return for_outcome(Outcome('fail', error_message, 'NA', 'NA', 'NA', 'token', 'fail'))
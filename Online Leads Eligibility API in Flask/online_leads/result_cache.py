@@ -0,0 +1,201 @@
+"""
+Idempotent result cache for redelivered leads.
+
+Ad platforms redeliver the same lead (webhook retries, resubmitted forms). A lead is identified
+by its application_id, a fingerprint of the decision-relevant fields, the threshold version and
+the versions of the reference data (reference snapshot, pincode and sector indexes), so a lead
+sent again with the same data under the same reference data gets the stored response for
+RESULT_CACHE_TTL_SECONDS. A duplicate is recorded as a small history event instead of a full row.
+
+A response decided on a fallback (a timed out lookup, the last known good pincode answer, an
+unreadable Highmark report) is not stored, see skip().
+
+"""
+
+import contextvars
+import functools
+import hashlib
+import inspect
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from online_leads import hist_writer
+from online_leads import metrics
+from online_leads import pincode_index
+from online_leads import reference_snapshot
+from online_leads import request_schema
+from online_leads import response_templates
+from online_leads import sector_index
+
+
+# seconds a stored response is returned for a duplicate lead
+RESULT_CACHE_TTL_SECONDS = float(os.environ.get('LOS_RESULT_CACHE_TTL_SECONDS', 600))
+
+# maximum number of stored responses
+RESULT_CACHE_MAX_SIZE = int(os.environ.get('LOS_RESULT_CACHE_MAX_SIZE', 50000))
+
+# request params which can change the response of a lead
+DECISION_FIELDS = request_schema.MANDATORY_PARAMS + ('loan_purpose',
+                                                     'dev_bypass',
+                                                     'loan_type',
+                                                     'applicant_highmark_XML')
+
+metrics.METRIC_HELP['online_leads_result_cache_total'] = 'Leads by duplicate result cache lookup result.'
+
+_pending = contextvars.ContextVar('online_leads_result_cache_pending', default=None)
+
+
+class _Pending(object):
+    '''Key the response of the running view is stored under. Shared with the lookup threads
+    of the request, which see a copy of its context, so skip() works from any of them.'''
+
+    __slots__ = ('key', 'skipped')
+
+    def __init__(self):
+        self.key = None
+        self.skipped = False
+
+
+def fingerprint(request_data):
+    '''Hash of the decision-relevant fields of a lead.'''
+
+    content = '\x1f'.join(f'{field}={request_data.get(field)}' for field in DECISION_FIELDS)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+class ResultCache(object):
+    '''LRU cache of responses with a fixed time window.'''
+
+    def __init__(self, ttl_seconds=RESULT_CACHE_TTL_SECONDS, max_size=RESULT_CACHE_MAX_SIZE):
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            response, expires_at = entry
+            if expires_at <= now:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return response
+
+    def put(self, key, response):
+        with self._lock:
+            self._entries[key] = (response, time.monotonic() + self.ttl_seconds)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+RESULT_CACHE = ResultCache()
+
+
+def reference_versions():
+    '''Versions of the reference snapshot, the pincode index and the sector index.'''
+
+    snapshot = reference_snapshot.current()
+    return (snapshot.version if snapshot is not None else None,
+            pincode_index.get_serviceability().version,
+            sector_index.get_reference().version)
+
+
+def request_key(request_data, api_name, threshold_version):
+    return (api_name, request_data.get('application_id'), fingerprint(request_data), threshold_version,
+            reference_versions())
+
+
+def lookup(request_data, api_name, threshold_version):
+    '''Returns (key, stored ResponseTemplate or None). On a miss the response of the running
+    view is stored under key once it returns, see stores_result().'''
+
+    key = request_key(request_data, api_name, threshold_version)
+    response = RESULT_CACHE.get(key)
+
+    if response is None:
+        metrics.inc('online_leads_result_cache_total', result='miss')
+        pending = _pending.get()
+        if pending is not None:
+            pending.key = key
+    else:
+        metrics.inc('online_leads_result_cache_total', result='hit')
+
+    return key, response
+
+
+def record_duplicate(api_name, key, template):
+    '''Records a duplicate lead as a small history event instead of a full request row.'''
+
+    _, application_id, request_fingerprint, threshold_version, _ = key
+    hist_writer.add_api_call_hist_data(api_name,
+                                       api_error_label="duplicate request",
+                                       api_status="success",
+                                       logic_status="duplicate",
+                                       api_request = {'application_id': application_id,
+                                                      'request_fingerprint': request_fingerprint,
+                                                      'threshold_version': threshold_version},
+                                       api_response = template.payload)
+
+
+def skip():
+    '''Keeps the response of the running view out of the cache, e.g. after a lookup timeout
+    or a fallback answer. A no-op outside a view decorated with stores_result().'''
+
+    pending = _pending.get()
+    if pending is not None:
+        pending.skipped = True
+
+
+def _store(pending, response):
+    if pending.key is None or pending.skipped:
+        return
+    if isinstance(response, response_templates.TemplateResponse):
+        RESULT_CACHE.put(pending.key, response.template)
+    elif isinstance(response, dict):
+        RESULT_CACHE.put(pending.key, response_templates.ResponseTemplate(response))
+
+
+def stores_result(view):
+    '''Decorator for a view (sync or async), stores its response for the key looked up during the request.'''
+
+    if inspect.iscoroutinefunction(view):
+
+        @functools.wraps(view)
+        async def async_wrapper(*args, **kwargs):
+            pending = _Pending()
+            token = _pending.set(pending)
+            try:
+                response = await view(*args, **kwargs)
+                _store(pending, response)
+                return response
+            finally:
+                _pending.reset(token)
+
+        return async_wrapper
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        pending = _Pending()
+        token = _pending.set(pending)
+        try:
+            response = view(*args, **kwargs)
+            _store(pending, response)
+            return response
+        finally:
+            _pending.reset(token)
+
+    return wrapper
@@ -0,0 +1,140 @@
+"""
+Rule pipeline for the eligibility checks.
+
+Every rule declares its precedence (its position in the documented check order), a cost class
+and the outcome it rejects with. The engine runs cheap in-memory rules before lookups and I/O,
+and can optionally reorder rules of the same cost class by their observed rejection rate.
+
+The response is always the one of the failing rule with the lowest precedence, exactly as if the
+rules had been run in check order: once a rule fails, only rules with a lower precedence are
+still evaluated.
+
+"""
+
+import os
+import threading
+from collections import namedtuple
+
+from online_leads import step_trace
+
+
+# cost classes, cheapest first
+COST_MEMORY = 'memory'
+COST_LOOKUP = 'lookup'
+COST_IO = 'io'
+
+COST_CLASSES = (COST_MEMORY, COST_LOOKUP, COST_IO)
+
+# reorder rules of the same cost class by observed rejection rate
+RULE_ADAPTIVE_ORDER = os.environ.get('LOS_RULE_ADAPTIVE_ORDER', 'false').lower() == 'true'
+
+# number of evaluations between two reorderings
+RULE_REORDER_EVERY = int(os.environ.get('LOS_RULE_REORDER_EVERY', 1000))
+
+
+class Rule(namedtuple('Rule', ['name', 'precedence', 'cost', 'outcome', 'check', 'description'])):
+    '''One eligibility check.
+
+    check       - callable(lead, thresholds, api_name) returning True when the lead fails,
+                  lead is a request_schema.LeadRequest
+    description - step marker recorded on the request trace when the rule runs'''
+
+    __slots__ = ()
+
+
+class RuleEngine(object):
+    '''Runs a list of rules in cost order and returns the failing rule with the lowest precedence.'''
+
+    def __init__(self, rules,
+                 adaptive = RULE_ADAPTIVE_ORDER,
+                 reorder_every = RULE_REORDER_EVERY):
+
+        rules = sorted(rules, key=lambda rule: rule.precedence)
+        for rule in rules:
+            if rule.cost not in COST_CLASSES:
+                raise ValueError(f'rule {rule.name} has unknown cost class {rule.cost}')
+
+        self.rules = tuple(rules)
+        self.adaptive = adaptive
+        self.reorder_every = reorder_every
+
+        self._evaluated = {rule.name: 0 for rule in rules}
+        self._rejected = {rule.name: 0 for rule in rules}
+        self._runs = 0
+        self._lock = threading.Lock()
+        self._order = self._cost_order()
+
+    @property
+    def order(self):
+        '''Names of the rules in their current execution order.'''
+
+        return [rule.name for rule in self._order]
+
+    def run(self, lead, thresholds, api_name):
+        '''Returns the failing Rule with the lowest precedence, or None if every rule passes.
+        An exception raised by a rule is re-raised only if no rule with a lower precedence fails.'''
+
+        failed = None
+        error = None
+        evaluated = []
+        rejected_rules = []
+
+        for rule in self._order:
+            if failed is not None and rule.precedence > failed.precedence:
+                continue
+
+            step_trace.step(rule.description)
+            evaluated.append(rule.name)
+
+            try:
+                rejected = rule.check(lead, thresholds, api_name)
+            except Exception as exc:
+                rejected = True
+                error = (rule, exc)
+
+            if rejected:
+                rejected_rules.append(rule.name)
+                failed = rule
+
+        # the counters are shared by the threads of the process, updated once per run
+        with self._lock:
+            for name in evaluated:
+                self._evaluated[name] += 1
+            for name in rejected_rules:
+                self._rejected[name] += 1
+            self._runs += 1
+            reorder_due = self.adaptive and self._runs % self.reorder_every == 0
+
+        if reorder_due:
+            self.reorder()
+
+        if error is not None and error[0] is failed:
+            raise error[1]
+
+        return failed
+
+    def reorder(self):
+        '''Orders the rules by cost class, then by observed rejection rate (highest first).'''
+
+        with self._lock:
+            self._order = tuple(sorted(self.rules, key=lambda rule: (COST_CLASSES.index(rule.cost),
+                                                                     -self.rejection_rate(rule.name),
+                                                                     rule.precedence)))
+
+    def rejection_rate(self, rule_name):
+        '''Share of the evaluations of a rule which rejected the lead.'''
+
+        evaluated = self._evaluated[rule_name]
+        return self._rejected[rule_name] / evaluated if evaluated else 0.0
+
+    def stats(self):
+        '''Returns evaluations, rejections and rejection rate per rule.'''
+
+        with self._lock:
+            return {rule.name: {'evaluated': self._evaluated[rule.name],
+                                'rejected': self._rejected[rule.name],
+                                'rejection_rate': self.rejection_rate(rule.name)}
+                    for rule in self.rules}
+
+    def _cost_order(self):
+        return tuple(sorted(self.rules, key=lambda rule: (COST_CLASSES.index(rule.cost), rule.precedence)))
@@ -0,0 +1,168 @@
+"""
+Local index of the excluded sectors and sub-sectors for the online leads eligibility API.
+
+The excluded sector and sub-sector reference data is compiled once into sets of normalized
+tuple keys (case and whitespace folded at load time), so each check is a single hash lookup.
+The index is rebuilt when a snapshot file changes and swapped in with a single assignment.
+
+Snapshots are CSV files with an optional header row:
+    excluded sectors    - business_main_sector,business_type
+    excluded sub-sector - business_main_sector,business_type,business_specific_sector
+
+A compiled reference_snapshot, when configured, is asked before this index.
+lf.validate_sector / lf.validate_subsector are only used while no snapshot is loaded.
+
+"""
+
+import csv
+import os
+import threading
+
+from los import los_function as lf
+from online_leads import reference_snapshot
+from online_leads.snapshot_watcher import SnapshotWatcher
+
+
+# snapshots of the excluded sectors and sub-sectors, lf is used while these are not set
+EXCLUDED_SECTOR_SNAPSHOT_PATH = os.environ.get('LOS_EXCLUDED_SECTOR_SNAPSHOT_PATH')
+EXCLUDED_SUBSECTOR_SNAPSHOT_PATH = os.environ.get('LOS_EXCLUDED_SUBSECTOR_SNAPSHOT_PATH')
+
+# seconds between two checks of the snapshot files for changes
+SECTOR_RELOAD_CHECK_SECONDS = float(os.environ.get('LOS_SECTOR_RELOAD_CHECK_SECONDS', 30))
+
+
+def normalize(value):
+    '''Folds case and whitespace of a sector name: "  Food  Processing " -> "food processing".'''
+
+    return ' '.join(str(value).split()).casefold()
+
+
+def _keys(rows, width):
+    keys = set()
+    for row in rows:
+        if len(row) < width or not any(cell.strip() for cell in row):
+            continue
+        keys.add(tuple(normalize(cell) for cell in row[:width]))
+    return frozenset(keys)
+
+
+def _read_rows(path):
+    with open(path, 'r', encoding='utf-8', newline='') as snapshot:
+        rows = list(csv.reader(snapshot))
+
+    # skip the header row
+    if rows and rows[0] and normalize(rows[0][0]) == 'business_main_sector':
+        rows = rows[1:]
+    return rows
+
+
+class SectorIndex(object):
+    '''Immutable sets of excluded (main sector, business type) and
+    (main sector, business type, specific sector) keys.'''
+
+    __slots__ = ('excluded_sectors', 'excluded_subsectors')
+
+    def __init__(self, excluded_sector_rows, excluded_subsector_rows):
+        self.excluded_sectors = _keys(excluded_sector_rows, 2)
+        self.excluded_subsectors = _keys(excluded_subsector_rows, 3)
+
+    @classmethod
+    def from_snapshots(cls, sector_path, subsector_path):
+        return cls(_read_rows(sector_path), _read_rows(subsector_path))
+
+    def is_valid_sector(self, business_main_sector, business_type):
+        '''True if the sector is not excluded, same meaning as lf.validate_sector.'''
+
+        return (normalize(business_main_sector), normalize(business_type)) not in self.excluded_sectors
+
+    def is_excluded_subsector(self, business_main_sector, business_type, business_specific_sector):
+        '''True if the sub-sector is excluded, same meaning as lf.validate_subsector.'''
+
+        key = (normalize(business_main_sector), normalize(business_type), normalize(business_specific_sector))
+        return key in self.excluded_subsectors
+
+
+def _build_index(paths):
+    # an empty (e.g. truncated) snapshot would let every sector through, the current index is kept
+    index = SectorIndex.from_snapshots(*paths)
+    if not index.excluded_sectors:
+        raise ValueError(f'excluded sector snapshot {paths[0]} is empty')
+    if not index.excluded_subsectors:
+        raise ValueError(f'excluded sub-sector snapshot {paths[1]} is empty')
+    return index
+
+
+class SectorReference(SnapshotWatcher):
+    '''Keeps a SectorIndex loaded from the snapshot files and reloads it when they change.'''
+
+    def __init__(self,
+                 sector_path = EXCLUDED_SECTOR_SNAPSHOT_PATH,
+                 subsector_path = EXCLUDED_SUBSECTOR_SNAPSHOT_PATH,
+                 reload_check_seconds = SECTOR_RELOAD_CHECK_SECONDS):
+
+        super().__init__(paths=(sector_path, subsector_path),
+                         build=_build_index,
+                         reload_check_seconds=reload_check_seconds,
+                         name='sector index')
+
+    @property
+    def index(self):
+        '''The current SectorIndex, None until the snapshots are loaded.'''
+
+        return self.value
+
+    def load(self, excluded_sector_rows, excluded_subsector_rows, version=None):
+        '''Replaces the index with one built from rows of the reference tables.'''
+
+        return self.replace(SectorIndex(excluded_sector_rows, excluded_subsector_rows), version)
+
+
+#====================================================================================
+# Module level index
+#====================================================================================
+_reference = None
+_reference_lock = threading.Lock()
+
+
+def get_reference():
+    '''Returns the process wide SectorReference, started on first use.'''
+
+    global _reference
+
+    if _reference is None:
+        with _reference_lock:
+            if _reference is None:
+                reference = SectorReference()
+                reference.start()
+                _reference = reference
+    return _reference
+
+
+def validate_sector(business_main_sector, business_type):
+    '''Drop-in replacement of lf.validate_sector answered from the reference snapshot or the local index.'''
+
+    snapshot = reference_snapshot.current()
+    if snapshot is not None:
+        is_valid = snapshot.is_valid_sector(business_main_sector, business_type)
+        if is_valid is not None:
+            return is_valid
+
+    index = get_reference().index
+    if index is None:
+        return lf.validate_sector(business_main_sector, business_type)
+    return index.is_valid_sector(business_main_sector, business_type)
+
+
+def validate_subsector(business_main_sector, business_type, business_specific_sector):
+    '''Drop-in replacement of lf.validate_subsector answered from the reference snapshot or the local index.'''
+
+    snapshot = reference_snapshot.current()
+    if snapshot is not None:
+        is_excluded = snapshot.is_excluded_subsector(business_main_sector, business_type, business_specific_sector)
+        if is_excluded is not None:
+            return is_excluded
+
+    index = get_reference().index
+    if index is None:
+        return lf.validate_subsector(business_main_sector, business_type, business_specific_sector)
+    return index.is_excluded_subsector(business_main_sector, business_type, business_specific_sector)
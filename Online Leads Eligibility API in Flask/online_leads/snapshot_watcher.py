@@ -0,0 +1,112 @@
+"""
+Reference data built from snapshot files and rebuilt when the files change.
+
+Used by the local pincode and sector indexes. The value is rebuilt off the request path and
+replaced with a single assignment, so readers always see either the old or the new value.
+
+"""
+
+import itertools
+import logging
+import os
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+class SnapshotWatcher(object):
+    '''Holds the value built from one or more snapshot files and rebuilds it on change.
+
+    paths - snapshot file paths, the watcher is disabled when any of them is not set
+    build - callable(paths) returning the new value; raising ValueError keeps the current one'''
+
+    def __init__(self, paths, build, reload_check_seconds, name):
+        self.paths = tuple(paths)
+        self.build = build
+        self.reload_check_seconds = reload_check_seconds
+        self.name = name
+
+        self.value = None
+        self.version = None
+        self._file_version = None
+        self._loads = itertools.count(1)
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def enabled(self):
+        return bool(self.paths) and all(self.paths)
+
+    def reload(self, force=False):
+        '''Rebuilds the value if a snapshot file changed since the last load.
+        Returns True if a new value was swapped in.'''
+
+        if not self.enabled:
+            return False
+
+        with self._lock:
+            file_version = tuple(_file_version(path) for path in self.paths)
+            if not force and file_version == self._file_version:
+                return False
+
+            try:
+                value = self.build(self.paths)
+            except ValueError as exc:
+                logger.warning('%s snapshot rejected, keeping the current one: %s', self.name, exc)
+                return False
+
+            self.value = value
+            self.version = file_version
+            self._file_version = file_version
+
+        logger.info('%s loaded from %s', self.name, ', '.join(self.paths))
+        return True
+
+    def replace(self, value, version=None):
+        '''Swaps in a value built outside the watcher, e.g. from rows of the reference tables.'''
+
+        with self._lock:
+            self.value = value
+            self.version = version if version is not None else ('loaded', next(self._loads))
+        return value
+
+    def start(self):
+        '''Loads the snapshot files and starts watching them for changes.'''
+
+        if not self.enabled:
+            return
+
+        try:
+            self.reload()
+        except OSError:
+            logger.exception('loading %s snapshot failed', self.name)
+
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name=f'{self.name}-watcher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        '''Stops watching the snapshot files.'''
+
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        self._thread = None
+
+    def _run(self):
+        while not self._stopped.wait(self.reload_check_seconds):
+            try:
+                self.reload()
+            except Exception:
+                # keep serving the current value
+                logger.exception('reloading %s snapshot failed', self.name)
+
+
+def _file_version(path):
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
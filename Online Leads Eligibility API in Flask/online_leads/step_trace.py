@@ -0,0 +1,189 @@
+"""
+Per request step tracing for the online leads eligibility API.
+
+Instead of one avf.make_log call per step, a view decorated with traced() collects its step
+markers in memory and emits a single structured log record once the view returns. The full
+request payload is only attached to a sample of the records.
+
+"""
+
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import os
+import random
+import time
+
+from flask import request
+
+from utilities import api_validation_function as avf
+from online_leads import metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+def _trace_level(value, default=logging.INFO):
+    '''Level named or numbered by value, default (with a warning) when it is neither.'''
+
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+
+    level = logging.getLevelName(value.upper())
+    if isinstance(level, int):
+        return level
+
+    logger.warning('LOS_TRACE_LEVEL %r is not a logging level, using %s', value, logging.getLevelName(default))
+    return default
+
+
+# steps below this level are not recorded, a level name (DEBUG, INFO, ...) or number
+TRACE_LEVEL = _trace_level(os.environ.get('LOS_TRACE_LEVEL', 'INFO'))
+
+# share of the trace records logged along with the full request payload
+TRACE_PAYLOAD_SAMPLE_RATE = float(os.environ.get('LOS_TRACE_PAYLOAD_SAMPLE_RATE', 0.01))
+
+# request fields kept in the trace records which are not sampled
+TRACE_SUMMARY_FIELDS = ('application_id',)
+
+_current_trace = contextvars.ContextVar('online_leads_step_trace', default=None)
+
+
+class StepTrace(object):
+    '''Step markers of one request, emitted as one record by emit().'''
+
+    __slots__ = ('api_name', 'request_data', 'started_at', 'steps', 'outcome')
+
+    def __init__(self, api_name, request_data):
+        self.api_name = api_name
+        self.request_data = request_data
+        self.started_at = time.perf_counter()
+        self.steps = []
+        self.outcome = None
+
+    def step(self, message, *args, level=logging.INFO):
+        '''Records a step marker. args are only formatted into the message on emit().'''
+
+        if level >= TRACE_LEVEL:
+            self.steps.append((time.perf_counter(), level, message, args))
+
+    def record(self):
+        '''Returns the trace as a dict ready to be logged.'''
+
+        steps = []
+        for at, level, message, args in self.steps:
+            if args:
+                message = message % args
+            steps.append({'step': message,
+                          'level': logging.getLevelName(level),
+                          'at_ms': round((at - self.started_at) * 1000, 3)})
+
+        return {'api_name': self.api_name,
+                'duration_ms': round((time.perf_counter() - self.started_at) * 1000, 3),
+                'outcome': self.outcome,
+                'steps': steps}
+
+    def emit(self):
+        '''Logs the trace once through avf.make_log, with the full payload for a sample only.'''
+
+        if random.random() < TRACE_PAYLOAD_SAMPLE_RATE:
+            request_data = self.request_data
+        else:
+            request_data = _summary(self.request_data)
+
+        avf.make_log(request_data=request_data,
+                     message=json.dumps(self.record(), default=str),
+                     api_name=self.api_name)
+
+
+def _summary(request_data):
+    try:
+        return {field: request_data.get(field) for field in TRACE_SUMMARY_FIELDS}
+    except AttributeError:
+        return {}
+
+
+def _outcome(response):
+    '''Short description of a view response for the trace record.'''
+
+    template = getattr(response, 'template', None)
+    if template is not None:
+        response = template.payload
+
+    if isinstance(response, dict) and 'request_status' in response:
+        body = response.get('body') or {}
+        return {'request_status': response['request_status'],
+                'request_message': response.get('request_message'),
+                'error_response_code': body.get('error_response_code')}
+
+    return {'response_type': type(response).__name__}
+
+
+def current():
+    '''Returns the StepTrace of the running request, or None outside a traced view.'''
+
+    return _current_trace.get()
+
+
+def step(message, *args, level=logging.INFO):
+    '''Records a step marker on the running request trace, no-op outside a traced view.'''
+
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.step(message, *args, level=level)
+
+
+def traced(api_name, payload=None):
+    '''Decorator for a view (sync or async), opens a StepTrace for the request and emits it
+    when the view returns or raises.
+
+    payload - callable returning the request payload to trace, request.form by default'''
+
+    def decorator(view):
+
+        def start():
+            request_data = payload() if payload is not None else request.form
+            trace = StepTrace(api_name, request_data)
+            return trace, _current_trace.set(trace)
+
+        def finish(trace, token):
+            _current_trace.reset(token)
+            metrics.observe('online_leads_request_seconds', time.perf_counter() - trace.started_at, view=view.__name__)
+            trace.emit()
+
+        if inspect.iscoroutinefunction(view):
+
+            @functools.wraps(view)
+            async def async_wrapper(*args, **kwargs):
+                trace, token = start()
+                try:
+                    response = await view(*args, **kwargs)
+                    trace.outcome = _outcome(response)
+                    return response
+                except Exception as exc:
+                    trace.outcome = {'exception': type(exc).__name__}
+                    raise
+                finally:
+                    finish(trace, token)
+
+            return async_wrapper
+
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            trace, token = start()
+            try:
+                response = view(*args, **kwargs)
+                trace.outcome = _outcome(response)
+                return response
+            except Exception as exc:
+                trace.outcome = {'exception': type(exc).__name__}
+                raise
+            finally:
+                finish(trace, token)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,310 @@
+"""
+In-memory cache of the "los_thresholds" values used by the online leads eligibility API.
+
+The thresholds change rarely, so they are read once into a frozen Thresholds object and
+refreshed by a background thread, either on a TTL or when a cheap version check reports a
+change. invalidate() forces a reload so policy changes apply at once: it reloads the
+thresholds of the process and rewrites a marker file the refreshers of the other workers of
+the host check as their version. Thresholds compiled into the reference_snapshot take
+precedence, until invalidate() is called; a new snapshot published after that takes
+precedence again.
+
+"""
+
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import namedtuple
+
+from los import los_function as lf
+from online_leads import db_pool
+from online_leads import metrics
+from online_leads import reference_snapshot
+
+
+logger = logging.getLogger(__name__)
+
+# seconds after which the thresholds are re-read from the table
+THRESHOLD_CACHE_TTL_SECONDS = float(os.environ.get('LOS_THRESHOLD_CACHE_TTL_SECONDS', 300))
+
+# seconds between two version checks, only used when a version_loader is given
+THRESHOLD_VERSION_CHECK_SECONDS = float(os.environ.get('LOS_THRESHOLD_VERSION_CHECK_SECONDS', 5))
+
+# file rewritten by invalidate(), shared by the workers of the host
+THRESHOLD_INVALIDATION_FILE = os.environ.get('LOS_THRESHOLD_INVALIDATION_FILE',
+                                             os.path.join(tempfile.gettempdir(), 'online_leads_thresholds.invalidated'))
+
+# var_key in "los_thresholds" -> field name on the Thresholds object
+THRESHOLD_KEYS = (('MIN_VINTAGE', 'min_vintage'),
+                  ('MAX_VINTAGE', 'max_vintage'),
+                  ('MIN_TURNOVER', 'min_turnover'),
+                  ('MAX_TURNOVER', 'max_turnover'),
+                  ('MIN_LOAN_AMOUNT', 'min_loan_amount'),
+                  ('MAX_LOAN_AMOUNT', 'max_loan_amount'),
+                  ('MIN_CRIF_SCORE', 'min_crif_score'),
+                  ('MAX_CRIF_SCORE', 'max_crif_score'))
+
+
+class Thresholds(namedtuple('Thresholds', [field for _, field in THRESHOLD_KEYS] + ['version'])):
+    '''Immutable set of typed threshold values along with the version they were read at.'''
+
+    __slots__ = ()
+
+    @classmethod
+    def from_frame(cls, threshold_df, version=None):
+        '''Builds the thresholds from the frame returned by lf.get_env_variables.
+        The frame is walked once instead of running one boolean scan per key.'''
+
+        values = dict(zip(threshold_df['var_key'], threshold_df['var_value']))
+
+        missing = [key for key, _ in THRESHOLD_KEYS if key not in values]
+        if missing:
+            raise KeyError(f'thresholds missing in los_thresholds: {missing}')
+
+        typed = {field: int(values[key]) for key, field in THRESHOLD_KEYS}
+
+        if version is None:
+            if 'updated_at' in threshold_df.columns and len(threshold_df):
+                version = str(threshold_df['updated_at'].max())
+            else:
+                content = repr(sorted(typed.items())).encode('utf-8')
+                version = hashlib.sha1(content).hexdigest()[:12]
+
+        return cls(version=version, **typed)
+
+
+class ThresholdCache(object):
+    '''Holds the current Thresholds for one api_name and keeps them fresh.
+
+    loader         - callable(api_name) returning the thresholds frame, db_pool.read_thresholds when
+                     the database pool is enabled, lf.get_env_variables otherwise
+    version_loader - optional cheap callable(api_name) returning a version / updated_at marker;
+                     when given, the table is also re-read before the TTL once this value
+                     changes. get_cache() passes invalidation_marker'''
+
+    def __init__(self,
+                 api_name,
+                 loader = None,
+                 ttl_seconds = THRESHOLD_CACHE_TTL_SECONDS,
+                 version_loader = None,
+                 version_check_seconds = THRESHOLD_VERSION_CHECK_SECONDS):
+
+        self.api_name = api_name
+        self.loader = loader or (db_pool.read_thresholds if db_pool.enabled() else lf.get_env_variables)
+        self.ttl_seconds = ttl_seconds
+        self.version_loader = version_loader
+        self.version_check_seconds = version_check_seconds
+
+        self._thresholds = None
+        self._loaded_at = 0.0
+        self._invalidations = 0
+        self._source_version = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def get(self):
+        '''Returns the cached thresholds. Only the very first call (or a call after
+        invalidate() with no refresher running) goes to the table.'''
+
+        thresholds = self._thresholds
+        if thresholds is not None and not self._is_stale():
+            return thresholds
+
+        if thresholds is not None and self._thread is not None and self._thread.is_alive():
+            # the background refresher is responsible for reloading, keep serving the old values
+            return thresholds
+
+        return self.refresh()
+
+    def refresh(self):
+        '''Reloads the thresholds from the table and swaps them in atomically.'''
+
+        with self._lock:
+            # taken before the load: the values are only as fresh as the start of the read, and
+            # an invalidate() arriving during the read leaves them stale
+            loaded_at = time.monotonic()
+            invalidations = self._invalidations
+            source_version = self._read_source_version()
+
+            with metrics.timed('get_env_variables'):
+                threshold_df = self.loader(self.api_name)
+            # the version describes the values, the result_cache keys on it
+            thresholds = Thresholds.from_frame(threshold_df)
+
+            if self._thresholds is None or thresholds != self._thresholds:
+                logger.info('thresholds loaded for %s --> %s', self.api_name, thresholds)
+
+            self._thresholds = thresholds
+            self._source_version = source_version
+            if self._invalidations == invalidations:
+                self._loaded_at = loaded_at
+            return thresholds
+
+    def invalidate(self):
+        '''Marks the cached thresholds as stale. The background refresher (if running)
+        reloads them immediately, otherwise the next get() does.'''
+
+        self._invalidations += 1
+        self._loaded_at = 0.0
+        self._wakeup.set()
+
+    def start(self):
+        '''Starts the background refresher thread.'''
+
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name=f'threshold-cache-{self.api_name}',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        '''Stops the background refresher thread.'''
+
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        self._thread = None
+
+    def _is_stale(self):
+        return time.monotonic() - self._loaded_at >= self.ttl_seconds
+
+    def _read_source_version(self):
+        if self.version_loader is None:
+            return None
+        return str(self.version_loader(self.api_name))
+
+    def _needs_reload(self):
+        if self._thresholds is None or self._is_stale():
+            return True
+
+        if self.version_loader is None:
+            return False
+
+        return self._read_source_version() != self._source_version
+
+    def _run(self):
+        if self.version_loader is not None:
+            interval = min(self.ttl_seconds, self.version_check_seconds)
+        else:
+            interval = self.ttl_seconds
+
+        while not self._stopped.is_set():
+            try:
+                if self._needs_reload():
+                    self.refresh()
+            except Exception:
+                # keep serving the last known good thresholds
+                logger.exception('threshold refresh failed for %s', self.api_name)
+
+            self._wakeup.wait(interval)
+            self._wakeup.clear()
+
+
+#====================================================================================
+# Module level cache per api_name
+#====================================================================================
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(api_name, **kwargs):
+    '''Returns the ThresholdCache for api_name, creating and starting it on first use.'''
+
+    cache = _caches.get(api_name)
+    if cache is None:
+        with _caches_lock:
+            cache = _caches.get(api_name)
+            if cache is None:
+                kwargs.setdefault('version_loader', invalidation_marker)
+                cache = ThresholdCache(api_name, **kwargs)
+                cache.start()
+                _caches[api_name] = cache
+    return cache
+
+
+def get_thresholds(api_name):
+    '''Returns the Thresholds for api_name from the reference snapshot, else from the cache.'''
+
+    snapshot = reference_snapshot.current()
+    if snapshot is not None and snapshot.version != _invalidated_snapshot():
+        thresholds = snapshot.thresholds(api_name)
+        if thresholds is not None:
+            return thresholds
+
+    return get_cache(api_name).get()
+
+
+def invalidate(api_name=None):
+    '''Invalidates the cached thresholds of api_name, or of every api when not given. The other
+    workers reload all of theirs once they see the new marker, within
+    THRESHOLD_VERSION_CHECK_SECONDS; the thresholds of the current reference snapshot are not
+    used anymore by any of them.'''
+
+    snapshot = reference_snapshot.current()
+    _write_marker(f'{time.time_ns()} {snapshot.version if snapshot is not None else ""}')
+
+    if api_name is None:
+        caches = list(_caches.values())
+    else:
+        caches = [_caches[api_name]] if api_name in _caches else []
+
+    for cache in caches:
+        cache.invalidate()
+
+
+#====================================================================================
+# Invalidation marker shared by the workers
+#====================================================================================
+# (marker, monotonic time it was read at)
+_marker = ('', float('-inf'))
+_marker_lock = threading.Lock()
+
+
+def _write_marker(marker):
+    global _marker
+
+    path = THRESHOLD_INVALIDATION_FILE
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, 'w') as marker_file:
+        marker_file.write(marker)
+    os.replace(temp_path, path)
+
+    with _marker_lock:
+        _marker = (marker, time.monotonic())
+
+
+def invalidation_marker(api_name=None):
+    '''Contents of the invalidation marker file, '' when none was written. Read again at most
+    every THRESHOLD_VERSION_CHECK_SECONDS; the version_loader of the caches.'''
+
+    global _marker
+
+    marker, read_at = _marker
+    now = time.monotonic()
+    if now - read_at < THRESHOLD_VERSION_CHECK_SECONDS:
+        return marker
+
+    with _marker_lock:
+        try:
+            with open(THRESHOLD_INVALIDATION_FILE) as marker_file:
+                marker = marker_file.read()
+        except OSError:
+            # not written yet
+            marker = ''
+        _marker = (marker, now)
+    return marker
+
+
+def _invalidated_snapshot():
+    # version of the reference snapshot current at the last invalidate(), None when none was
+    return invalidation_marker().partition(' ')[2] or None
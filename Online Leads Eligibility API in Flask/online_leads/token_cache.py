@@ -0,0 +1,190 @@
+"""
+Bounded LRU/TTL cache in front of avf.validate_token_and_api_access.
+
+Results are cached per (token, credentials, api_name): successful validations for
+TOKEN_CACHE_TTL_SECONDS and failed ones for the shorter TOKEN_CACHE_NEGATIVE_TTL_SECONDS. The
+credentials part is a hash of the fields avf reads besides the token (LOS_TOKEN_CREDENTIAL_PARAMS),
+so a cached token sent with other credentials is validated again. revoke() drops a token from the
+cache of the current process at once. Tokens listed in the LOS_TOKEN_REVOCATION_PATH file (one per
+line) are never served from the cache of any worker, the file is re-read every second when changed.
+
+"""
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from utilities import api_validation_function as avf
+from online_leads import metrics
+from online_leads.snapshot_watcher import SnapshotWatcher
+
+
+# request params identifying the caller, the cache is skipped when none of them is sent
+TOKEN_PARAMS = tuple(param.strip() for param in os.environ.get('LOS_TOKEN_PARAMS', 'token').split(',') if param.strip())
+
+# request fields checked by avf along with the token, e.g. a user id or an api key header; every
+# field avf reads has to be listed, the others (User-Agent, Content-Length, ...) are not hashed
+TOKEN_CREDENTIAL_PARAMS = tuple(param.strip() for param in os.environ.get('LOS_TOKEN_CREDENTIAL_PARAMS', '').split(',')
+                                if param.strip())
+
+# seconds a successful / failed validation is served from the cache
+TOKEN_CACHE_TTL_SECONDS = float(os.environ.get('LOS_TOKEN_CACHE_TTL_SECONDS', 60))
+TOKEN_CACHE_NEGATIVE_TTL_SECONDS = float(os.environ.get('LOS_TOKEN_CACHE_NEGATIVE_TTL_SECONDS', 5))
+
+# maximum number of cached (token, api_name) entries
+TOKEN_CACHE_MAX_SIZE = int(os.environ.get('LOS_TOKEN_CACHE_MAX_SIZE', 10000))
+
+# file listing revoked tokens, shared by all workers
+TOKEN_REVOCATION_PATH = os.environ.get('LOS_TOKEN_REVOCATION_PATH')
+
+metrics.METRIC_HELP['online_leads_token_cache_total'] = 'Token validations by cache result.'
+
+
+def _read_revoked_tokens(paths):
+    revocation_path, = paths
+    with open(revocation_path, 'r', encoding='utf-8') as revocation_file:
+        return frozenset(line.strip() for line in revocation_file if line.strip())
+
+
+class TokenCache(object):
+    '''LRU cache of validate_token_and_api_access results with separate positive and negative TTLs.'''
+
+    def __init__(self,
+                 validate = None,
+                 token_params = TOKEN_PARAMS,
+                 credential_params = TOKEN_CREDENTIAL_PARAMS,
+                 ttl_seconds = TOKEN_CACHE_TTL_SECONDS,
+                 negative_ttl_seconds = TOKEN_CACHE_NEGATIVE_TTL_SECONDS,
+                 max_size = TOKEN_CACHE_MAX_SIZE,
+                 revocation_path = TOKEN_REVOCATION_PATH):
+
+        self.validate = validate or avf.validate_token_and_api_access
+        self.token_params = token_params
+        self.credential_params = credential_params
+        self.ttl_seconds = ttl_seconds
+        self.negative_ttl_seconds = negative_ttl_seconds
+        self.max_size = max_size
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._revoked = SnapshotWatcher(paths=(revocation_path,),
+                                        build=_read_revoked_tokens,
+                                        reload_check_seconds=1.0,
+                                        name='token revocation list')
+        self._revoked.start()
+
+    def _token(self, request_data):
+        token = tuple(request_data.get(param) for param in self.token_params)
+        if all(value is None for value in token):
+            return None
+        return token
+
+    def _credentials(self, request_data):
+        '''Hash of the credential fields of the request, the token params included.'''
+
+        digest = hashlib.blake2b(digest_size=16)
+        for param in self.token_params + self.credential_params:
+            value = request_data.get(param)
+            digest.update(param.encode('utf-8') + b'\0' + repr(value).encode('utf-8') + b'\0')
+        return digest.digest()
+
+    def _is_revoked(self, token):
+        revoked = self._revoked.value
+        return bool(revoked) and any(value in revoked for value in token if value is not None)
+
+    def validate_token_and_api_access(self, request_data, api_name):
+        '''Drop-in replacement of avf.validate_token_and_api_access served from the cache.'''
+
+        token = self._token(request_data)
+        if token is None:
+            metrics.inc('online_leads_token_cache_total', result='uncacheable')
+            return self.validate(request_data, api_name)
+
+        if self._is_revoked(token):
+            self.revoke(token)
+            metrics.inc('online_leads_token_cache_total', result='revoked')
+            return self.validate(request_data, api_name)
+
+        key = (token, self._credentials(request_data), api_name)
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                result, expires_at = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    metrics.inc('online_leads_token_cache_total',
+                                result='hit' if result['status'] != 'fail' else 'negative_hit')
+                    return dict(result)
+                del self._entries[key]
+
+        metrics.inc('online_leads_token_cache_total', result='miss')
+        result = self.validate(request_data, api_name)
+
+        ttl_seconds = self.negative_ttl_seconds if result['status'] == 'fail' else self.ttl_seconds
+        if ttl_seconds > 0:
+            with self._lock:
+                self._entries[key] = (dict(result), now + ttl_seconds)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+
+        return result
+
+    def revoke(self, token, api_name=None):
+        '''Drops a token from the cache, for one api_name or for every api.
+        token is the token value, or the tuple of TOKEN_PARAMS values.'''
+
+        if not isinstance(token, tuple):
+            token = (token,)
+
+        with self._lock:
+            for key in list(self._entries):
+                cached_token, _, cached_api_name = key
+                if api_name is not None and cached_api_name != api_name:
+                    continue
+                if cached_token == token or (len(token) == 1 and token[0] in cached_token):
+                    del self._entries[key]
+
+    def clear(self):
+        '''Drops every cached result.'''
+
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+#====================================================================================
+# Module level cache
+#====================================================================================
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    '''Returns the process wide TokenCache, created on first use.'''
+
+    global _cache
+
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = TokenCache()
+    return _cache
+
+
+def validate_token_and_api_access(request_data, api_name):
+    '''Drop-in replacement of avf.validate_token_and_api_access served from the cache.'''
+
+    return get_cache().validate_token_and_api_access(request_data, api_name)
+
+
+def revoke(token, api_name=None):
+    '''Drops a revoked token from the cache so it stops working at once in this process.'''
+
+    get_cache().revoke(token, api_name)
@@ -0,0 +1,299 @@
+"""
+Vectorized evaluation of the online leads eligibility checks over a batch of leads.
+
+The checks follow the same order and produce the same responses as the single lead
+endpoint, the first failing check decides the outcome of a lead. Pincode, sector and
+sub-sector lookups are done once per distinct value instead of once per lead.
+
+"""
+
+import os
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from online_leads import highmark_report
+from online_leads import pincode_index
+from online_leads import request_schema
+from online_leads import sector_index
+from online_leads.eligibility_rules import NON_SERVICEABLE_LOAN_PURPOSES, highmark_xml_score_not_eligible
+from online_leads.request_schema import MANDATORY_PARAMS, NUMERIC_PARAMS, NON_NEGATIVE_PARAMS, TEXT_NUMERIC_PARAMS
+
+
+# maximum number of leads accepted in one batch call
+MAX_BATCH_SIZE = int(os.environ.get('LOS_MAX_BATCH_SIZE', 5000))
+
+
+def leads_to_frame(leads):
+    '''Converts a list of lead dicts into a DataFrame with every mandatory column present.'''
+
+    leads_df = pd.DataFrame.from_records(leads)
+
+    for column in MANDATORY_PARAMS + ('loan_purpose', 'dev_bypass', 'applicant_highmark_XML'):
+        if column not in leads_df.columns:
+            leads_df[column] = None
+
+    # pandas makes a column of numbers and nulls float, the text params keep the values as sent
+    for column in TEXT_NUMERIC_PARAMS:
+        leads_df[column] = pd.Series([lead.get(column) for lead in leads], index=leads_df.index, dtype=object)
+
+    return leads_df
+
+
+# vintage group of a business type, the vintage threshold depends on it
+VINTAGE_GROUP_OTHER = 0
+VINTAGE_GROUP_MANUFACTURING = 1
+VINTAGE_GROUP_TRADING_SERVICES = 2
+
+
+class RuleColumns(namedtuple('RuleColumns', ['vintage_group',
+                                             'vintage_months',
+                                             'turnover',
+                                             'loan_amount',
+                                             'highmark_score',
+                                             'loan_purpose_excluded'])):
+    '''Typed arrays read by the arithmetic rules, one value per lead. They do not depend on the
+    thresholds, so they are built once and can be checked against any number of thresholds.'''
+
+    __slots__ = ()
+
+    def take(self, idx):
+        '''Columns of the leads at the given positions (or boolean mask).'''
+
+        return RuleColumns(*(column[idx] for column in self))
+
+
+def map_distinct(values, func):
+    '''Applies func once per distinct value and returns the results as an array in lead order.'''
+
+    codes, uniques = pd.factorize(pd.Series(values, dtype=object), use_na_sentinel=False)
+    return np.asarray([func(value) for value in uniques])[codes]
+
+
+def to_numeric(values):
+    '''Numeric values of a column, NaN where not a number. Text columns are coerced once per
+    distinct value, recorded amounts repeat a lot.'''
+
+    values = pd.Series(values)
+    if pd.api.types.is_numeric_dtype(values.dtype):
+        return pd.to_numeric(values, errors='coerce')
+
+    codes, uniques = pd.factorize(values.astype(object), use_na_sentinel=False)
+    numbers = pd.to_numeric(pd.Series(uniques, dtype=object), errors='coerce').to_numpy(dtype=float)
+    return pd.Series(numbers[codes], index=values.index)
+
+
+def _text(value):
+    return None if value is None or (isinstance(value, float) and np.isnan(value)) else str(value)
+
+
+def _integral_text(value):
+    if pd.isna(value):
+        return None
+    return str(int(value)) if float(value).is_integer() else str(value)
+
+
+def raw_text(values):
+    '''Text of every value as the single lead endpoint reads it, None for a null. A float column
+    is one pandas built from numbers and nulls (e.g. a Parquet export), its integral values are
+    read back as the integers sent.'''
+
+    values = pd.Series(values)
+    func = _integral_text if pd.api.types.is_float_dtype(values.dtype) else _text
+    return map_distinct(values, func).astype(object)
+
+
+def _integer(value):
+    number = request_schema.parse_int(value)
+    return np.nan if number is None else number
+
+
+def _vintage_group(business_type):
+    business_type = str(business_type).lower()
+    if business_type == 'manufacturing':
+        return VINTAGE_GROUP_MANUFACTURING
+    if business_type in ('trading', 'services'):
+        return VINTAGE_GROUP_TRADING_SERVICES
+    return VINTAGE_GROUP_OTHER
+
+
+def _loan_purpose_excluded(loan_purpose):
+    loan_purpose = 'missing' if pd.isna(loan_purpose) else str(loan_purpose)
+    return loan_purpose.lower().replace(' ', '_') in NON_SERVICEABLE_LOAN_PURPOSES
+
+
+def rule_columns(leads_df):
+    '''Builds the RuleColumns of a frame of leads, string params are mapped once per distinct value.
+    Expects the numeric columns to be coerced already.'''
+
+    if not len(leads_df):
+        empty = np.zeros(0)
+        return RuleColumns(empty.astype(np.int8), empty, empty, empty, empty, empty.astype(bool))
+
+    return RuleColumns(vintage_group=map_distinct(leads_df['business_type'], _vintage_group).astype(np.int8),
+                       vintage_months=np.trunc(leads_df['vintage_months'].to_numpy(dtype=float)),
+                       turnover=np.trunc(leads_df['average_annual_turnover'].to_numpy(dtype=float)),
+                       loan_amount=np.trunc(leads_df['required_loan_amount'].to_numpy(dtype=float)),
+                       highmark_score=np.trunc(leads_df['app_highmark_score_A8'].to_numpy(dtype=float)),
+                       loan_purpose_excluded=map_distinct(leads_df['loan_purpose'], _loan_purpose_excluded).astype(bool))
+
+
+def rule_masks(columns, thresholds):
+    '''Returns the arithmetic rule masks (vintage, turnover, loan amount, highmark score
+    and loan purpose) of RuleColumns in check order, True where the lead fails the rule.'''
+
+    vintage_months = columns.vintage_months
+
+    low_vintage = (((columns.vintage_group == VINTAGE_GROUP_MANUFACTURING) & (vintage_months < thresholds.min_vintage)) |
+                   ((columns.vintage_group == VINTAGE_GROUP_TRADING_SERVICES) & (vintage_months < thresholds.max_vintage)))
+
+    return [('vintage', low_vintage),
+            ('turnover', (columns.turnover < thresholds.min_turnover) | (columns.turnover > thresholds.max_turnover)),
+            ('loan_amount', (columns.loan_amount < thresholds.min_loan_amount) | (columns.loan_amount > thresholds.max_loan_amount)),
+            ('highmark_score', (columns.highmark_score < thresholds.max_crif_score) & (columns.highmark_score > thresholds.min_crif_score)),
+            ('loan_purpose', columns.loan_purpose_excluded)]
+
+
+def eligibility_rule_masks(leads_df, thresholds):
+    '''Returns the arithmetic rule masks of a frame of leads in check order, True where the
+    lead fails the rule. Expects the numeric columns to be coerced already.'''
+
+    return rule_masks(rule_columns(leads_df), thresholds)
+
+
+def _distinct_lookup(key_columns, pending, lookup):
+    '''Calls lookup(idx, key) once per distinct key among the pending leads, key being the tuple
+    of the key_columns values of the lead (or the value itself for a single column).
+    Returns a bool array with the lookup result of every pending lead.'''
+
+    codes = None
+    for column in key_columns:
+        column_codes, uniques = pd.factorize(pd.Series(column, dtype=object), use_na_sentinel=False)
+        if codes is None:
+            codes = column_codes
+        else:
+            codes, _ = pd.factorize(codes * len(uniques) + column_codes)
+
+    flags = np.zeros(len(pending), dtype=bool)
+    pending_idx = np.flatnonzero(pending)
+    if not len(pending_idx):
+        return flags
+
+    # first pending lead of every distinct key, in lead order
+    distinct_codes, first = np.unique(codes[pending_idx], return_index=True)
+    results = np.zeros(codes.max() + 1, dtype=bool)
+    for code, idx in sorted(zip(distinct_codes, pending_idx[first]), key=lambda item: item[1]):
+        key = tuple(column[idx] for column in key_columns)
+        results[code] = bool(lookup(idx, key if len(key_columns) > 1 else key[0]))
+
+    flags[pending_idx] = results[codes[pending_idx]]
+    return flags
+
+
+def screen_leads(leads_df, api_name,
+                 check_pincode = None,
+                 validate_sector = None,
+                 validate_subsector = None,
+                 request_data = None):
+    '''Runs the checks which do not depend on the thresholds: mandatory params, dev bypass,
+    numeric and non negative params, and CHECK 1 to CHECK 3. Coerces the numeric columns
+    of leads_df in place. request_data(idx) gives the data sent to the Pincode Eng API.
+
+    Returns (outcome, pending): the eligibility_rules.OUTCOMES key of every lead decided so
+    far ('success' otherwise) and True for every lead which reaches CHECK 4.'''
+
+    check_pincode = check_pincode or pincode_index.check_pincode
+    validate_sector = validate_sector or sector_index.validate_sector
+    validate_subsector = validate_subsector or sector_index.validate_subsector
+    request_data = request_data or (lambda idx: leads_df.iloc[idx].to_dict())
+
+    outcome = np.full(len(leads_df), 'success', dtype=object)
+    pending = np.ones(len(leads_df), dtype=bool)
+
+    def reject(mask, key):
+        mask = np.asarray(mask, dtype=bool) & pending
+        outcome[mask] = key
+        pending[mask] = False
+
+    # mandatory params, null or empty counts as not sent
+    missing = leads_df[list(MANDATORY_PARAMS)].isna().any(axis=1).to_numpy(copy=True)
+    for param in MANDATORY_PARAMS:
+        missing |= map_distinct(leads_df[param], request_schema.is_blank).astype(bool)
+    reject(missing, 'missing_params')
+
+    # dev bypass
+    reject(map_distinct(leads_df['dev_bypass'], lambda value: str(value).lower() == 'true').astype(bool), 'dev_bypass')
+
+    # numeric data type, in parameter order. Raw pincode is kept for the length check.
+    raw_pincode = raw_text(leads_df['business_pincode'])
+    for param in NUMERIC_PARAMS:
+        leads_df[param] = to_numeric(leads_df[param])
+        reject(~np.isfinite(leads_df[param].to_numpy(dtype=float)), f'numeric:{param}')
+
+    # non negative params
+    for param in NON_NEGATIVE_PARAMS:
+        reject((leads_df[param] < 0).to_numpy(), f'negative:{param}')
+
+    # highmark score is parsed as an integer, with the parser of the single lead endpoint
+    not_number = map_distinct(leads_df['app_highmark_score_A8'],
+                              lambda value: request_schema.parse_number(value) is None).astype(bool)
+    leads_df['app_highmark_score_A8'] = map_distinct(leads_df['app_highmark_score_A8'], _integer).astype(float)
+    not_integer = leads_df['app_highmark_score_A8'].isna().to_numpy()
+    reject(not_integer & not_number, 'numeric:app_highmark_score_A8')
+    reject(not_integer, 'integer:app_highmark_score_A8')
+
+    # CHECK 1 - pincode length and serviceability
+    reject(map_distinct(raw_pincode, lambda pincode: len(pincode) if isinstance(pincode, str) else 0) >= 7, 'pincode_wrong')
+
+    serviceable = _distinct_lookup([raw_pincode], pending,
+                                   lambda idx, pincode: check_pincode(pincode, request_data=request_data(idx), api_name=api_name))
+    reject(~serviceable, 'pincode')
+
+    # CHECK 2 - sector validity
+    main_sector = leads_df['business_main_sector'].to_numpy(dtype=object)
+    business_type = leads_df['business_type'].to_numpy(dtype=object)
+    valid_sector = _distinct_lookup([main_sector, business_type], pending, lambda idx, key: validate_sector(*key))
+    reject(~valid_sector, 'sector')
+
+    # CHECK 3 - sub-sector validity
+    specific_sector = leads_df['business_specific_sector'].to_numpy(dtype=object)
+    excluded_subsector = _distinct_lookup([main_sector, business_type, specific_sector], pending,
+                                          lambda idx, key: validate_subsector(*key))
+    reject(excluded_subsector, 'subsector')
+
+    return outcome, pending
+
+
+def evaluate_leads(leads, thresholds, api_name,
+                   check_pincode = None,
+                   validate_sector = None,
+                   validate_subsector = None):
+    '''Runs all eligibility checks over a list of lead dicts.
+    Returns a list with one eligibility_rules.OUTCOMES key per lead, in the order of the leads.'''
+
+    leads_df = leads_to_frame(leads)
+    outcome, pending = screen_leads(leads_df, api_name,
+                                    check_pincode=check_pincode,
+                                    validate_sector=validate_sector,
+                                    validate_subsector=validate_subsector,
+                                    request_data=lambda idx: leads[idx])
+
+    def reject(mask, key):
+        mask = np.asarray(mask, dtype=bool) & pending
+        outcome[mask] = key
+        pending[mask] = False
+
+    # CHECK 4 to 8 - arithmetic rules over the whole batch
+    for key, mask in eligibility_rule_masks(leads_df, thresholds):
+        reject(mask, key)
+
+    # CHECK 9 - Highmark XML score, each report is read once per batch
+    if highmark_report.HIGHMARK_XML_ENABLED:
+        report_urls = leads_df['applicant_highmark_XML'].to_numpy(dtype=object)
+        low_xml_score = _distinct_lookup([report_urls], pending,
+                                         lambda idx, url: highmark_xml_score_not_eligible(request_schema.parse(leads[idx]),
+                                                                                          thresholds, api_name))
+        reject(low_xml_score, 'highmark_xml')
+
+    return outcome.tolist()
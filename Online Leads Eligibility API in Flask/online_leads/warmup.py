@@ -0,0 +1,94 @@
+"""
+Warm-up of a worker of the online leads eligibility API before it accepts traffic.
+
+The caches, reference data and background threads of the online_leads helpers are created
+on first use, so without a warm-up the first requests of a new worker pay for the threshold
+query, the snapshot loads and the thread starts. warm_up() runs those steps up front; it is
+meant to be called after the fork, from the gunicorn post_worker_init hook, since threads
+started before the fork do not survive it. A failing step is logged and skipped, the worker
+still starts and the step is retried by the first request that needs it.
+
+"""
+
+import logging
+import os
+import time
+
+from online_leads import admission
+from online_leads import async_lookups
+from online_leads import db_pool
+from online_leads import highmark_report
+from online_leads import hist_writer
+from online_leads import metrics
+from online_leads import pincode_index
+from online_leads import reference_snapshot
+from online_leads import sector_index
+from online_leads import threshold_cache
+from online_leads import token_cache
+
+
+logger = logging.getLogger(__name__)
+
+# also load the batch checks (pandas, numpy) during the warm-up
+WARM_UP_BATCH = os.environ.get('LOS_WARM_UP_BATCH', 'false').lower() == 'true'
+
+
+def _load_reference_data():
+    snapshot = reference_snapshot.current()
+    serviceability = pincode_index.get_serviceability()
+    sector_index.get_reference()
+
+    # the Pincode Eng API is only called while neither a snapshot with pincodes nor the index is loaded
+    if (snapshot is None or snapshot.is_serviceable('0') is None) and serviceability.index is None:
+        pincode_index.get_breaker()
+
+
+def _warm_up_db_pool():
+    db_pool.get_pool().fill(db_pool.DB_POOL_MIN_SIZE)
+    db_pool.check_schema()
+
+
+def _load_batch_checks():
+    from online_leads import vectorized_rules
+
+    return vectorized_rules
+
+
+def warm_up(api_name, batch=WARM_UP_BATCH):
+    '''Runs every warm-up step for api_name. Returns {step: seconds taken, None when it failed}.'''
+
+    steps = []
+    if db_pool.enabled():
+        # before the thresholds and the history writer, which fall back to lf and avf on a schema error
+        steps.append(('db_pool', _warm_up_db_pool))
+
+    steps += [('thresholds', lambda: threshold_cache.get_thresholds(api_name)),
+              ('reference_data', _load_reference_data),
+              ('token_cache', token_cache.get_cache),
+              ('hist_writer', hist_writer.get_writer),
+              ('admission', admission.get_controller),
+              ('async_lookups', async_lookups.get_executor)]
+
+    if highmark_report.HIGHMARK_XML_ENABLED:
+        steps.append(('highmark_report', highmark_report.get_fetcher))
+
+    if batch:
+        steps.append(('batch_checks', _load_batch_checks))
+
+    timings = {}
+    started_at = time.perf_counter()
+
+    for step, run in steps:
+        step_started_at = time.perf_counter()
+        try:
+            with metrics.timed(f'warm_up_{step}'):
+                run()
+        except Exception:
+            logger.exception('warm-up step %s failed for %s', step, api_name)
+            timings[step] = None
+            continue
+        timings[step] = time.perf_counter() - step_started_at
+
+    logger.info('worker %s warmed up for %s in %.3f s: %s',
+                os.getpid(), api_name, time.perf_counter() - started_at, timings)
+    return timings
@@ -0,0 +1,32 @@
+"""
+Test setup: the blueprint is mounted on the local stand-ins of avf and lf (benchmarks.fakes),
+with no simulated latency.
+
+"""
+
+import os
+import sys
+
+import pytest
+
+API_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if API_FOLDER not in sys.path:
+    sys.path.insert(0, API_FOLDER)
+
+from benchmarks import fakes
+from benchmarks.run_benchmark import create_app
+
+
+@pytest.fixture(scope='session')
+def api():
+    '''(app, blueprint_module, fake database) shared by the tests.'''
+
+    app, module, database, _ = create_app(fakes.Latency(token_ms=0, thresholds_ms=0, pincode_ms=0,
+                                                        sector_ms=0, hist_ms=0))
+    yield app, module, database
+    module.hist_writer.get_writer().stop()
+
+
+@pytest.fixture()
+def client(api):
+    return api[0].test_client()
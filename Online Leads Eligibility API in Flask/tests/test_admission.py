@@ -0,0 +1,144 @@
+"""
+Admission: the token buckets keyed by client, the flock concurrency slots and the load
+shedding replies.
+
+"""
+
+import itertools
+
+import pytest
+
+from benchmarks import fakes
+from benchmarks.run_benchmark import API_URL, BATCH_API_URL, BASE_LEAD
+
+
+_application_ids = itertools.count()
+
+
+def lead(**changes):
+    data = dict(BASE_LEAD, token=fakes.VALID_TOKEN, application_id=f'ADMISSION-{next(_application_ids)}')
+    data.update(changes)
+    return data
+
+
+class Clock(object):
+    '''Stands in for the time module of admission, moved by hand.'''
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture()
+def admission(api):
+    from online_leads import admission
+
+    return admission
+
+
+@pytest.fixture()
+def clock(admission, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(admission, 'time', clock)
+    return clock
+
+
+def test_bucket_refills_at_its_rate(admission, clock, tmp_path):
+    buckets = admission.TokenBuckets(str(tmp_path / 'buckets'), rate=2, burst=2)
+
+    assert buckets.take('10.0.0.1') == 0
+    assert buckets.take('10.0.0.1') == 0
+    assert buckets.take('10.0.0.1') == pytest.approx(0.5)
+
+    clock.now += 0.5
+    assert buckets.take('10.0.0.1') == 0
+
+
+def test_batch_is_charged_per_lead(admission, clock, tmp_path):
+    buckets = admission.TokenBuckets(str(tmp_path / 'buckets'), rate=1, burst=4)
+
+    # a batch larger than the burst is admitted from a full bucket and leaves it in debt
+    assert buckets.take('10.0.0.1', 6) == 0
+    assert buckets.take('10.0.0.1') == pytest.approx(3)
+
+
+def test_full_slot_does_not_reset_other_clients(admission, clock, monkeypatch, tmp_path):
+    monkeypatch.setattr(admission, 'ADMISSION_BUCKET_PROBES', 1)
+    buckets = admission.TokenBuckets(str(tmp_path / 'buckets'), rate=1, burst=1, slots=1)
+
+    assert buckets.take('10.0.0.1') == 0
+    # every other client shares the one live bucket, it does not start a full one
+    for client in ('10.0.0.2', '10.0.0.3', '10.0.0.4'):
+        assert buckets.take(client) > 0
+    assert buckets.take('10.0.0.1') > 0
+
+
+def test_refilled_slot_expires(admission, clock, monkeypatch, tmp_path):
+    monkeypatch.setattr(admission, 'ADMISSION_BUCKET_PROBES', 1)
+    buckets = admission.TokenBuckets(str(tmp_path / 'buckets'), rate=1, burst=1, slots=1)
+
+    assert buckets.take('10.0.0.1') == 0
+    clock.now += 1
+    assert buckets.take('10.0.0.2') == 0
+    assert buckets.take('10.0.0.1') > 0
+
+
+def test_concurrency_slots_are_shared_through_the_lock_files(admission, tmp_path):
+    # two limiters on one directory stand in for two workers
+    first = admission.ConcurrencyLimiter(str(tmp_path), max_concurrency=1)
+    second = admission.ConcurrencyLimiter(str(tmp_path), max_concurrency=1)
+
+    slot = first.acquire()
+    assert slot == 0
+    assert first.acquire() is None
+    assert second.acquire() is None
+
+    first.release(slot)
+    assert second.acquire() == 0
+
+
+def test_rate_limit_is_per_client_not_per_token(admission, client, monkeypatch, tmp_path):
+    controller = admission.AdmissionController(state_dir=str(tmp_path), token_rate=0.001, token_burst=2,
+                                               max_concurrency=0)
+    monkeypatch.setattr(admission, '_controller', controller)
+
+    assert client.post(API_URL, json=lead()).status_code == 200
+    assert client.post(API_URL, json=lead(token='made-up-1')).status_code == 200
+
+    shed = client.post(API_URL, json=lead(token='made-up-2'))
+    assert shed.status_code == 429
+    assert shed.get_json()['request_message'] == 'too many requests from this client, retry later'
+    assert int(shed.headers['Retry-After']) >= 1
+
+    other_client = client.post(API_URL, json=lead(), environ_base={'REMOTE_ADDR': '10.0.0.9'})
+    assert other_client.status_code == 200
+
+
+def test_batch_takes_one_token_per_lead(admission, client, monkeypatch, tmp_path):
+    controller = admission.AdmissionController(state_dir=str(tmp_path), token_rate=0.001, token_burst=3,
+                                               max_concurrency=0)
+    monkeypatch.setattr(admission, '_controller', controller)
+
+    batch = client.post(BATCH_API_URL, json={'token': fakes.VALID_TOKEN, 'leads': [lead(), lead(), lead()]})
+    assert batch.status_code == 200
+
+    assert client.post(API_URL, json=lead()).status_code == 429
+
+
+def test_overload_is_shed_with_retry_after(admission, client, monkeypatch, tmp_path):
+    controller = admission.AdmissionController(state_dir=str(tmp_path), token_rate=0, max_concurrency=1,
+                                               retry_after_seconds=3)
+    monkeypatch.setattr(admission, '_controller', controller)
+
+    slot = controller.limiter.acquire()
+    try:
+        shed = client.post(API_URL, json=lead())
+        assert shed.status_code == 503
+        assert shed.get_json()['request_message'] == 'service busy, retry later'
+        assert shed.headers['Retry-After'] == '3'
+    finally:
+        controller.release(slot)
+
+    assert client.post(API_URL, json=lead()).status_code == 200
@@ -0,0 +1,58 @@
+"""
+The async route looks nothing up for a request whose token is not valid, which is answered
+from a stored response or whose pincode is too long.
+
+"""
+
+from benchmarks import fakes
+from benchmarks.run_benchmark import ASYNC_API_URL, BASE_LEAD
+
+
+def test_lookups_wait_for_the_token(api, client, monkeypatch):
+    from los import los_function as lf
+
+    pincode_checks = []
+    check_pincode = lf.check_pincode
+
+    def recording_check_pincode(business_pincode, request_data=None, api_name=None):
+        pincode_checks.append(business_pincode)
+        return check_pincode(business_pincode, request_data=request_data, api_name=api_name)
+
+    monkeypatch.setattr(lf, 'check_pincode', recording_check_pincode)
+
+    rejected = client.post(ASYNC_API_URL, json=dict(BASE_LEAD, token='wrong-token', application_id='ASYNC-1'))
+    assert rejected.get_json()['request_message'] == 'invalid token'
+    assert pincode_checks == []
+
+    accepted = client.post(ASYNC_API_URL, json=dict(BASE_LEAD, token=fakes.VALID_TOKEN, application_id='ASYNC-2'))
+    assert accepted.get_json()['body']['online_leads_eligibility_status'] == 'success'
+    assert pincode_checks == [BASE_LEAD['business_pincode']]
+
+
+def test_lookups_wait_for_the_duplicate_and_pincode_checks(api, client, monkeypatch):
+    from los import los_function as lf
+
+    lookups = []
+
+    def recording(name, lookup):
+        def recorded(*args, **kwargs):
+            lookups.append(name)
+            return lookup(*args, **kwargs)
+        return recorded
+
+    monkeypatch.setattr(lf, 'check_pincode', recording('pincode', lf.check_pincode))
+    monkeypatch.setattr(lf, 'validate_sector', recording('sector', lf.validate_sector))
+    monkeypatch.setattr(lf, 'validate_subsector', recording('subsector', lf.validate_subsector))
+
+    data = dict(BASE_LEAD, token=fakes.VALID_TOKEN, application_id='ASYNC-3')
+    assert client.post(ASYNC_API_URL, json=data).get_json()['body']['online_leads_eligibility_status'] == 'success'
+    assert sorted(lookups) == ['pincode', 'sector', 'subsector']
+
+    # the redelivered lead is answered from the stored response
+    del lookups[:]
+    assert client.post(ASYNC_API_URL, json=data).get_json()['body']['online_leads_eligibility_status'] == 'success'
+    assert lookups == []
+
+    wrong_pincode = client.post(ASYNC_API_URL, json=dict(data, application_id='ASYNC-4', business_pincode='5600011'))
+    assert wrong_pincode.get_json()['body']['body_message'] == 'entered pincode is wrong'
+    assert lookups == []
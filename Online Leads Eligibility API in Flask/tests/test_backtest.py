@@ -0,0 +1,74 @@
+"""
+The backtest gives every lead of a history export the outcome the scalar rules give it.
+
+"""
+
+import json
+
+import pandas as pd
+import pytest
+
+from benchmarks import fakes
+from benchmarks.run_benchmark import API_NAME, BASE_LEAD, LEAD_PATHS
+
+
+def sample_leads():
+    '''One lead per benchmark path (the token path aside) and a few more edge cases.'''
+
+    changes = [path_changes for path, (path_changes, _) in LEAD_PATHS.items() if path != 'token']
+    changes += [{'app_highmark_score_A8': '720.0'}, {'app_highmark_score_A8': '720.5'},
+                {'vintage_months': '18', 'business_type': 'manufacturing'}, {'business_name': '  '}]
+
+    leads = []
+    for number, lead_changes in enumerate(changes):
+        lead = dict(BASE_LEAD, application_id=f'BACKTEST-{number}')
+        for key, value in lead_changes.items():
+            if value is None:
+                lead.pop(key, None)
+            else:
+                lead[key] = value
+        leads.append(lead)
+    return leads
+
+
+def scalar_outcome(data, thresholds):
+    '''eligibility_rules.OUTCOMES key the single lead route decides for data.'''
+
+    from online_leads import eligibility_rules
+    from online_leads import request_schema
+
+    lead = request_schema.parse(data)
+    if lead.missing_params:
+        return 'missing_params'
+    if lead.dev_bypass:
+        return 'dev_bypass'
+    if lead.invalid_param is not None:
+        return lead.invalid_param
+
+    failed_rule = eligibility_rules.ENGINE.run(lead, thresholds, API_NAME)
+    return failed_rule.name if failed_rule is not None else 'success'
+
+
+@pytest.fixture()
+def backtest(api):
+    from online_leads import backtest
+
+    return backtest
+
+
+def test_baseline_and_candidate_outcomes_equal_the_scalar_rules(backtest):
+    leads = sample_leads()
+    history_df = pd.DataFrame({'api_name': API_NAME,
+                               'api_error_label': 'NA',
+                               'api_request': [json.dumps(lead) for lead in leads]})
+
+    run = backtest.Backtest(backtest.history_to_frame(history_df))
+    baseline = backtest.thresholds_from_values(fakes.DEFAULT_THRESHOLDS)
+    candidate = backtest.with_changes(baseline, 'low_vintage', {'MIN_VINTAGE': 6, 'MIN_TURNOVER': 100000})
+
+    for thresholds in (baseline, candidate):
+        expected = [scalar_outcome(lead, thresholds) for lead in leads]
+        assert list(run.outcome_keys(thresholds)) == expected
+
+    # the sample goes through most checks
+    assert len(set(expected)) >= 10
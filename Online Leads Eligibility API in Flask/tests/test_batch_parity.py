@@ -0,0 +1,115 @@
+"""
+The batch route answers every lead as the single lead route does.
+
+"""
+
+import itertools
+
+import pytest
+
+from benchmarks import fakes
+from benchmarks.run_benchmark import API_URL, BATCH_API_URL, BASE_LEAD
+
+
+_application_ids = itertools.count()
+
+
+def lead(**changes):
+    '''Base lead with a new application_id, a change to None drops the param.'''
+
+    data = dict(BASE_LEAD, application_id=f'TEST-{next(_application_ids)}')
+    for key, value in changes.items():
+        if value is None:
+            data.pop(key, None)
+        else:
+            data[key] = value
+    return data
+
+
+def single_response(client, data):
+    response = client.post(API_URL, json=dict(data, token=fakes.VALID_TOKEN))
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def batch_responses(client, leads):
+    response = client.post(BATCH_API_URL, json={'token': fakes.VALID_TOKEN, 'leads': leads})
+    assert response.status_code == 200
+    return [{key: value for key, value in lead_response.items() if key != 'application_id'}
+            for lead_response in response.get_json()['body']['leads']]
+
+
+def test_null_pincode_does_not_change_the_other_leads(client):
+    leads = [lead(business_pincode=560001), lead(business_pincode=None), lead(business_pincode=5600011),
+             lead(business_pincode=700001)]
+    leads[1]['business_pincode'] = None
+
+    responses = batch_responses(client, leads)
+
+    assert responses[0]['body']['online_leads_eligibility_status'] == 'success'
+    assert responses[1]['request_message'] == 'all mandatory parameters are not sent'
+    assert responses[2]['body']['body_message'] == 'entered pincode is wrong'
+    assert responses[3]['body']['error_response_code'] == '252'
+
+
+@pytest.mark.parametrize('changes', [
+    {},
+    {'business_pincode': 560001},
+    {'business_pincode': '5600011'},
+    {'app_highmark_score_A8': '720.0'},
+    {'app_highmark_score_A8': 720.0},
+    {'app_highmark_score_A8': '720.5'},
+    {'app_highmark_score_A8': 720.5},
+    {'app_highmark_score_A8': 720},
+    {'app_highmark_score_A8': 'abc'},
+    {'app_highmark_score_A8': '500'},
+    {'vintage_months': '6'},
+    {'required_loan_amount': '-10'},
+    {'vintage_months': 'nan'},
+    {'average_annual_turnover': 'inf'},
+    {'business_name': ''},
+    {'applicant_name': '  '},
+    {'loan_purpose': 'Machine Purchase'},
+])
+def test_batch_and_single_routes_agree(client, changes):
+    data = lead(**changes)
+
+    assert batch_responses(client, [data]) == [single_response(client, data)]
+
+
+@pytest.mark.parametrize('param', ['business_name', 'app_highmark_score_A8', 'vintage_months'])
+def test_null_mandatory_param_is_reported_as_not_sent(client, param):
+    data = lead()
+    data[param] = None
+
+    response = single_response(client, data)
+
+    assert response['request_message'] == 'all mandatory parameters are not sent'
+    assert batch_responses(client, [data]) == [response]
+
+
+def test_failed_token_history_stores_the_batch_size_not_the_headers(api, client, monkeypatch):
+    rows = []
+    monkeypatch.setattr(api[1].hist_writer, 'add_api_call_hist_data',
+                        lambda api_name, **row: rows.append(row))
+
+    response = client.post(BATCH_API_URL, json=[lead(), lead()],
+                           headers={'token': 'wrong-token', 'Authorization': 'Bearer secret'})
+
+    assert response.get_json()['request_message'] == 'invalid token'
+    assert [row['api_request'] for row in rows] == [{'leads': 2}]
+
+
+@pytest.mark.parametrize('score, message', [
+    ('720.0', None),
+    (720.0, None),
+    ('720.5', 'Parameter app_highmark_score_A8 should be an integer'),
+    ('abc', 'Parameter app_highmark_score_A8 should be numeric'),
+])
+def test_highmark_score_written_as_a_float(client, score, message):
+    response = single_response(client, lead(app_highmark_score_A8=score))
+
+    if message is None:
+        assert response['body']['online_leads_eligibility_status'] == 'success'
+    else:
+        assert response['request_message'] == message
@@ -0,0 +1,41 @@
+"""
+Calls abandoned at their deadline are bounded, a saturated pool counts as a failure.
+
+"""
+
+import threading
+import time
+
+import pytest
+
+from online_leads.circuit_breaker import CallTimeout, CircuitBreaker, PoolSaturated, CLOSED, OPEN
+
+
+def test_abandoned_calls_saturate_the_pool():
+    breaker = CircuitBreaker('test_saturation', call_timeout_seconds=0.05, min_calls=3,
+                             failure_rate_threshold=1.0, max_workers=2)
+    release = threading.Event()
+
+    for _ in range(2):
+        with pytest.raises(CallTimeout):
+            breaker.call(release.wait)
+
+    started_at = time.monotonic()
+    with pytest.raises(PoolSaturated):
+        breaker.call(lambda: 'answer')
+    assert time.monotonic() - started_at < 0.05
+
+    stats = breaker.stats()
+    assert stats['in_flight'] == 2
+    assert stats['failures'] == 3
+    assert stats['state'] == OPEN
+
+    release.set()
+    deadline = time.monotonic() + 1
+    while breaker.stats()['in_flight'] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert breaker.stats()['in_flight'] == 0
+
+    breaker.reset()
+    assert breaker.call(lambda: 'answer') == 'answer'
+    assert breaker.state == CLOSED
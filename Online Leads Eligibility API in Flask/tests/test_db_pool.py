@@ -0,0 +1,68 @@
+"""
+The database pool checks the configured tables before their first use, and credentials are kept
+out of the history rows on both history paths.
+
+"""
+
+import json
+import sqlite3
+
+import pytest
+from werkzeug.datastructures import Headers
+
+from benchmarks import fakes
+
+
+@pytest.fixture()
+def db_pool(api):
+    from online_leads import db_pool
+
+    return db_pool
+
+
+def test_history_rows_leave_out_the_token_and_headers(db_pool):
+    row = {'api_name': 'api', 'api_error_label': 'NA', 'api_status': 'success', 'logic_status': 'success',
+           'api_request': {'token': fakes.VALID_TOKEN, 'application_id': 'APP-1'},
+           'api_response': {'request_status': 'success'}}
+
+    values = dict(zip(db_pool.HIST_COLUMNS, db_pool._history_values(row)))
+
+    assert json.loads(values['api_request']) == {'application_id': 'APP-1'}
+
+    headers = Headers({'Authorization': 'Bearer secret', 'token': fakes.VALID_TOKEN, 'User-Agent': 'ads',
+                       'application_id': 'APP-2'})
+    assert db_pool.history_request(headers) == {'application_id': 'APP-2'}
+
+
+def test_missing_table_turns_the_pool_off(db_pool, monkeypatch, tmp_path):
+    path = str(tmp_path / 'los.db')
+    fakes.create_sqlite_database(path, 'api')
+    pool = db_pool.ConnectionPool(lambda: sqlite3.connect(path, check_same_thread=False), paramstyle='qmark')
+    monkeypatch.setattr(db_pool, 'DB_DSN', path)
+    monkeypatch.setattr(db_pool, '_pool', pool)
+    monkeypatch.setattr(db_pool, '_schema_error', None)
+    monkeypatch.setattr(db_pool, '_schema_checked', False)
+
+    # checked on the first call; the default tables are in the dsapi schema, which the SQLite
+    # file does not have
+    assert not db_pool.enabled()
+    assert 'LOS_DB_THRESHOLDS_TABLE' in str(db_pool._schema_error)
+
+    with pytest.raises(db_pool.SchemaError, match='LOS_DB_THRESHOLDS_TABLE'):
+        db_pool.check_schema()
+    pool.close()
+
+
+def test_avf_history_rows_leave_out_the_token(db_pool, monkeypatch):
+    from utilities import api_validation_function as avf
+    from online_leads import hist_writer
+
+    rows = []
+    monkeypatch.setattr(avf, 'add_api_call_hist_data', lambda **row: rows.append(row))
+
+    hist_writer.write_rows_one_by_one([{'api_name': 'api', 'api_error_label': 'NA', 'api_status': 'success',
+                                        'logic_status': 'success',
+                                        'api_request': {'token': fakes.VALID_TOKEN, 'application_id': 'APP-3'},
+                                        'api_response': {'request_status': 'success'}}])
+
+    assert [row['api_request'] for row in rows] == [{'application_id': 'APP-3'}]
@@ -0,0 +1,61 @@
+"""
+Highmark report URLs are only fetched from the allowed schemes and hosts, CHECK 9 is skipped
+for the others.
+
+"""
+
+import pytest
+
+from benchmarks import fakes
+from benchmarks.run_benchmark import API_URL, ASYNC_API_URL, BATCH_API_URL, BASE_LEAD
+
+
+@pytest.fixture()
+def highmark_report(api, monkeypatch):
+    from online_leads import highmark_report
+
+    monkeypatch.setattr(highmark_report, 'HIGHMARK_XML_ENABLED', True)
+    monkeypatch.setattr(highmark_report, 'HIGHMARK_XML_ALLOWED_SCHEMES', ('https',))
+    monkeypatch.setattr(highmark_report, 'HIGHMARK_XML_ALLOWED_HOSTS', ('reports.example.com', '.crif.example'))
+    return highmark_report
+
+
+@pytest.mark.parametrize('url, allowed', [
+    ('https://reports.example.com/b2c/1.xml', True),
+    ('https://eu.crif.example/b2c/1.xml', True),
+    ('http://reports.example.com/b2c/1.xml', False),
+    ('https://reports.example.com.evil.example/1.xml', False),
+    ('https://reports.example.com@169.254.169.254/latest/meta-data', False),
+    ('http://169.254.169.254/latest/meta-data', False),
+    ('file:///etc/passwd', False),
+    ('/etc/passwd', False),
+    ('https://[::1', False),
+])
+def test_allowed_url(highmark_report, url, allowed):
+    assert highmark_report.allowed_url(url) is allowed
+
+
+def test_fetcher_does_not_request_other_hosts(highmark_report):
+    fetcher = highmark_report.HighmarkReportFetcher(session=object())
+
+    with pytest.raises(highmark_report.HighmarkReportError, match='not allowed'):
+        fetcher.fetch_score('http://127.0.0.1:8080/report')
+
+
+def test_routes_skip_check_9_for_other_report_urls(highmark_report, client, monkeypatch, caplog):
+    def unexpected_read(self, url, deadline):
+        raise AssertionError(f'{url} fetched')
+
+    monkeypatch.setattr(highmark_report.HighmarkReportFetcher, '_read_url', unexpected_read)
+    data = dict(BASE_LEAD, token=fakes.VALID_TOKEN, application_id='HIGHMARK-1',
+                applicant_highmark_XML='http://169.254.169.254/latest/meta-data')
+
+    single = client.post(API_URL, json=data).get_json()
+    concurrent = client.post(ASYNC_API_URL, json=dict(data, application_id='HIGHMARK-2')).get_json()
+    batch = client.post(BATCH_API_URL, json={'token': fakes.VALID_TOKEN, 'leads': [data]}).get_json()
+
+    # the lead is answered like one with an unreadable report, from the other checks
+    assert single['body']['error_response_code'] == 'NA'
+    assert concurrent['body']['error_response_code'] == 'NA'
+    assert batch['body']['leads'][0]['body']['error_response_code'] == 'NA'
+    assert 'is not allowed' in caplog.text
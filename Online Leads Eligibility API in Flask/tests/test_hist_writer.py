@@ -0,0 +1,74 @@
+"""
+The history writer writes every queued row when stopped, and starts a new worker thread when
+its thread died.
+
+"""
+
+import pytest
+
+
+@pytest.fixture()
+def hist_writer(api):
+    from online_leads import hist_writer
+
+    return hist_writer
+
+
+def row(application_id):
+    return {'api_name': 'api', 'api_error_label': 'NA', 'api_status': 'success', 'logic_status': 'success',
+            'api_request': {'application_id': application_id}, 'api_response': {'request_status': 'success'}}
+
+
+def add(writer, application_id):
+    writer.add_api_call_hist_data(**row(application_id))
+
+
+def written_ids(batches):
+    return [written['api_request']['application_id'] for batch in batches for written in batch]
+
+
+def test_stop_writes_the_queued_rows(hist_writer):
+    batches = []
+    writer = hist_writer.HistoryWriter(sink=batches.append, batch_size=2, flush_interval_seconds=60)
+
+    for application_id in ('APP-1', 'APP-2', 'APP-3', 'APP-4', 'APP-5'):
+        add(writer, application_id)
+    writer.stop()
+
+    assert written_ids(batches) == ['APP-1', 'APP-2', 'APP-3', 'APP-4', 'APP-5']
+    assert writer.stats()['written'] == 5
+    assert writer.stats()['queue_size'] == 0
+
+
+def test_rows_queued_without_a_worker_are_written_on_stop(hist_writer):
+    batches = []
+    writer = hist_writer.HistoryWriter(sink=batches.append)
+    writer._queue.put(row('APP-6'))
+
+    writer.stop()
+
+    assert written_ids(batches) == ['APP-6']
+
+
+@pytest.mark.filterwarnings('ignore::pytest.PytestUnhandledThreadExceptionWarning')
+def test_dead_worker_thread_is_restarted(hist_writer):
+    batches = []
+
+    def crashing_once(rows):
+        if not batches:
+            batches.append(None)
+            # not an Exception, _write does not catch it and the worker thread ends
+            raise SystemExit('worker crashed')
+        batches.append(rows)
+
+    writer = hist_writer.HistoryWriter(sink=crashing_once, flush_interval_seconds=0.01)
+    add(writer, 'APP-7')
+    crashed = writer._thread
+    crashed.join(timeout=5)
+    assert not crashed.is_alive()
+
+    add(writer, 'APP-8')
+    assert writer._thread is not crashed and writer._thread.is_alive()
+    writer.stop()
+
+    assert written_ids(batches[1:]) == ['APP-8']
@@ -0,0 +1,56 @@
+"""
+Worker metric files are written when the worker exits, and the gauges of an exited worker are
+dropped even once its pid is given to another process.
+
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+
+@pytest.fixture()
+def metrics(api, monkeypatch, tmp_path):
+    from online_leads import metrics
+
+    monkeypatch.setattr(metrics, 'METRICS_DIR', str(tmp_path))
+    return metrics
+
+
+def write_worker_file(metrics, name, worker):
+    snapshot = {'counters': [], 'gauges': [[name, [], 1]], 'histograms': [], 'worker': worker}
+    with open(metrics._worker_file(name), 'w', encoding='utf-8') as worker_file:
+        json.dump(snapshot, worker_file)
+
+
+def test_gauges_of_exited_workers_are_dropped(metrics):
+    pid = os.getpid()
+    started = metrics._process_started(pid)
+    if started is None:
+        pytest.skip('no /proc to read process start times from')
+
+    # this process, and an exited worker whose pid was given to this process
+    write_worker_file(metrics, 'live_worker', {'pid': pid, 'started': started})
+    write_worker_file(metrics, 'exited_worker', {'pid': pid, 'started': started - 1})
+
+    gauges = {name for snapshot in metrics.collect() for name, _, _ in snapshot['gauges']}
+
+    assert 'live_worker' in gauges
+    assert 'exited_worker' not in gauges
+
+
+def test_worker_file_is_written_at_exit(tmp_path):
+    api_folder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    code = ('from online_leads import metrics\n'
+            'metrics.inc("online_leads_responses_total", code="NA")\n')
+    env = dict(os.environ, LOS_METRICS_DIR=str(tmp_path), LOS_METRICS_FLUSH_SECONDS='600',
+               PYTHONPATH=api_folder)
+
+    subprocess.run([sys.executable, '-c', code], env=env, check=True, timeout=30)
+
+    worker_file, = tmp_path.glob('metrics_*.json')
+    snapshot = json.loads(worker_file.read_text(encoding='utf-8'))
+    assert snapshot['counters'] == [['online_leads_responses_total', [['code', 'NA']], 1]]
@@ -0,0 +1,53 @@
+"""
+While the Pincode Eng API is down, a pincode is answered from the last known good set, and an
+unknown one is not serviceable unless LOS_PINCODE_FALLBACK_SERVICEABLE is set.
+
+"""
+
+import pytest
+
+
+@pytest.fixture()
+def pincode_index(api):
+    from online_leads import pincode_index
+
+    yield pincode_index
+    pincode_index.get_breaker().reset()
+
+
+@pytest.fixture()
+def outage(api, monkeypatch):
+    '''Append to the list to take the Pincode Eng API down.'''
+
+    from los import los_function as lf
+
+    check_pincode = lf.check_pincode
+    outage = []
+
+    def unavailable_while_down(business_pincode, request_data=None, api_name=None):
+        if outage:
+            raise ConnectionError('Pincode Eng API unavailable')
+        return check_pincode(business_pincode, request_data=request_data, api_name=api_name)
+
+    monkeypatch.setattr(lf, 'check_pincode', unavailable_while_down)
+    return outage
+
+
+def test_outage_answers_from_the_last_known_good_set(pincode_index, outage):
+    assert pincode_index.remote_check_pincode('560201') is True
+    assert pincode_index.remote_check_pincode('700201') is False
+
+    outage.append(True)
+
+    assert pincode_index.remote_check_pincode('560201') is True
+    assert pincode_index.remote_check_pincode('700201') is False
+
+
+def test_unknown_pincode_fails_closed_by_default(pincode_index, outage, monkeypatch):
+    outage.append(True)
+
+    assert pincode_index.PINCODE_FALLBACK_SERVICEABLE is False
+    assert pincode_index.remote_check_pincode('560202') is False
+
+    monkeypatch.setattr(pincode_index, 'PINCODE_FALLBACK_SERVICEABLE', True)
+    assert pincode_index.remote_check_pincode('560203') is True
@@ -0,0 +1,96 @@
+"""
+A compiled reference snapshot reads back the same pincodes, sectors and thresholds, and a
+truncated or corrupted file is rejected.
+
+"""
+
+import pytest
+
+from benchmarks import fakes
+from benchmarks.run_benchmark import API_NAME
+
+
+@pytest.fixture()
+def reference_snapshot(api):
+    from online_leads import reference_snapshot
+
+    return reference_snapshot
+
+
+@pytest.fixture()
+def snapshot_path(reference_snapshot, tmp_path):
+    from online_leads import threshold_cache
+
+    thresholds = threshold_cache.Thresholds(version='test',
+                                            **{field: int(fakes.DEFAULT_THRESHOLDS[key])
+                                               for key, field in threshold_cache.THRESHOLD_KEYS})
+    path = str(tmp_path / 'reference.snapshot')
+    reference_snapshot.compile_snapshot(path,
+                                        pincodes=['560001', '110001'],
+                                        excluded_sector_rows=[('Trading', 'Retail')],
+                                        excluded_subsector_rows=[('Manufacturing', 'Proprietorship', 'Tobacco')],
+                                        thresholds={API_NAME: thresholds})
+    return path
+
+
+def test_snapshot_round_trip(reference_snapshot, snapshot_path):
+    snapshot = reference_snapshot.ReferenceSnapshot(snapshot_path)
+
+    assert snapshot.is_serviceable('560001') is True
+    assert snapshot.is_serviceable('110001') is True
+    assert snapshot.is_serviceable('700001') is False
+    assert snapshot.is_serviceable('5600011') is False
+
+    assert snapshot.is_valid_sector('Trading', 'Retail') is False
+    assert snapshot.is_valid_sector('Trading', 'Wholesale') is True
+
+    assert snapshot.is_excluded_subsector('Manufacturing', 'Proprietorship', 'Tobacco') is True
+    assert snapshot.is_excluded_subsector('Manufacturing', 'Proprietorship', 'Textiles') is False
+
+    thresholds = snapshot.thresholds(API_NAME)
+    assert thresholds.min_vintage == fakes.DEFAULT_THRESHOLDS['MIN_VINTAGE']
+    assert thresholds.max_loan_amount == fakes.DEFAULT_THRESHOLDS['MAX_LOAN_AMOUNT']
+    assert thresholds.version == snapshot.version
+    assert snapshot.thresholds('other_api') is None
+
+
+def test_sections_left_out_answer_none(reference_snapshot, tmp_path):
+    path = str(tmp_path / 'pincodes.snapshot')
+    reference_snapshot.compile_snapshot(path, pincodes=['560001'])
+    snapshot = reference_snapshot.ReferenceSnapshot(path)
+
+    assert snapshot.is_serviceable('560001') is True
+    assert snapshot.is_valid_sector('Trading', 'Retail') is None
+    assert snapshot.is_excluded_subsector('Manufacturing', 'Proprietorship', 'Tobacco') is None
+    assert snapshot.thresholds(API_NAME) is None
+
+
+# cut inside the header, and inside the last section
+@pytest.mark.parametrize('size', [8, -1])
+def test_truncated_snapshot_is_rejected(reference_snapshot, snapshot_path, size):
+    with open(snapshot_path, 'rb') as snapshot_file:
+        data = snapshot_file.read()
+    with open(snapshot_path, 'wb') as snapshot_file:
+        snapshot_file.write(data[:size])
+
+    with pytest.raises(ValueError):
+        reference_snapshot.ReferenceSnapshot(snapshot_path)
+
+
+def test_corrupted_snapshot_is_rejected(reference_snapshot, snapshot_path):
+    with open(snapshot_path, 'r+b') as snapshot_file:
+        snapshot_file.seek(-1, 2)
+        last = snapshot_file.read(1)
+        snapshot_file.seek(-1, 2)
+        snapshot_file.write(bytes([last[0] ^ 0xff]))
+
+    with pytest.raises(ValueError, match='corrupted'):
+        reference_snapshot.ReferenceSnapshot(snapshot_path)
+
+
+def test_other_format_is_rejected(reference_snapshot, snapshot_path):
+    with open(snapshot_path, 'r+b') as snapshot_file:
+        snapshot_file.write(b'NOTASNAP')
+
+    with pytest.raises(ValueError, match='unknown format'):
+        reference_snapshot.ReferenceSnapshot(snapshot_path)
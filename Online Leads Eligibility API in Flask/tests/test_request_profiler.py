@@ -0,0 +1,59 @@
+"""
+A profiled request is sampled along with the threads working for it, only a request asking
+for its profile is told the profile file.
+
+"""
+
+import contextvars
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def waiting_lookup(seconds):
+    time.sleep(seconds)
+
+
+def test_threads_working_for_the_request_are_sampled(api):
+    from online_leads import request_profiler
+
+    sampler = request_profiler.StackSampler(threading.get_ident(), sys._getframe(), interval_seconds=0.001).start()
+    token = request_profiler._active_sampler.set(sampler)
+    try:
+        context = contextvars.copy_context()
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix='lookup') as executor:
+            executor.submit(context.run, request_profiler.sampled_call, waiting_lookup, 0.05).result()
+    finally:
+        request_profiler._active_sampler.reset(token)
+        sampler.stop()
+
+    stacks = [labels for labels, _ in sampler.weighted_stacks('view')]
+    assert ('view', '[lookup_0]', f'{__name__}.waiting_lookup') in stacks
+
+
+def test_profile_file_is_only_named_to_a_header_request(api, monkeypatch, tmp_path):
+    from flask import Flask
+    from online_leads import request_profiler
+
+    monkeypatch.setattr(request_profiler, 'PROFILE_TOKEN', 'profile-token')
+    monkeypatch.setattr(request_profiler, 'PROFILE_SAMPLE_RATE', 1.0)
+    write_profile = request_profiler.write_profile
+    monkeypatch.setattr(request_profiler, 'write_profile',
+                        lambda *args: write_profile(*args, directory=str(tmp_path)))
+
+    app = Flask(__name__)
+
+    @app.route('/profiled')
+    @request_profiler.profiled('api')
+    def profiled_view():
+        return 'ok'
+
+    client = app.test_client()
+    sampled = client.get('/profiled')
+    asked = client.get('/profiled', headers={request_profiler.PROFILE_HEADER: 'profile-token'})
+
+    assert request_profiler.PROFILE_FILE_HEADER not in sampled.headers
+    assert (tmp_path / asked.headers[request_profiler.PROFILE_FILE_HEADER]).exists()
+    # the sampled request is profiled all the same
+    assert len(list(tmp_path.iterdir())) == 2
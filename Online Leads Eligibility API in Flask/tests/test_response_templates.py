@@ -0,0 +1,41 @@
+"""
+The pre-encoded response bodies are byte for byte what jsonify sends for the same payload.
+
+"""
+
+import pytest
+from flask import jsonify
+
+
+@pytest.fixture()
+def response_templates(api):
+    from online_leads import response_templates
+
+    return response_templates
+
+
+def fixed_templates(response_templates):
+    templates = dict(response_templates.TEMPLATES, invalid_method=response_templates.INVALID_METHOD,
+                     rate_limited=response_templates.RATE_LIMITED, overloaded=response_templates.OVERLOADED)
+    return sorted(templates.items())
+
+
+def test_every_fixed_outcome_is_encoded_like_jsonify(api, response_templates):
+    with api[0].app_context():
+        for key, template in fixed_templates(response_templates):
+            assert template.body == jsonify(dict(template.payload)).get_data(), key
+
+            response = template.response()
+            assert response.get_data() == template.body
+            assert response.mimetype == 'application/json'
+
+
+@pytest.mark.parametrize('orjson_installed', [True, False])
+def test_dynamic_messages_are_encoded_like_jsonify(api, response_templates, monkeypatch, orjson_installed):
+    if not orjson_installed:
+        monkeypatch.setattr(response_templates, 'orjson', None)
+
+    payload = response_templates.response_dict('fail', 'token expired for "partner" – café\n', 'NA', 'NA', 'NA')
+
+    with api[0].app_context():
+        assert response_templates.encode(payload) == jsonify(payload).get_data()
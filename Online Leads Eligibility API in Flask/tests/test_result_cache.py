@@ -0,0 +1,52 @@
+"""
+Redelivered leads get the stored response only while it still holds: not after a fallback
+answer and not after the reference data changed.
+
+"""
+
+import itertools
+
+from benchmarks import fakes
+from benchmarks.run_benchmark import API_URL, BASE_LEAD
+
+
+_application_ids = itertools.count()
+
+
+def lead(**changes):
+    return dict(BASE_LEAD, token=fakes.VALID_TOKEN, application_id=f'CACHE-{next(_application_ids)}', **changes)
+
+
+def error_code(client, data):
+    response = client.post(API_URL, json=data)
+    assert response.status_code == 200
+    return response.get_json()['body']['error_response_code']
+
+
+def test_pincode_fallback_answer_is_not_stored(api, client, monkeypatch):
+    from los import los_function as lf
+
+    data = lead(business_pincode='560123')
+
+    def unavailable(business_pincode, request_data=None, api_name=None):
+        raise ConnectionError('Pincode Eng API unavailable')
+
+    with monkeypatch.context() as patch:
+        patch.setattr(lf, 'check_pincode', unavailable)
+        assert error_code(client, data) == '252'
+
+    assert error_code(client, data) == 'NA'
+
+
+def test_new_pincode_index_is_not_answered_from_stored_responses(api, client):
+    from online_leads import pincode_index
+
+    data = lead(business_pincode='700001')
+    assert error_code(client, data) == '252'
+
+    serviceability = pincode_index.get_serviceability()
+    serviceability.load(['700001'])
+    try:
+        assert error_code(client, data) == 'NA'
+    finally:
+        serviceability.replace(None)
@@ -0,0 +1,41 @@
+"""
+The rule engine answers with the failing rule of lowest precedence whatever order it runs the
+rules in.
+
+"""
+
+import pytest
+
+
+@pytest.fixture()
+def rule_engine(api):
+    from online_leads import rule_engine
+
+    return rule_engine
+
+
+def rejects(*values):
+    '''Check rejecting a lead (a set of names here) holding one of values.'''
+
+    return lambda lead, thresholds, api_name: bool(lead & set(values))
+
+
+def test_lowest_precedence_wins_under_the_adaptive_order(rule_engine):
+    Rule = rule_engine.Rule
+    engine = rule_engine.RuleEngine([Rule('vintage', 4, rule_engine.COST_MEMORY, 'vintage', rejects('vintage'), 'CHECK 4'),
+                                     Rule('loan_purpose', 8, rule_engine.COST_MEMORY, 'loan_purpose',
+                                          rejects('loan_purpose'), 'CHECK 8'),
+                                     Rule('pincode', 1, rule_engine.COST_IO, 'pincode', rejects('pincode'), 'CHECK 1')],
+                                    adaptive=True, reorder_every=1)
+
+    # loan_purpose rejects most, it is moved ahead of vintage
+    for _ in range(3):
+        assert engine.run({'loan_purpose'}, None, 'api').name == 'loan_purpose'
+    assert engine.order == ['loan_purpose', 'vintage', 'pincode']
+
+    assert engine.run({'loan_purpose', 'vintage'}, None, 'api').name == 'vintage'
+    assert engine.run({'loan_purpose', 'vintage', 'pincode'}, None, 'api').name == 'pincode'
+    assert engine.run(set(), None, 'api') is None
+
+    stats = engine.stats()
+    assert stats['loan_purpose'] == {'evaluated': 6, 'rejected': 5, 'rejection_rate': 5 / 6}
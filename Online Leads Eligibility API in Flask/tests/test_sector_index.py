@@ -0,0 +1,33 @@
+"""
+An empty sector snapshot is rejected, the loaded index stays in use.
+
+"""
+
+import os
+
+
+def write(path, text, mtime):
+    path.write_text(text, encoding='utf-8')
+    os.utime(path, ns=(mtime, mtime))
+    return str(path)
+
+
+def test_empty_snapshot_keeps_the_current_index(api, tmp_path):
+    from online_leads import sector_index
+
+    sector_path = write(tmp_path / 'sectors.csv', 'business_main_sector,business_type\nTrading,Retail\n', 1)
+    subsector_path = write(tmp_path / 'subsectors.csv',
+                           'business_main_sector,business_type,business_specific_sector\nTrading,Retail,Liquor\n', 1)
+    reference = sector_index.SectorReference(sector_path, subsector_path, reload_check_seconds=60)
+
+    assert reference.reload()
+    index = reference.index
+    assert not index.is_valid_sector('trading', ' RETAIL ')
+
+    write(tmp_path / 'sectors.csv', 'business_main_sector,business_type\n', 2)
+    assert not reference.reload()
+    assert reference.index is index
+
+    write(tmp_path / 'sectors.csv', '', 3)
+    assert not reference.reload()
+    assert reference.index is index
@@ -0,0 +1,21 @@
+"""
+LOS_TRACE_LEVEL takes a level name or number, anything else falls back to INFO.
+
+"""
+
+import logging
+
+import pytest
+
+
+@pytest.mark.parametrize('value, level', [
+    ('DEBUG', logging.DEBUG),
+    (' warning ', logging.WARNING),
+    ('15', 15),
+    ('verbose', logging.INFO),
+    ('', logging.INFO),
+])
+def test_trace_level(api, value, level):
+    from online_leads import step_trace
+
+    assert step_trace._trace_level(value) == level
@@ -0,0 +1,132 @@
+"""
+The threshold cache reloads on its TTL, on invalidate() and when its version changes, and
+invalidate() reaches the other workers and the thresholds of the reference snapshot.
+
+"""
+
+import time
+
+import pytest
+
+
+API_NAME = 'online_leads_eligibility'
+
+
+class Table(object):
+    '''Stands in for los_thresholds, counts the reads.'''
+
+    def __init__(self, api):
+        self.frame = api[2].thresholds_frame()
+        self.reads = 0
+        self.during_read = None
+
+    def load(self, api_name):
+        self.reads += 1
+        if self.during_read is not None:
+            self.during_read()
+        return self.frame.copy()
+
+    def set(self, key, value):
+        self.frame.loc[self.frame['var_key'] == key, 'var_value'] = value
+
+
+@pytest.fixture()
+def threshold_cache(api, monkeypatch, tmp_path):
+    from online_leads import threshold_cache
+
+    monkeypatch.setattr(threshold_cache, 'THRESHOLD_INVALIDATION_FILE', str(tmp_path / 'thresholds.invalidated'))
+    monkeypatch.setattr(threshold_cache, 'THRESHOLD_VERSION_CHECK_SECONDS', 0)
+    monkeypatch.setattr(threshold_cache, '_marker', ('', float('-inf')))
+    return threshold_cache
+
+
+@pytest.fixture()
+def table(api):
+    return Table(api)
+
+
+def test_thresholds_are_read_once_per_ttl(threshold_cache, table, monkeypatch):
+    cache = threshold_cache.ThresholdCache(API_NAME, loader=table.load, ttl_seconds=60)
+
+    first = cache.get()
+    assert cache.get() is first
+    assert table.reads == 1
+
+    table.set('MIN_VINTAGE', '18')
+    now = time.monotonic()
+    monkeypatch.setattr(threshold_cache.time, 'monotonic', lambda: now + 61)
+    assert cache.get().min_vintage == 18
+    assert cache.get().version != first.version
+    assert table.reads == 2
+
+
+def test_invalidate_during_a_refresh_is_not_lost(threshold_cache, table):
+    cache = threshold_cache.ThresholdCache(API_NAME, loader=table.load, ttl_seconds=60)
+    cache.get()
+
+    table.during_read = cache.invalidate
+    cache.refresh()
+    table.during_read = None
+
+    # the values read while invalidate() ran may be the old ones, they are read again
+    table.set('MIN_VINTAGE', '18')
+    assert cache.get().min_vintage == 18
+    assert table.reads == 3
+    cache.get()
+    assert table.reads == 3
+
+
+def test_refresher_reloads_when_the_version_changes(threshold_cache, table):
+    version = ['1']
+    cache = threshold_cache.ThresholdCache(API_NAME, loader=table.load, ttl_seconds=60,
+                                           version_loader=lambda api_name: version[0],
+                                           version_check_seconds=0.01)
+    cache.start()
+    try:
+        cache.get()
+        table.set('MIN_VINTAGE', '18')
+        version[0] = '2'
+
+        deadline = time.monotonic() + 5
+        while cache.get().min_vintage != 18 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert cache.get().min_vintage == 18
+    finally:
+        cache.stop()
+
+
+def test_invalidate_reaches_other_workers(threshold_cache, table):
+    # a cache created by get_cache() in another worker, sharing the marker file
+    other_worker = threshold_cache.ThresholdCache(API_NAME, loader=table.load, ttl_seconds=60,
+                                                  version_loader=threshold_cache.invalidation_marker)
+    other_worker.get()
+    assert not other_worker._needs_reload()
+
+    threshold_cache.invalidate(API_NAME)
+
+    assert other_worker._needs_reload()
+
+
+def test_invalidate_overrides_the_snapshot_thresholds(threshold_cache, table, monkeypatch):
+    snapshot_thresholds = threshold_cache.Thresholds.from_frame(table.frame, version='snapshot-1')
+
+    class Snapshot(object):
+        version = 'snapshot-1'
+
+        def thresholds(self, api_name):
+            return snapshot_thresholds
+
+    snapshot = Snapshot()
+    monkeypatch.setattr(threshold_cache.reference_snapshot, 'current', lambda: snapshot)
+    monkeypatch.setattr(threshold_cache, '_caches', {
+        API_NAME: threshold_cache.ThresholdCache(API_NAME, loader=table.load, ttl_seconds=60)})
+
+    assert threshold_cache.get_thresholds(API_NAME) is snapshot_thresholds
+
+    table.set('MIN_VINTAGE', '18')
+    threshold_cache.invalidate(API_NAME)
+    assert threshold_cache.get_thresholds(API_NAME).min_vintage == 18
+
+    # a snapshot published after invalidate() takes precedence again
+    snapshot.version = 'snapshot-2'
+    assert threshold_cache.get_thresholds(API_NAME) is snapshot_thresholds
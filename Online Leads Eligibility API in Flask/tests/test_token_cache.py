@@ -0,0 +1,31 @@
+"""
+The token cache keys on the token and the configured credential fields only.
+
+"""
+
+from werkzeug.datastructures import Headers
+
+from benchmarks import fakes
+
+
+def test_only_credential_fields_are_hashed(api):
+    from online_leads import token_cache
+
+    validations = []
+
+    def validate(request_data, api_name):
+        validations.append(request_data.get('X-Api-User'))
+        return {'status': 'success', 'error': None}
+
+    cache = token_cache.TokenCache(validate=validate, credential_params=('X-Api-User',),
+                                   revocation_path=None)
+
+    for user_agent, content_length in (('ads/1.0', '512'), ('ads/1.1', '2048')):
+        headers = Headers({'token': fakes.VALID_TOKEN, 'X-Api-User': 'partner-1',
+                           'User-Agent': user_agent, 'Content-Length': content_length})
+        assert cache.validate_token_and_api_access(headers, 'api')['status'] == 'success'
+    assert validations == ['partner-1']
+
+    other_user = Headers({'token': fakes.VALID_TOKEN, 'X-Api-User': 'partner-2'})
+    cache.validate_token_and_api_access(other_user, 'api')
+    assert validations == ['partner-1', 'partner-2']